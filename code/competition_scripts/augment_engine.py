@@ -0,0 +1,280 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：fused augmentation, the random crop, flips, size and rotation augmentation
+#                composed into one affine matrix and applied with a single warp on the uint8 image,
+#                and its batch version: crops and flips as views, one warp per image, one normalization pass
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import time
+import numpy as np
+import cv2
+
+from config import FLAGS
+
+
+def _translate(tx, ty):
+    return np.array([[1.0, 0.0, tx], [0.0, 1.0, ty], [0.0, 0.0, 1.0]])
+
+
+def _scale(sx, sy):
+    return np.array([[sx, 0.0, 0.0], [0.0, sy, 0.0], [0.0, 0.0, 1.0]])
+
+
+def _resize(src_size, dst_size):
+    """ Pixel-center aligned resize from src_size to dst_size, same sampling grid as cv2.resize
+    """
+    ratio = float(dst_size) / src_size
+    return _translate(0.5 * ratio - 0.5, 0.5 * ratio - 0.5).dot(_scale(ratio, ratio))
+
+
+def _rotate(angle, size):
+    """ Counter-clockwise rotation around the image center, same direction as skimage.transform.rotate
+    """
+    theta = np.deg2rad(angle)
+    center = (size - 1) / 2.0
+    rotation = np.array([[np.cos(theta), np.sin(theta), 0.0],
+                         [-np.sin(theta), np.cos(theta), 0.0],
+                         [0.0, 0.0, 1.0]])
+    return _translate(center, center).dot(rotation).dot(_translate(-center, -center))
+
+
+def _flip(flip_v, flip_h, size):
+    """ Vertical and horizontal flips of a size x size image
+    """
+    matrix = np.eye(3)
+    if flip_v:
+        matrix = _translate(0.0, size - 1).dot(_scale(1.0, -1.0)).dot(matrix)
+    if flip_h:
+        matrix = _translate(size - 1, 0.0).dot(_scale(-1.0, 1.0)).dot(matrix)
+    return matrix
+
+
+class AugmentEngine(object):
+    """
+    Draw the FLAGS-driven augmentation of one image as one affine matrix and apply it with one warp
+    """
+    def __init__(self, out_size=None, rng=None, size_before_crop=None):
+        """Initializer
+            Args:
+            out_size			: Size of the augmented images, default FLAGS.img_size
+            rng					: np.random.RandomState to draw from, default the global numpy state
+            size_before_crop	: Size of the sources with crop aug, default FLAGS.size_before_crop
+        """
+        self.out_size = out_size if out_size is not None else FLAGS.img_size
+        self.size_before_crop = size_before_crop if size_before_crop is not None else FLAGS.size_before_crop
+        self.rng = rng if rng is not None else np.random.mtrand._rand
+
+        # augmentation cost
+        self.num_images = 0
+        self.seconds = 0.0
+
+    def source_size(self):
+        """ The size the source image should be opened at
+        """
+        return self.size_before_crop if FLAGS.if_crop_augment else self.out_size
+
+    def set_resolution(self, resolution):
+        """ Augment to another size from now on
+        Args:
+            resolution	: (out_size, size_before_crop)
+        """
+        self.out_size, self.size_before_crop = resolution
+
+    def sample_transform(self, src_size):
+        """ Draw one augmentation
+        Args:
+            src_size	: Size of the square source image
+        Returns:
+            crop_box	: (x, y, size), the region of the source the matrix is relative to
+            matrix		: 3x3 affine matrix mapping crop box pixels to output pixels
+            clip		: 3x3 matrix of the rotation when the zoomed canvas has to be clipped before it, else None
+        """
+        crop_box, flips, matrix, clip = self._sample(src_size)
+        # flipping the crop box before the resize is the same as flipping the resized image
+        return crop_box, matrix.dot(_flip(flips[0], flips[1], crop_box[2])), clip
+
+    def _sample(self, src_size):
+        """ Draw one augmentation, the flips apart from the matrix
+        Returns:
+            flips	: (vertical, horizontal) flips of the crop box, applied before the matrix
+            See self.sample_transform for the others
+        """
+        rng = self.rng
+        out_size = self.out_size
+
+        # crop aug, the scale is relative to the source so the same box is drawn for any size_before_crop
+        crop_size = src_size
+        loc_x, loc_y = 0, 0
+        if FLAGS.if_crop_augment and rng.randint(2):
+            crop_size = int(src_size * FLAGS.crop_scale)
+            loc_x = rng.randint(0, src_size - crop_size)
+            loc_y = rng.randint(0, src_size - crop_size)
+        matrix = _resize(crop_size, out_size)
+
+        # flip aug
+        flips = (False, False)
+        if FLAGS.if_flip_augment:
+            flips = (bool(rng.randint(2)), bool(rng.randint(2)))
+
+        # augment size
+        zoom_in = False
+        if FLAGS.if_size_augment and rng.randint(2):
+            compress_ratio = rng.uniform(FLAGS.min_compress_ratio, FLAGS.max_compress_ratio)
+            size = int(round(compress_ratio * out_size))
+            if compress_ratio <= 1.0:
+                offset = (out_size - size) // 2
+            else:
+                offset = -((size - out_size) // 2)
+                zoom_in = True
+            matrix = _translate(offset, offset).dot(_resize(out_size, size)).dot(matrix)
+
+        # rotate augmentation
+        clip = None
+        if FLAGS.if_rotate_augment and rng.randint(2):
+            rotation = _rotate(rng.randint(-1 * FLAGS.max_rotation, FLAGS.max_rotation), out_size)
+            matrix = rotation.dot(matrix)
+            if zoom_in:
+                clip = rotation
+
+        return (loc_x, loc_y, crop_size), flips, matrix, clip
+
+    def _warp(self, region, matrix, clip, out=None):
+        """ Warp region to (out_size, out_size) with matrix, pixels mapped from outside it stay black
+        """
+        out_size = self.out_size
+        # pixels mapped from outside the crop box stay black, like the padding of the chained version
+        out = cv2.warpAffine(region, matrix[:2], (out_size, out_size), dst=out, flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        if clip is not None:
+            # the chained version crops the zoomed image to out_size before rotating, black out what it drops
+            corners = np.array([[-0.5, -0.5, 1], [out_size - 0.5, -0.5, 1],
+                                [out_size - 0.5, out_size - 0.5, 1], [-0.5, out_size - 0.5, 1]])
+            corners = clip.dot(corners.T)[:2].T
+            mask = np.zeros((out_size, out_size), dtype=np.uint8)
+            cv2.fillConvexPoly(mask, np.round(corners * 16).astype(np.int32), 1, cv2.LINE_8, 4)
+            out[mask == 0] = 0
+        return out
+
+    def augment(self, src, out=None, color_fn=None):
+        """ Augment one image
+        Args:
+            src			: (size, size, 3) uint8 source image, opened at self.source_size()
+            out			: Optional (out_size, out_size, 3) uint8 array to write into
+            color_fn	: Optional color augmentation applied to the cropped uint8 region before the warp
+        Returns:
+            (out_size, out_size, 3) uint8 augmented image
+        """
+        start_time = time.time()
+
+        (loc_x, loc_y, crop_size), matrix, clip = self.sample_transform(src.shape[0])
+        region = src[loc_y:loc_y + crop_size, loc_x:loc_x + crop_size]
+        if color_fn is not None:
+            region = color_fn(np.ascontiguousarray(region))
+        out = self._warp(region, matrix, clip, out)
+
+        self.num_images += 1
+        self.seconds += time.time() - start_time
+        return out
+
+    def augment_batch(self, src, out=None, normalize=True, color_fn=None):
+        """ Augment a stacked batch, every image with its own draw. The crop is a slice and the flips are
+        reversed strided views of the source, only the resize, size and rotation augmentation are warped,
+        then the whole batch is converted (and divided by 255) in one pass
+        Args:
+            src			: (batch, size, size, 3) uint8 sources opened at self.source_size(), a broadcast view
+            			  of one image gives batch views of it
+            out			: Optional (batch, out_size, out_size, 3) float32 array to write into
+            normalize	: (bool) True to divide by 255
+            color_fn	: See self.augment
+        Returns:
+            (batch, out_size, out_size, 3) float32 augmented batch
+        """
+        start_time = time.time()
+        batch_size, out_size = src.shape[0], self.out_size
+
+        warped = np.empty((batch_size, out_size, out_size, 3), dtype=np.uint8)
+        for i in range(batch_size):
+            (loc_x, loc_y, crop_size), (flip_v, flip_h), matrix, clip = self._sample(src.shape[1])
+            region = src[i, loc_y:loc_y + crop_size, loc_x:loc_x + crop_size]
+            region = region[::-1 if flip_v else 1, ::-1 if flip_h else 1]
+            if color_fn is not None:
+                region = color_fn(np.ascontiguousarray(region))
+            if crop_size == out_size and clip is None and np.allclose(matrix, np.eye(3)):
+                warped[i] = region
+            else:
+                self._warp(region, matrix, clip, warped[i])
+
+        if out is None:
+            out = np.empty(warped.shape, dtype=np.float32)
+        if normalize:
+            np.divide(warped, np.float32(255.0), out=out)
+        else:
+            out[:] = warped
+
+        self.num_images += batch_size
+        self.seconds += time.time() - start_time
+        return out
+
+    def cost_per_image(self):
+        """ Average augmentation cost in milliseconds
+        """
+        return 1000.0 * self.seconds / max(self.num_images, 1)
+
+    def report(self):
+        print('[augment engine] %d images, %.3f ms per image' % (self.num_images, self.cost_per_image()))
+
+
+def benchmark_augmentation(image_names, is_train=True, repeats=3):
+    """ Compare the per-image cost of the chained PIL/skimage augmentation with the fused engine
+    Args:
+        image_names	: Images to augment
+        is_train	: True to read from FLAGS.img_dir, False from FLAGS.test_img_dir
+        repeats		: Passes over image_names
+    """
+    import data_generator
+
+    engine = AugmentEngine()
+    source_size = engine.source_size()
+    sources = [data_generator.open_img(is_train, name, source_size, FLAGS.img_type) for name in image_names]
+
+    start_time = time.time()
+    for _ in range(repeats):
+        for name, src in zip(image_names, sources):
+            img = src
+            if FLAGS.if_crop_augment:
+                img = data_generator.crop_augmentation(is_train, img, name, FLAGS.crop_scale)
+            if FLAGS.if_flip_augment:
+                img = data_generator.flip_augmentation(img)
+            if FLAGS.if_size_augment:
+                img = data_generator.size_augmentation(img)
+            if FLAGS.if_rotate_augment:
+                img = data_generator.rotate_augmentation(img)
+    chained_ms = 1000.0 * (time.time() - start_time) / (repeats * len(image_names))
+
+    # one image at a time: warp, then normalize
+    out = np.zeros((engine.out_size, engine.out_size, 3), dtype=np.uint8)
+    start_time = time.time()
+    for _ in range(repeats):
+        for src in sources:
+            engine.augment(src, out=out)
+            out.astype(np.float32) / 255.0
+    fused_ms = 1000.0 * (time.time() - start_time) / (repeats * len(image_names))
+
+    batch_engine = AugmentEngine()
+    src_batch = np.stack(sources)
+    batch = np.zeros((len(sources), engine.out_size, engine.out_size, 3), dtype=np.float32)
+    for _ in range(repeats):
+        batch_engine.augment_batch(src_batch, out=batch)
+    batch_ms = batch_engine.cost_per_image()
+
+    print('chained augmentation: %.3f ms per image' % chained_ms)
+    print('fused augmentation:   %.3f ms per image, speed up %.1fx' % (fused_ms, chained_ms / fused_ms))
+    print('batch augmentation:   %.3f ms per image, speed up %.1fx' % (batch_ms, chained_ms / batch_ms))
+
+
+if __name__ == '__main__':
+    from parse_raw_data import load_catalog
+    train_images = sorted(load_catalog().train_images)
+    benchmark_augmentation(train_images[:200])
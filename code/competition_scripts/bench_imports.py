@@ -0,0 +1,128 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：import time report of every entry point, `python bench_imports.py --baseline <git rev>`
+#                also measures the scripts of an older revision and prints the startup saving
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+
+ENTRY_POINTS = ['main', 'train_ldf', 'extract_pred_latent_attr', 'train_seen_to_unseen_attr_regression',
+                'determine_gt_attr_with_latent', 'test_one_with_aug', 'data_generator', 'parse_raw_data']
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _parse_importtime(stderr, module):
+    """ Direct imports of a module in a `python -X importtime` log
+    Returns:
+        list of (package, cumulative seconds)
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, package = line.split('|', 2)
+        # children are logged before their parent, top level modules are indented by one space,
+        # their imports by two more spaces per level
+        indent = len(package) - len(package.lstrip(' '))
+        if indent == 3:
+            imports.append((package.strip(), int(cumulative) / 1e6))
+        elif indent == 1:
+            if package.strip() == module:
+                return imports
+            imports = []
+    return []
+
+
+def measure_import(module, scripts_dir=SCRIPTS_DIR, repeats=3):
+    """ Import a module in fresh interpreters
+    Returns:
+        dict with the best wall time, the top level imports of the fastest run, or the error
+    """
+    has_importtime = sys.version_info >= (3, 7)
+    command = [sys.executable] + (['-X', 'importtime'] if has_importtime else []) + ['-c', 'import ' + module]
+    best = None
+    for _ in range(repeats):
+        start_time = time.time()
+        process = subprocess.Popen(command, cwd=scripts_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        _, stderr = process.communicate()
+        wall = time.time() - start_time
+        if process.returncode != 0:
+            error = [line for line in stderr.splitlines() if not line.startswith('import time:')]
+            return {'error': error[-1] if error else 'exit code %d' % process.returncode}
+        if best is None or wall < best['wall']:
+            best = {'wall': wall, 'imports': _parse_importtime(stderr, module) if has_importtime else []}
+    return best
+
+
+def _export_revision(revision):
+    """ Scripts of a git revision in a temporary directory
+    """
+    root = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], cwd=SCRIPTS_DIR,
+                                   universal_newlines=True).strip()
+    prefix = os.path.relpath(SCRIPTS_DIR, root)
+    out_dir = tempfile.mkdtemp(prefix='bench_imports_')
+    archive = subprocess.Popen(['git', 'archive', revision, prefix], cwd=root, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', out_dir], stdin=archive.stdout)
+    archive.wait()
+    return out_dir, os.path.join(out_dir, prefix)
+
+
+def _format(result):
+    if result is None:
+        return '-'
+    if 'error' in result:
+        return 'failed'
+    return '%.3fs' % result['wall']
+
+
+def report(modules=ENTRY_POINTS, baseline=None, repeats=3, top=5):
+    """ Print the import time of every module, and of the baseline revision when given
+    """
+    baseline_results = {}
+    if baseline:
+        tmp_dir, baseline_dir = _export_revision(baseline)
+        try:
+            for module in modules:
+                if os.path.exists(os.path.join(baseline_dir, module + '.py')):
+                    baseline_results[module] = measure_import(module, baseline_dir, repeats)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    print('%-40s %10s %10s %10s' % ('entry point', 'import', 'baseline', 'saving'))
+    results = {}
+    for module in modules:
+        results[module] = measure_import(module, SCRIPTS_DIR, repeats)
+        before = baseline_results.get(module)
+        saving = '-'
+        if before is not None and 'error' not in before and 'error' not in results[module]:
+            saving = '%.3fs' % (before['wall'] - results[module]['wall'])
+        print('%-40s %10s %10s %10s' % (module, _format(results[module]), _format(before), saving))
+
+    for module in modules:
+        result = results[module]
+        if 'error' in result:
+            print('\n%s: %s' % (module, result['error']))
+        elif result['imports']:
+            heaviest = sorted(result['imports'], key=lambda item: -item[1])[:top]
+            print('\n%s, heaviest imports:' % module)
+            for package, seconds in heaviest:
+                print('    %-30s %.3fs' % (package, seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time of every entry point')
+    parser.add_argument('--baseline', default=None, help='git revision to compare with, e.g. HEAD~1')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS)
+    args = parser.parse_args()
+    report(args.modules, args.baseline, args.repeats)
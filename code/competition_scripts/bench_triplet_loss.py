@@ -0,0 +1,114 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：memory and speed of batch_all_triplet_loss against batch_all_triplet_loss_chunked,
+#                loss and gradient of the embeddings, every run in a fresh process for its peak memory
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import argparse
+import subprocess
+import numpy as np
+
+from config import FLAGS
+
+
+STRATEGIES = ['batch_all', 'batch_all_chunked']
+
+
+def _inputs(batch_size, embed_dim=FLAGS.attribute_label_cnt, seed=0):
+    """ Embeddings and labels of batch_size / 4 classes, as in a pk batch
+    """
+    rng = np.random.RandomState(seed)
+    embeddings = rng.normal(size=(batch_size, embed_dim)).astype(np.float32)
+    labels = rng.randint(0, max(2, batch_size // 4), batch_size).astype(np.int32)
+    return embeddings, labels
+
+
+def run_one(strategy, batch_size, out_dir, repeats=5):
+    """ Loss and gradient of one strategy, printed as json with the mean run time and the peak rss
+    """
+    import tensorflow as tf
+    from triplet_loss import batch_all_triplet_loss, batch_all_triplet_loss_chunked
+
+    embeddings_np, labels_np = _inputs(batch_size)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tf.Graph().as_default():
+        embeddings = tf.constant(embeddings_np)
+        labels = tf.constant(labels_np)
+        if strategy == 'batch_all':
+            loss, fraction = batch_all_triplet_loss(labels, embeddings, FLAGS.margin, FLAGS.squared)
+        else:
+            loss, fraction = batch_all_triplet_loss_chunked(labels, embeddings, FLAGS.margin, FLAGS.squared,
+                                                            FLAGS.triplet_chunk_size)
+        gradient, = tf.gradients(loss, embeddings)
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            loss_value, fraction_value, gradient_value = sess.run([loss, fraction, gradient])
+            start_time = time.time()
+            for _ in range(repeats):
+                sess.run([loss, gradient])
+            run_time = (time.time() - start_time) / repeats
+    np.save(os.path.join(out_dir, '%s_%d.npy' % (strategy, batch_size)), gradient_value)
+    # ru_maxrss is in kilobytes on linux
+    print(json.dumps({'loss': float(loss_value), 'fraction': float(fraction_value), 'time': run_time,
+                      'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                      'graph_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024.0}))
+
+
+def compare(batch_sizes=(64, 256, 1024), repeats=5):
+    """ Run every strategy at every batch size and print the comparison table
+    """
+    out_dir = tempfile.mkdtemp(prefix='bench_triplet_')
+    try:
+        print('%-20s %6s %12s %12s %12s %14s %12s' % ('strategy', 'batch', 'loss', 'step ms', 'peak MB', 'extra peak MB',
+                                                      'grad diff'))
+        for batch_size in batch_sizes:
+            results = {}
+            for strategy in STRATEGIES:
+                process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', strategy,
+                                            '--batch_size', str(batch_size), '--out_dir', out_dir,
+                                            '--repeats', str(repeats)],
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+                stdout, _ = process.communicate()
+                lines = [line for line in stdout.splitlines() if line.startswith('{')]
+                results[strategy] = json.loads(lines[-1]) if process.returncode == 0 and lines else None
+
+            gradients = {}
+            for strategy in STRATEGIES:
+                path = os.path.join(out_dir, '%s_%d.npy' % (strategy, batch_size))
+                if results[strategy] is not None:
+                    gradients[strategy] = np.load(path)
+            for strategy in STRATEGIES:
+                result = results[strategy]
+                if result is None:
+                    print('%-20s %6d %12s' % (strategy, batch_size, 'failed (out of memory?)'))
+                    continue
+                diff = '-'
+                if strategy != STRATEGIES[0] and STRATEGIES[0] in gradients:
+                    diff = '%.2e' % np.max(np.abs(gradients[strategy] - gradients[STRATEGIES[0]]))
+                print('%-20s %6d %12.6f %12.2f %12.1f %14.1f %12s' % (strategy, batch_size, result['loss'],
+                                                                      result['time'] * 1e3, result['peak_mb'],
+                                                                      result['graph_mb'], diff))
+    finally:
+        shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='batch_all against batch_all_chunked triplet loss')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 256, 1024])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--run', choices=STRATEGIES, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--batch_size', type=int, default=64, help=argparse.SUPPRESS)
+    parser.add_argument('--out_dir', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run_one(args.run, args.batch_size, args.out_dir, args.repeats)
+    else:
+        compare(args.batch_sizes, args.repeats)
@@ -0,0 +1,106 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：asynchronous checkpointing, the training thread copies the variables and a background thread
+#                writes them, keeping the last checkpoint_keep checkpoints
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import time
+import threading
+import queue
+import tensorflow as tf
+from tensorflow.python.ops import io_ops
+
+from config import FLAGS
+
+
+class AsyncCheckpointer(object):
+    """
+    Saver whose save only costs one sess.run of the variables in the training thread.
+    The numpy snapshot is written by a background thread with the SaveV2 op of tf.train.Saver, fed through
+    placeholders of a separate graph, so the files are the same as tf.train.Saver ones and restore into the
+    training graph by name, and no second copy of the variables is kept
+    """
+    def __init__(self, save_path, var_list=None, max_to_keep=FLAGS.checkpoint_keep):
+        """Initializer
+            Args:
+            save_path	: Checkpoint prefix, e.g. model_save_dir/resnet_50
+            var_list	: Variables to save, default all global variables
+            max_to_keep	: Older checkpoints are deleted
+        """
+        self.save_path = save_path
+        self.save_dir = os.path.dirname(save_path)
+        self.var_list = var_list if var_list is not None else tf.global_variables()
+        self.max_to_keep = max_to_keep
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in self.var_list]
+            self.prefix = tf.placeholder(tf.string, [])
+            self.save_op = io_ops.save_v2(self.prefix, [var.op.name for var in self.var_list],
+                                          [''] * len(self.var_list), self.placeholders)
+        self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        # checkpoints of a resumed run count for the retention
+        checkpoint = tf.train.get_checkpoint_state(self.save_dir)
+        self.checkpoints = list(checkpoint.all_model_checkpoint_paths) if checkpoint is not None else []
+
+        # one snapshot in the queue and one being written at most
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self, step, values):
+        """ Write one checkpoint, update the checkpoint state file and delete the ones past max_to_keep
+        """
+        path = '%s-%d' % (self.save_path, step)
+        feed_dict = dict(zip(self.placeholders, values))
+        feed_dict[self.prefix] = path
+        self.sess.run(self.save_op, feed_dict=feed_dict)
+
+        if path in self.checkpoints:
+            self.checkpoints.remove(path)
+        self.checkpoints.append(path)
+        while self.max_to_keep and len(self.checkpoints) > self.max_to_keep:
+            for filename in tf.gfile.Glob(self.checkpoints.pop(0) + '.*'):
+                tf.gfile.Remove(filename)
+        tf.train.update_checkpoint_state(self.save_dir, path, self.checkpoints)
+        return path
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            step, values = item
+            try:
+                start_time = time.time()
+                path = self._write(step, values)
+                print('[%s][checkpoint %s written in %.2f seconds]' %
+                      (time.strftime("%Y-%m-%d %H:%M:%S"), path, time.time() - start_time))
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def save(self, sess, step):
+        """ Copy the variables now and write them in the background
+        Args:
+            sess	: Training session
+            step	: Global step, suffix of the checkpoint
+        """
+        self._check()
+        self.queue.put((step, sess.run(self.var_list)))
+
+    def close(self):
+        """ Wait for the pending checkpoints
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.sess.close()
+        self._check()
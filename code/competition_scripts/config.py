@@ -4,6 +4,9 @@
 # Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
 
 
+import os
+
+
 class FLAGS(object):
     # dictory configuration
 
@@ -30,11 +33,21 @@ class FLAGS(object):
     weight_decay = 0.0002
     num_residual_blocks = 25
 
+    # keep only the outputs of the bottleneck units of resnet_v2_50 in train_multi and recompute the activations
+    # inside them in the backward pass, one more forward pass per step. Measured with `python resnet_recompute.py`
+    # on a 6 GB CPU host: batch 64 peaks at 2852 MB against 4496 MB stored, 37.7 s against 33.1 s per step;
+    # batch 128 fits with recompute (4202 MB, 77.7 s) and runs out of memory stored; neither fits batch 256
+    recompute_activations = False
+
     # pattern configuration
     img_type = 'RGB'
     use_gpu = True
 
     # augment configuration
+    # 'fused': crops and flips as views of the stacked batch, one affine warp per image and one normalization
+    # pass (augment_engine.py), 'graph': feed raw uint8 images and augment in the training graph
+    # (graph_augment.py), 'legacy': PIL/skimage chain
+    augment_backend = 'fused'
     if_crop_augment = True
     crop_scale = 0.7
 
@@ -61,6 +74,35 @@ class FLAGS(object):
     img_height = 224
     img_depth = 3
     normalize = True
+    # progressive resolution of train_multi with the 'generator' input pipeline and the 'fused' augment backend:
+    # [(first epoch, img_size, size_before_crop)], e.g. [(0, 128, 146), (60, 160, 183), (140, 224, 256)], the last
+    # stage should be img_size and size_before_crop above; empty to train at img_size from the first epoch. The
+    # sizes are set on the data generator, the FLAGS above are not changed
+    resolution_schedule = []
+
+    # input pipeline configuration
+    # 'generator': DataGenerator batches through feed_dict, 'tf_data': input_pipeline.py,
+    # 'tfrecord': shards written by `python tfrecord_dataset.py`
+    input_pipeline = 'generator'
+    data_parallel_calls = 8         # parallel decode and augment calls of the tf.data pipeline
+    shuffle_buffer = 10000          # tf.data shuffle buffer, 0 reads train.txt in order
+    prefetch_batches = 4
+    num_data_workers = 0    # worker processes filling shared-memory batch slots, 0 builds batches in the train thread
+    data_ring_slots = 0     # batch slots in the shared-memory ring, 0 means 2 * num_data_workers
+
+    # TFRecord shards configuration
+    tfrecord_dir = '../../data/tfrecords'
+    tfrecord_shards = 64
+    tfrecord_image_format = 'jpeg'  # 'jpeg': file bytes as they are, 'raw': decoded uint8 pixels at size_before_crop
+    tfrecord_compression = 'GZIP'   # 'GZIP'/'ZLIB'/''
+    tfrecord_parallel_reads = 16    # shards interleaved at the same time
+
+    # parsed text files are cached here and reparsed when one of them changes
+    catalog_cache_dir = '../../data/catalog_cache'
+
+    # decoded image cache configuration, build it once with `python image_cache.py`
+    use_image_cache = False
+    image_cache_dir = '../../data/image_cache'
 
     # train configuration
     training_epoch = 200
@@ -68,6 +110,59 @@ class FLAGS(object):
     attribute_label_cnt = 30
     num_class = 285
 
+    # 'random': images drawn uniformly, 'pk': batch_size / pk_images_per_class classes x pk_images_per_class images,
+    # so that every batch_hard anchor has a positive, batch_size / data-parallel workers / accumulate_steps must be
+    # a multiple of pk_images_per_class
+    batch_sampler = 'random'
+    pk_images_per_class = 4
+
+    # frozen backbone: `python feature_cache.py` caches the pooled features of feature_cache_views views
+    # (view 0 plain, the others augmented with fixed seeds) and trains the fully_connected head on them on CPU,
+    # True to do it in main.py and to extract, test and export from the head checkpoint (model_weights/head_...)
+    train_head_on_cached_features = False
+    feature_cache_dir = '../../data/feature_cache'
+    feature_cache_views = 5
+    feature_head_epochs = 30
+
+    # summaries are evaluated every summary_every_steps steps (0: never), the other steps only fetch the loss,
+    # event files are written by a background thread
+    summary_every_steps = 50
+
+    # phase timing of the training steps, percentiles over the last profile_window steps printed every
+    # profile_report_every_steps, and a chrome trace of the session run every trace_every_steps (0: none) in logs/.../trace
+    profile_window = 200
+    profile_report_every_steps = 500
+    trace_every_steps = 5000
+
+    # checkpoints are written every checkpoint_every_steps by a background thread, the last checkpoint_keep are kept,
+    # with auto_resume training restarts from the global step of the latest checkpoint in the model dir, without it
+    # a run starts from scratch unless pretrained_model is set
+    checkpoint_every_steps = 1000
+    checkpoint_keep = 5
+    auto_resume = False
+
+    # progressive unfreezing of train_multi: [(first global step, [resnet scopes unfrozen at that step])], the
+    # fully_connected head is always trained and no gradient is computed below the lowest unfrozen scope, e.g.
+    # [(0, ['resnet_v2_50/postnorm', 'resnet_v2_50/block4']), (5000, ['resnet_v2_50/block3']),
+    #  (10000, ['resnet_v2_50/block2']), (15000, ['resnet_v2_50/block1', 'resnet_v2_50/conv1'])],
+    # empty to train every layer from the first step. The scopes of each stage get their own Adam optimizer, whose
+    # moments and bias correction start at the step they are unfrozen
+    unfreeze_schedule = []
+
+    # the batch_size images of an optimizer step are run as accumulate_steps micro-batches of
+    # batch_size / accumulate_steps images whose gradients are summed before the update, the steps of the
+    # learning rate decay count the updates
+    accumulate_steps = 1
+
+    # data-parallel CPU training, `python distributed.py`: dp_num_workers processes per host, each with its own
+    # input pipeline and batch_size / (dp_num_workers * dp_num_nodes) images, gradients averaged every step by the
+    # 'shm' (one host) or 'socket' (several hosts, rank 0 listens on dp_master) all-reduce, rank 0 saves the checkpoints
+    dp_num_workers = 1
+    dp_backend = 'shm'
+    dp_num_nodes = 1
+    dp_master = '127.0.0.1:29500'
+    dp_seed = 0
+
     # learning rate configuration
     dropout_keep_prob = 0.5
     learning_rate = 0.0005
@@ -76,8 +171,22 @@ class FLAGS(object):
     fixed_lr = 0.0001
     square_optimizer = 'Adam'
 
+    # softmax loss configuration
+    # 'full': compatibility softmax over every class, 'sampled': over the true class and softmax_num_sampled
+    # uniformly sampled classes (plus the classes of the batch with softmax_in_batch_negatives), for large
+    # class vocabularies, the validation keeps the full softmax
+    softmax_strategy = 'full'
+    softmax_num_sampled = 64
+    softmax_in_batch_negatives = True
+
     # triplet loss configuration
+    # 'batch_hard', 'batch_all', or 'batch_all_chunked': batch_all over triplet_chunk_size anchors at a time,
+    # same loss with O(batch_size^2) memory instead of O(batch_size^3), see bench_triplet_loss.py
     triplet_strategy = 'batch_hard'
+    triplet_chunk_size = 16
+    # with batch_hard, number of past embeddings (FIFO over the last batches) also searched for the hardest
+    # positive and negative of each anchor, 0 to mine in the batch only
+    triplet_memory_size = 0
     squared = False
     margin = 1.0
     learning_rate_triplet = 0.0001
@@ -90,8 +199,20 @@ class FLAGS(object):
     fc_lr = 0.001
     lambda1 = 1.0
 
-    # subprocess configuration
+    # subprocess configuration: with run_validator, validation_rate of the training images are held out, the split
+    # is kept in model_dir/valid_set.txt, and validator.py evaluates every new checkpoint on them in its own process
+    # with validator_threads threads, polling the model dir every validation_interval seconds. Off by default: every
+    # training image is trained on and no process is started. Nothing is held out with the 'tfrecord' input
+    # pipeline either, whose shards hold every training image
     validation_interval = 20
+    validation_rate = 0.05
+    validation_split_seed = 0
+    run_validator = False
+    validator_threads = 2
+
+    # frozen inference graph of the latest train_multi checkpoint, exported (again) by the inference stages when
+    # missing or older than the checkpoint, `python export_inference_graph.py --benchmark` to compare the startup
+    inference_graph_dir = '../../data/results_multi/inference_graph'
 
     # test configuration
     '''
@@ -116,3 +237,10 @@ class FLAGS(object):
 
     # experiment setting
     experiment_id = '1'
+
+
+def model_path_suffix():
+    """ Name of the train_multi model, log and export dirs
+    """
+    return os.path.join(FLAGS.network_def + '_' + FLAGS.version + '_' + 'train_multi' + '_imagesize_' + str(
+        FLAGS.img_size) + '_batchsize_' + str(FLAGS.batch_size) + '_experiment_' + FLAGS.experiment_id)
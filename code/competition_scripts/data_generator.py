@@ -7,15 +7,225 @@
 import numpy as np
 import cv2
 import os
-import matplotlib.pyplot as plt
+import ctypes
+import multiprocessing
+import queue
 import random
-from skimage import transform
-from PIL import Image, ImageEnhance, ImageFilter
 
 from parse_raw_data import *
+from image_cache import get_image_cache
+from augment_engine import AugmentEngine
 from config import FLAGS
 
 
+class SharedBatchRing(object):
+    """
+    Preallocated batch slots in shared memory, written by worker processes and read by the trainer
+    """
+    def __init__(self, num_slots, batch_size, img_size, attribute_label_cnt, img_dtype=np.float32):
+        """Initializer
+            Args:
+            num_slots			: Number of batches that can be in flight at once
+            batch_size			: Number of images per batch
+            img_size			: Height and width of the images
+            attribute_label_cnt	: Length of the attribute vector
+            img_dtype			: np.float32 for augmented images, np.uint8 for raw images
+        """
+        self.img_dtype = img_dtype
+        self.img_shape = (num_slots, batch_size, img_size, img_size, 3)
+        self.attr_shape = (num_slots, batch_size, attribute_label_cnt)
+        self.num_shape = (num_slots, batch_size)
+
+        img_ctype = ctypes.c_uint8 if img_dtype == np.uint8 else ctypes.c_float
+        self._img_buf = multiprocessing.RawArray(img_ctype, int(np.prod(self.img_shape)))
+        self._attr_buf = multiprocessing.RawArray(ctypes.c_float, int(np.prod(self.attr_shape)))
+        self._num_buf = multiprocessing.RawArray(ctypes.c_int32, int(np.prod(self.num_shape)))
+
+    def views(self):
+        """ Numpy views on the shared buffers, call it again in each process after fork
+        """
+        train_img = np.frombuffer(self._img_buf, dtype=self.img_dtype).reshape(self.img_shape)
+        attribute_labels = np.frombuffer(self._attr_buf, dtype=np.float32).reshape(self.attr_shape)
+        num_labels = np.frombuffer(self._num_buf, dtype=np.int32).reshape(self.num_shape)
+        return train_img, attribute_labels, num_labels
+
+
+class PKSampler(object):
+    """
+    Batches of P classes x K images, for batch_hard triplet mining every anchor then has a positive.
+    Classes, and the images of each class, are drawn without replacement and reshuffled epoch by epoch
+    """
+    def __init__(self, set_index, num_labels, images_per_class=4, rng=None):
+        """Initializer
+            Args:
+            set_index			: Indexes of the images of the set
+            num_labels			: Class index of every image, indexed by set_index
+            images_per_class	: K
+            rng					: np.random.RandomState, default a new one
+        """
+        labels = num_labels[set_index]
+        order = np.argsort(labels, kind='mergesort')
+        sorted_index = set_index[order]
+        _, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+        # a class with a single image can not give its anchor a positive
+        self.class_images = [sorted_index[start:start + count] for start, count in zip(starts, counts) if count >= 2]
+        if not self.class_images:
+            raise ValueError('P x K sampling needs a class with at least 2 images')
+
+        self.images_per_class = images_per_class
+        self.rng = rng if rng is not None else np.random.RandomState()
+        self.epoch = 0
+        self._class_order = np.zeros(0, dtype=np.int64)
+        self._class_cursor = 0
+        self._image_order = [None] * len(self.class_images)
+        self._image_cursor = np.zeros(len(self.class_images), dtype=np.int64)
+
+    def _next_classes(self, num_classes):
+        """ num_classes distinct classes, the next ones of the epoch order
+        """
+        if num_classes > len(self.class_images):
+            raise ValueError('P x K sampling of %d classes per batch, only %d classes have 2 images or more'
+                             % (num_classes, len(self.class_images)))
+        classes = []
+        while len(classes) < num_classes:
+            if self._class_cursor >= len(self._class_order):
+                # a batch across two epochs takes its other classes first, those already in it come last in
+                # the new epoch, so every class is still drawn once per epoch
+                order = self.rng.permutation(len(self.class_images))
+                in_batch = np.in1d(order, classes)
+                self._class_order = np.concatenate([order[~in_batch], order[in_batch]])
+                self._class_cursor = 0
+                self.epoch += 1
+            take = self._class_order[self._class_cursor:self._class_cursor + num_classes - len(classes)]
+            self._class_cursor += len(take)
+            classes.extend(take)
+        return classes
+
+    def _next_images(self, class_id, num_images):
+        images = []
+        while len(images) < num_images:
+            if self._image_order[class_id] is None or self._image_cursor[class_id] >= len(self._image_order[class_id]):
+                self._image_order[class_id] = self.rng.permutation(self.class_images[class_id])
+                self._image_cursor[class_id] = 0
+            cursor = self._image_cursor[class_id]
+            take = self._image_order[class_id][cursor:cursor + num_images - len(images)]
+            self._image_cursor[class_id] += len(take)
+            images.extend(take)
+        return images
+
+    def sample(self, batch_size):
+        """ Indexes of one batch, grouped by class, batch_size must be a multiple of K
+        """
+        if batch_size % self.images_per_class != 0:
+            raise ValueError('P x K sampling needs a batch size multiple of K = %d, got %d'
+                             % (self.images_per_class, batch_size))
+        num_classes = batch_size // self.images_per_class
+        index = []
+        for class_id in self._next_classes(num_classes):
+            index.extend(self._next_images(class_id, self.images_per_class))
+        return np.array(index[:batch_size], dtype=np.int64)
+
+
+def valid_anchor_fraction(num_labels):
+    """ Fraction of the batch with a positive and a negative in the batch, the anchors batch_hard learns from
+    """
+    _, inverse, counts = np.unique(num_labels, return_inverse=True, return_counts=True)
+    if len(counts) < 2:
+        return 0.0
+    return float(np.mean(counts[inverse] > 1))
+
+
+class BatchPool(object):
+    """
+    Worker processes filling preallocated batch slots of a shared-memory ring buffer, only slot indices
+    and batch indexes travel through the queues. The workers are forked when the pool is created, so create it
+    before the tensorflow graph and session: forking a process whose tensorflow threads are running can
+    deadlock the children. Iterate it like the generator, the yielded arrays are views into the ring and stay
+    valid until the next call of next()
+    Every task carries the resolution of the parent dataset at the time it is queued, so the image size can
+    change during training (see ResolutionSchedule) without forking the workers again: the ring is allocated
+    at max_img_size and the batches of an older resolution are refilled instead of yielded
+    """
+    def __init__(self, dataset, batch_size, normalize, sample_set, num_workers, num_slots=0, sampler='random',
+                 max_img_size=0):
+        """Initializer
+            Args:
+            dataset		: DataGenerator filling the batches, its _pool_worker runs in the workers
+            See Args section in DataGenerator.generator for the others
+        """
+        if num_slots <= 0:
+            num_slots = 2 * num_workers
+        num_slots = max(num_slots, num_workers + 1)
+
+        ctx = multiprocessing.get_context('fork')
+        img_size, img_dtype = dataset._batch_image_spec()
+        ring = SharedBatchRing(num_slots, batch_size, max(img_size, max_img_size), FLAGS.attribute_label_cnt,
+                               img_dtype)
+        self.free_queue = ctx.Queue()
+        self.ready_queue = ctx.Queue()
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sample_set = sample_set
+        self.batch_sampler = dataset._make_sampler(sample_set, sampler)
+        self.slot_resolution = [None] * num_slots
+        for slot in range(num_slots):
+            self._queue_slot(slot)
+
+        self.workers = []
+        for worker_id in range(num_workers):
+            seed = np.random.randint(0, 2 ** 31 - 1) + worker_id
+            worker = ctx.Process(target=dataset._pool_worker,
+                                 args=(ring, self.free_queue, self.ready_queue, normalize, seed))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        print('START %d DATA WORKERS, %d BATCH SLOTS' % (num_workers, num_slots))
+
+        self.train_img, self.attribute_labels, self.num_labels = ring.views()
+        self._slot = None
+
+    def _queue_slot(self, slot):
+        resolution = self.dataset.resolution
+        self.slot_resolution[slot] = resolution
+        self.free_queue.put((slot, self.dataset._batch_index(self.batch_size, self.sample_set, self.batch_sampler),
+                             resolution))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # the consumer is done with the previous slot once it asks for the next batch
+        if self._slot is not None:
+            self._queue_slot(self._slot)
+            self._slot = None
+        while True:
+            try:
+                slot = self.ready_queue.get(timeout=10)
+            except queue.Empty:
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        raise RuntimeError('Data worker %d died with exit code %s' % (worker.pid, worker.exitcode))
+                continue
+            if self.slot_resolution[slot] == self.dataset.resolution:
+                break
+            # queued before the last resolution change
+            self._queue_slot(slot)
+        self._slot = slot
+        img_size = self.dataset._batch_image_spec()[0]
+        return self.train_img[slot, :, :img_size, :img_size], self.attribute_labels[slot], self.num_labels[slot]
+
+    def close(self):
+        """ Stop the workers
+        """
+        for _ in self.workers:
+            self.free_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+
 class DataGenerator():
     """
     To process images and labels
@@ -31,81 +241,81 @@ class DataGenerator():
         self.attrs_per_class_dir = attrs_per_class_dir
         self.img_dir = img_dir
         self.train_file = train_file
+        self.image_cache = get_image_cache('train') if train_file == FLAGS.train_file else None
+        # (img_size, size_before_crop) of the batches, changed by set_resolution without touching FLAGS
+        self.resolution = (FLAGS.img_size, FLAGS.size_before_crop)
+        self.augment_engine = AugmentEngine(out_size=self.resolution[0], size_before_crop=self.resolution[1])
 
     # --------------------Generator Initialization Methods ---------------------
 
     def _read_train_data(self):
         """
         To read labels in csv
+        Labels are kept as arrays: image names and their class index are aligned,
+        the attribute vector of an image is the row of its class in self.class_attributes
         """
-        self.train_table = []     # The names of images being trained
-        self.train_image2represent_label_map = {}
-        self.represent_label2attribute_vec_map = {}
-        self.data_dict = {}       # The labels of images
-        
-        with open(self.train_file, 'r') as f:
-            for line in f.readlines():
-                image_name = line.split('	')[0]
-                self.train_table.append(image_name)
-        # label_file = pd.read_csv(self.train_file)
+        catalog = load_catalog(attrs_per_class_dir=self.attrs_per_class_dir, train_file=self.train_file)
         print('READING LABELS OF TRAIN DATA')
-        print('Total num:', len(self.train_table))
-
-        # obtain image name and class label in train.txt
-        self.train_image2represent_label_map = \
-        parse_train_image2represent_label_map(self.train_file)
-
-        # print(self.train_image2represent_label_map)
-
-        # obtain class label and attribute label in attrs_per_class.txt
-        self.represent_label2attribute_vec_map = \
-        parse_attribute_per_class(self.attrs_per_class_dir)
-
-        self.repre_label2num_label_map = \
-            parse_repre_label2num_label_map(self.attrs_per_class_dir)
+        print('Total num:', len(catalog.train_images))
 
-        _, _, self.repre_label2onehot_label_map = parse_repre_label2one_hot_map(self.attrs_per_class_dir)
+        self.repre_label2num_label_map = catalog.class2num_label
+        # (num_class, attribute_label_cnt) class attribute matrix, rows ordered by num_label
+        self.class_attributes = catalog.class_attributes[:, 0:FLAGS.attribute_label_cnt]
+        self.image_names = catalog.train_images
+        self.num_labels = catalog.train_num_labels
+        self.train_table = list(self.image_names)     # The names of images being trained
 
-        # print(len(self.train_table))
-        for i in range(len(self.train_table)):
-            image_name = self.train_table[i]
-            class_label = self.train_image2represent_label_map[image_name]
-            attribute_label = np.array(self.represent_label2attribute_vec_map[class_label])
-            num_label = self.repre_label2num_label_map[class_label]
-            onehot_label = self.repre_label2onehot_label_map[class_label]
-            self.data_dict[image_name] = {'attribute_label': attribute_label, 'num_label': num_label, 'onehot_label': onehot_label}
-        
         print('LABEL READING FINISHED')
-        # print(self.data_dict[image_name]['attribute_label'])
-        return self.train_table, self.data_dict
+        return self.image_names, self.num_labels
 
-    def _randomize(self):
+    def _randomize(self, rng=None):
         """ Randomize the set
         """
-        random.shuffle(self.train_table)
+        (rng if rng is not None else np.random).shuffle(self.order)
 
-    def generate_set(self, rand=True, validationRate=0.1):
+    def generate_set(self, rand=True, validationRate=0.1, valid_set_file=None):
         """ Generate the training and validation set
         Args:
-            rand : (bool) True to shuffle the set
+            rand 			: (bool) True to shuffle the set
+            validationRate	: Percentage of validation data
+            valid_set_file	: Names of the validation images, read when it exists so that a resumed run and the
+                              validator keep the same split, else written after a split seeded with validation_split_seed
         """
         self._read_train_data()
+        self.order = np.arange(len(self.image_names), dtype=np.int32)
+        if valid_set_file is not None and os.path.exists(valid_set_file):
+            with open(valid_set_file, 'r') as f:
+                valid_names = set(line.strip() for line in f if line.strip())
+            if rand:
+                self._randomize()
+            is_valid = np.array([name in valid_names for name in self.image_names[self.order]], dtype=bool)
+            self.order = np.concatenate([self.order[~is_valid], self.order[is_valid]])
+            self._create_sets(valid_sample=int(is_valid.sum()))
+            return
         if rand:
-            self._randomize()
+            # every data-parallel worker draws the same split
+            self._randomize(np.random.RandomState(FLAGS.validation_split_seed) if valid_set_file is not None else None)
         self._create_sets(validation_rate=validationRate)
+        if valid_set_file is not None:
+            with open(valid_set_file + '.tmp%d' % os.getpid(), 'w') as f:
+                for name in self.valid_set:
+                    f.write(name + '\n')
+            os.rename(valid_set_file + '.tmp%d' % os.getpid(), valid_set_file)
 
-    def _create_sets(self, validation_rate=0.1):
+    def _create_sets(self, validation_rate=0.1, valid_sample=None):
         """ Select Elements to feed training and validation set
         Args:
             validation_rate		: Percentage of validation data (in ]0,1[, don't waste time use 0.1)
+            valid_sample		: Number of validation images at the end of self.order, instead of validation_rate
         """
-        self.train_dict = {}
-        self.valid_dict = {}
-        sample = len(self.train_table)
-        valid_sample = int(sample * validation_rate)
-        self.train_set = self.train_table[:sample - valid_sample]
-        self.valid_set = self.train_table[sample - valid_sample:]
-        # preset = self.train_table[sample - valid_sample:]
+        sample = len(self.order)
+        if valid_sample is None:
+            valid_sample = int(sample * validation_rate)
+        # indexes into self.image_names / self.num_labels
+        self.train_index = self.order[:sample - valid_sample]
+        self.valid_index = self.order[sample - valid_sample:]
+        self.train_set = self.image_names[self.train_index]
+        self.valid_set = self.image_names[self.valid_index]
         print('START SET CREATION')
 
         print('SET CREATED')
@@ -114,12 +324,6 @@ class DataGenerator():
         print('--Training set :', len(self.train_set), ' samples.')
         print('--Validation set :', len(self.valid_set), ' samples.')
 
-        for item in range(len(self.train_set)):
-            self.train_dict[self.train_set[item]] = self.data_dict[self.train_set[item]]
-
-        for item in range(len(self.valid_set)):
-            self.valid_dict[self.valid_set[item]] = self.data_dict[self.valid_set[item]]
-
     def _give_batch_name(self, batch_size=16, set='train'):
         """ Returns a List of Samples
         Args:
@@ -139,6 +343,7 @@ class DataGenerator():
 
     # ---------------------------- Augmentation Methods --------------------------
     def _rotate_augment(self, img, max_rotation=FLAGS.max_rotation):
+        from skimage import transform
         if random.choice([0, 1]):
             r_angle = np.random.randint(-1 * max_rotation, max_rotation)
             img = transform.rotate(img, r_angle, preserve_range=True)
@@ -179,6 +384,7 @@ class DataGenerator():
         return aug_img
 
     def _color_augment(self, img):
+        from PIL import Image, ImageEnhance, ImageFilter
         if random.choice([0, 1]):
             image = Image.fromarray(img)
             # image.show()
@@ -218,6 +424,7 @@ class DataGenerator():
         return img
 
     def _crop_augment(self, img, img_name, crop_scale=0.7):
+        from PIL import Image
         if random.choice([0, 1]):
             image = Image.fromarray(img, 'RGB')
             loc_x = np.random.randint(0, FLAGS.size_before_crop - int(FLAGS.size_before_crop * crop_scale))
@@ -231,6 +438,7 @@ class DataGenerator():
         return img
 
     def _flip_augment(self, img):
+        from PIL import Image
 
         image = Image.fromarray(img, 'RGB')
 
@@ -244,79 +452,174 @@ class DataGenerator():
         return img
 
         # ----------------------- Batch Random Generator ----------------------------------
-    def _aux_generator(self, batch_size=16, normalize=True, sample_set='train'):
+    def _make_sampler(self, sample_set='train', sampler='random'):
+        """ PKSampler of the set for sampler 'pk', None to draw images uniformly with replacement
+        """
+        if sampler == 'pk':
+            set_index = self.train_index if sample_set == 'train' else self.valid_index
+            return PKSampler(set_index, self.num_labels, FLAGS.pk_images_per_class)
+        elif sampler != 'random':
+            raise ValueError('Batch sampler not recognized: {}'.format(sampler))
+        return None
+
+    def _batch_index(self, batch_size, sample_set='train', sampler=None):
+        """ Indexes into self.image_names of the next batch
+        """
+        if sampler is not None:
+            return sampler.sample(batch_size)
+        set_index = self.train_index if sample_set == 'train' else self.valid_index
+        return set_index[np.random.randint(0, len(set_index), batch_size)]
+
+    def _fill_batch(self, train_img, attribute_labels, num_labels, normalize, index):
+        """ Fill one batch in place
+        Args:
+            train_img			: (batch, size, size, 3) array to write images into, see self._batch_image_spec
+            attribute_labels	: (batch, attribute_label_cnt) float32 array
+            num_labels			: (batch,) int32 array, the onehot labels are built from it in the graph
+            normalize			: (bool) True to divide images by 255
+            index				: (batch,) indexes into self.image_names, see self._batch_index
+        """
+        batch_size = train_img.shape[0]
+        names = self.image_names[index]
+        num_labels[:] = self.num_labels[index]
+        attribute_labels[:] = self.class_attributes[num_labels]
+
+        if FLAGS.augment_backend == 'graph':
+            # raw uint8 images, the augmentation and normalization run in the graph
+            train_img[:] = self.open_batch(names, train_img.shape[1], FLAGS.img_type)
+            if FLAGS.if_color_augment:
+                for i in range(batch_size):
+                    train_img[i] = self._color_augment(train_img[i])
+            return
+
+        if FLAGS.augment_backend == 'fused':
+            # crops and flips as views of the stacked sources, size and rotate aug in one warp per image
+            src = self.open_batch(names, self.augment_engine.source_size(), FLAGS.img_type)
+            self.augment_engine.augment_batch(src, out=train_img, normalize=normalize,
+                                              color_fn=self._color_augment if FLAGS.if_color_augment else None)
+            return
+
+        i = 0
+        while i < batch_size:
+            name = names[i]
+
+            # print(name)
+
+            # 读图片 & crop aug
+            if FLAGS.if_crop_augment:
+                img = self.open_img(name, FLAGS.size_before_crop, FLAGS.img_type)
+                img = self._crop_augment(img, name, FLAGS.crop_scale)
+            else:
+                img = self.open_img(name, FLAGS.img_size, FLAGS.img_type)
+
+            # flip aug
+            if FLAGS.if_flip_augment:
+                img = self._flip_augment(img)
+
+            # color aug
+            if FLAGS.if_color_augment:
+                img = self._color_augment(img)
+
+            # augment size
+            if FLAGS.if_size_augment:
+                img = self._size_augment(img)
+
+            # rotate augmentation
+            if FLAGS.if_rotate_augment:
+                img = self._rotate_augment(img)
+
+            train_img[i] = img
+
+            # cv2.imshow('train image', train_img[i])  # cv only display BGR mode image, but now opened as type RGB
+            # cv2.waitKey(1000)
+
+            i = i + 1
+
+        if normalize:
+            train_img /= 255.0
+
+    def set_resolution(self, resolution):
+        """ Build the next batches at another size, with the fused augment backend
+        Args:
+            resolution	: (img_size, size_before_crop)
+        """
+        self.resolution = tuple(resolution)
+        self.augment_engine.set_resolution(self.resolution)
+
+    def _batch_image_spec(self):
+        """ Size and dtype of the batch images
+        With the 'graph' backend the batch holds raw uint8 images at size_before_crop
+        """
+        if FLAGS.augment_backend == 'graph':
+            return self.augment_engine.source_size(), np.uint8
+        return self.resolution[0], np.float32
+
+    def _aux_generator(self, batch_size=16, normalize=True, sample_set='train', sampler='random'):
         """ Auxiliary Generator
         Args:
             See Args section in self._generator
         """
+        batch_sampler = self._make_sampler(sample_set, sampler)
         while True:
-            train_img = np.zeros((batch_size, FLAGS.img_size, FLAGS.img_size, 3), dtype=np.float32)
-            attribute_labels = np.zeros((batch_size, 30), dtype=np.float32)
+            # read every batch, the resolution can change between two batches
+            img_size, img_dtype = self._batch_image_spec()
+            train_img = np.zeros((batch_size, img_size, img_size, 3), dtype=img_dtype)
+            attribute_labels = np.zeros((batch_size, FLAGS.attribute_label_cnt), dtype=np.float32)
             num_labels = np.zeros((batch_size), dtype=np.int32)
-            onehot_labels = np.zeros((batch_size, FLAGS.num_class), dtype=np.int32)
-
-            i = 0
-            while i < batch_size:
-                if sample_set == 'train':
-                    name = random.choice(self.train_set)
-                    # name = '06011f469d5e1891784592bf870c4ae6.jpeg'
-                else:
-                    name = random.choice(self.valid_set)
-
-                # print(name)
-
-                # 读图片 & crop aug
-                if FLAGS.if_crop_augment:
-                    img = self.open_img(name, FLAGS.size_before_crop, FLAGS.img_type)
-                    img = self._crop_augment(img, name, FLAGS.crop_scale)
-                else:
-                    img = self.open_img(name, FLAGS.img_size, FLAGS.img_type)
-
-                # flip aug
-                if FLAGS.if_flip_augment:
-                    img = self._flip_augment(img)
-
-                # color aug
-                if FLAGS.if_color_augment:
-                    img = self._color_augment(img)
-
-                # augment size
-                if FLAGS.if_size_augment:
-                    img = self._size_augment(img)
-
-                # rotate augmentation
-                if FLAGS.if_rotate_augment:
-                    img = self._rotate_augment(img)
-
-                attribute_labels[i] = self.data_dict[name]['attribute_label']
-                num_labels[i] = self.data_dict[name]['num_label']
-                onehot_labels[i] = self.data_dict[name]['onehot_label']
-
-                # print('repre_labels', self.train_image2represent_label_map[name])
-                # print('attribute_labels', attribute_labels[i])
-                # print('num_labels', num_labels[i])
-                # print('onehot_labels', onehot_labels[i])
-
-                if normalize:
-                    train_img[i] = img.astype(np.float32) / 255.0
-                else:
-                    train_img[i] = img.astype(np.float32)
-
-                # cv2.imshow('train image', train_img[i])  # cv only display BGR mode image, but now opened as type RGB
-                # cv2.waitKey(1000)
-
-                i = i + 1
-            yield train_img, attribute_labels, num_labels, onehot_labels
-
-    def generator(self, batchSize=16, norm=True, sample='train'):
+
+            index = self._batch_index(batch_size, sample_set, batch_sampler)
+            self._fill_batch(train_img, attribute_labels, num_labels, normalize, index)
+            yield train_img, attribute_labels, num_labels
+
+    def _pool_worker(self, ring, free_queue, ready_queue, normalize, seed):
+        """ Worker process body: fill free ring slots until a None slot is received,
+        the batch indexes and the resolution come with the slot so sampling stays in the parent process
+        """
+        # every forked worker starts with the parent's random state
+        random.seed(seed)
+        np.random.seed(seed % (2 ** 32))
+        # one OpenCV thread per worker, the pool itself provides the parallelism
+        cv2.setNumThreads(1)
+
+        train_img, attribute_labels, num_labels = ring.views()
+        while True:
+            task = free_queue.get()
+            if task is None:
+                break
+            slot, index, resolution = task
+            if resolution != self.resolution:
+                self.set_resolution(resolution)
+            img_size = self._batch_image_spec()[0]
+            self._fill_batch(train_img[slot, :, :img_size, :img_size], attribute_labels[slot], num_labels[slot],
+                             normalize, index)
+            ready_queue.put(slot)
+
+    def _pool_generator(self, batch_size=16, normalize=True, sample_set='train', num_workers=4, num_slots=0,
+                        sampler='random', max_img_size=0):
+        """ Multi-process Generator, see BatchPool
+        Args:
+            See Args section in self.generator
+        """
+        return BatchPool(self, batch_size, normalize, sample_set, num_workers, num_slots, sampler, max_img_size)
+
+    def generator(self, batchSize=16, norm=True, sample='train', num_workers=0, num_slots=0, sampler='random',
+                  max_img_size=0):
         """ Create a Sample Generator
         Args:
             batchSize 	: Number of image per batch
             stacks 	 	: Stacks in HG model
             norm 	 	 	: (bool) True to normalize the batch
             sample 	 	: 'train'/'valid' Default: 'train'
+            num_workers	: Number of worker processes, forked at once, 0 to build batches in the calling thread
+            num_slots	: Number of shared-memory batch slots, 0 for 2 * num_workers
+            sampler		: 'random' draws images uniformly, 'pk' draws P classes x K images, see PKSampler
+            max_img_size	: Largest img_size set during training, the size of the worker ring, 0 for img_size
         """
-        return self._aux_generator(batch_size=batchSize, normalize=norm, sample_set=sample)
+        if num_workers > 0:
+            return self._pool_generator(batch_size=batchSize, normalize=norm, sample_set=sample,
+                                        num_workers=num_workers, num_slots=num_slots, sampler=sampler,
+                                        max_img_size=max_img_size)
+        return self._aux_generator(batch_size=batchSize, normalize=norm, sample_set=sample, sampler=sampler)
 
     # ---------------------------- Image Reader --------------------------------
     def open_img(self, name, size, color='RGB'):
@@ -325,6 +628,9 @@ class DataGenerator():
             name	: Name of the sample
             color	: Color Mode (RGB/BGR/GRAY)
         """
+        if self.image_cache is not None and self.image_cache.has(name, size):
+            return _cached_img(self.image_cache, name, size, color)
+
         img = cv2.imread(os.path.join(self.img_dir, name))
         # arr = np.asarray(img,dtype="float32")
         img = cv2.resize(img, (size, size))
@@ -348,12 +654,23 @@ class DataGenerator():
         else:
             print('Color mode supported: RGB/BGR. If you need another mode do it yourself :p')
 
+    def open_batch(self, names, size, color='RGB'):
+        """ Open images into one stacked (len(names), size, size, 3) array
+        Args:
+            names	: Names of the samples
+            color	: Color Mode (RGB/BGR)
+        """
+        if color == 'RGB' and self.image_cache is not None and self.image_cache.has(names[0], size):
+            return self.image_cache.get_batch(names, size)
+        return np.stack([self.open_img(name, size, color) for name in names])
+
     def plot_img(self, name, plot='cv2'):
         """ Plot an image
         Args:
             name	: Name of the Sample
             plot	: Library to use (cv2: OpenCV, plt: matplotlib)
         """
+        import matplotlib.pyplot as plt
         if plot == 'cv2':
             img = self.open_img(name, color='BGR')
             cv2.imshow('Image', img)
@@ -367,9 +684,18 @@ class DataGenerator():
 
 
 # ####################################### aug test image api #########################################################
+_test_augment_engine = AugmentEngine()
+
+
 def aug_test_image(is_train, name, aug_num=FLAGS.aug_num):
-    aug_image = np.zeros((aug_num, FLAGS.img_size, FLAGS.img_size, FLAGS.img_depth), dtype=np.float32)
+    if FLAGS.augment_backend == 'fused':
+        # the source is opened once, the aug_num views are broadcast views of it
+        src = open_img(is_train, name, _test_augment_engine.source_size(), FLAGS.img_type)
+        src = np.broadcast_to(src, (aug_num,) + src.shape)
+        return _test_augment_engine.augment_batch(src, normalize=FLAGS.normalize,
+                                                  color_fn=color_augmentation if FLAGS.if_color_augment else None)
 
+    aug_image = np.zeros((aug_num, FLAGS.img_size, FLAGS.img_size, FLAGS.img_depth), dtype=np.float32)
     for i in range(aug_num):
         # 读图片 & crop aug
         if FLAGS.if_crop_augment:
@@ -394,14 +720,13 @@ def aug_test_image(is_train, name, aug_num=FLAGS.aug_num):
         if FLAGS.if_rotate_augment:
             img = rotate_augmentation(img)
 
-        if FLAGS.normalize:
-            aug_image[i] = img.astype(np.float32) / 255.0
-        else:
-            aug_image[i] = img.astype(np.float32)
+        aug_image[i] = img
 
         # cv2.imshow('train image', aug_image[i])  # cv only display BGR mode image, but now opened as type RGB
         # cv2.waitKey(1000)
 
+    if FLAGS.normalize:
+        aug_image /= 255.0
     return aug_image
 
 
@@ -417,6 +742,10 @@ def open_img(is_train, name, size, color='RGB'):
     else:
         img_dir = FLAGS.test_img_dir
 
+    image_cache = get_image_cache('train' if is_train else 'test')
+    if image_cache is not None and image_cache.has(name, size):
+        return _cached_img(image_cache, name, size, color)
+
     img = cv2.imread(os.path.join(img_dir, name))
     img = cv2.resize(img, (size, size))
 
@@ -439,8 +768,23 @@ def open_img(is_train, name, size, color='RGB'):
         print('Color mode supported: RGB/BGR. If you need another mode do it yourself :p')
 
 
+def _cached_img(image_cache, name, size, color='RGB'):
+    """ Read an image from the decoded image cache, the cache stores RGB
+    """
+    img = image_cache.get(name, size)
+    if color == 'RGB':
+        return img
+    elif color == 'BGR':
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    elif color == 'GRAY':
+        return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    else:
+        print('Color mode supported: RGB/BGR. If you need another mode do it yourself :p')
+
+
 # ---------------------------- Augmentation Methods --------------------------
 def rotate_augmentation(img, max_rotation=FLAGS.max_rotation):
+    from skimage import transform
     if random.choice([0, 1]):
         r_angle = np.random.randint(-1 * max_rotation, max_rotation)
         img = transform.rotate(img, r_angle, preserve_range=True)
@@ -483,6 +827,7 @@ def size_augmentation(img, min_compress_ratio=FLAGS.min_compress_ratio, max_comp
 
 
 def color_augmentation(img):
+    from PIL import Image, ImageEnhance, ImageFilter
     if random.choice([0, 1]):
         image = Image.fromarray(img)
         # image.show()
@@ -523,6 +868,7 @@ def color_augmentation(img):
 
 
 def crop_augmentation(is_train, img, img_name, crop_scale=0.7):
+    from PIL import Image
     if random.choice([0, 1]) == 1:
         image = Image.fromarray(img, 'RGB')
         loc_x = np.random.randint(0, FLAGS.size_before_crop - int(FLAGS.size_before_crop * crop_scale))
@@ -537,6 +883,7 @@ def crop_augmentation(is_train, img, img_name, crop_scale=0.7):
 
 
 def flip_augmentation(img):
+    from PIL import Image
 
     image = Image.fromarray(img, 'RGB')
 
@@ -551,6 +898,11 @@ def flip_augmentation(img):
 
 
 def aug_input_image(image_val):
+    from PIL import Image
+    if FLAGS.augment_backend == 'fused':
+        return AugmentEngine().augment_batch(image_val[:FLAGS.batch_size], normalize=FLAGS.normalize,
+                                             color_fn=color_augmentation if FLAGS.if_color_augment else None)
+
     aug_image = np.zeros((FLAGS.batch_size, FLAGS.img_size, FLAGS.img_size, FLAGS.img_depth), dtype=np.float32)
 
     for i in range(FLAGS.batch_size):
@@ -582,14 +934,13 @@ def aug_input_image(image_val):
         if FLAGS.if_rotate_augment:
             img = rotate_augmentation(img)
 
-        if FLAGS.normalize:
-            aug_image[i] = img.astype(np.float32) / 255.0
-        else:
-            aug_image[i] = img.astype(np.float32)
+        aug_image[i] = img
 
         # cv2.imshow('train image', aug_image[i])  # cv only display BGR mode image, but now opened as type RGB
         # cv2.waitKey(1000)
 
+    if FLAGS.normalize:
+        aug_image /= 255.0
     return aug_image
 
 
@@ -599,4 +950,4 @@ if __name__ == '__main__':
     
     generator = dataset.generator(batchSize=FLAGS.batch_size, norm=True, sample='train')
     while True:
-        train_img, attribute_labels, num_labels, onehot_labels = next(generator)
\ No newline at end of file
+        train_img, attribute_labels, num_labels = next(generator)
\ No newline at end of file
@@ -4,19 +4,20 @@
 #  				 to determine the ground truth label of latent attributes in useen dataset
 # Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
 
-import tensorflow as tf
 import os
 import time
 import numpy as np
 
 from config import FLAGS
 
-from parse_raw_data import *
-from data_generator import *
-from seen2unseen_attr_regression_model import *
+from parse_raw_data import load_catalog
 
 
 def determine_gt_attr_with_latent():
+	# tensorflow is only needed once the regression graph is built
+	import tensorflow as tf
+	from seen2unseen_attr_regression_model import regression_model
+
 	'''
 		Step 1: Create dirs for saving models and logs
 	'''
@@ -47,35 +48,16 @@ def determine_gt_attr_with_latent():
 	'''
 		Step 2: Create dataset and data generator
 	'''
-	total_class_set_list, _, _ = parse_repre_label2one_hot_map(
-		FLAGS.attrs_per_class_dir)
+	catalog = load_catalog()
+	total_class_set_list = catalog.class_list
 	print('Total class set', total_class_set_list, len(total_class_set_list))
-
-	train_table = []
-	train_class_table = []
-	with open(FLAGS.train_file, 'r') as f:
-		for line in f.readlines():
-			image_name = line.split('	')[0]
-			class_repre = line.split('	')[1].replace('\n', '')
-			train_table.append(image_name)
-			if class_repre not in train_class_table:
-				train_class_table.append(class_repre)
-	# label_file = pd.read_csv(self.train_file)
 	print('READING LABELS OF TRAIN DATA')
-	print('Total num:', len(train_table))
+	print('Total num:', len(catalog.train_images))
 
-	train_class_set_list = [item for item in total_class_set_list if item in train_class_table]
+	train_class_set_list = catalog.seen_classes()
 	print('Train class set', train_class_set_list, len(train_class_set_list))
 
-	# obtain image name and class label in train.txt
-	train_image2represent_label_map = \
-		parse_train_image2represent_label_map(FLAGS.train_file)
-
-	# obtain class label and attribute label in attrs_per_class.txt
-	represent_label2attribute_vec_map = \
-		parse_attribute_per_class(FLAGS.attrs_per_class_dir)
-
-	useen_class_set_list = [item for item in total_class_set_list if item not in train_class_table]
+	useen_class_set_list = catalog.unseen_classes()
 	print('useen_class_set_list', useen_class_set_list, len(useen_class_set_list))
 
 	'''
@@ -94,9 +76,8 @@ def determine_gt_attr_with_latent():
 	gt_la_attr_train = np.zeros((len(train_class_set_list), FLAGS.attribute_label_cnt), dtype=np.float32)
 	for i in range(len(train_class_set_list)):
 		temp_la_list = []
-		for image_name in train_table:
-			if train_image2represent_label_map[image_name] == train_class_set_list[i]:
-				temp_la_list.append(train_la_dict[image_name][FLAGS.attribute_label_cnt:2 * FLAGS.attribute_label_cnt])
+		for image_name in catalog.images_of_class(catalog.seen_class_index[i]):
+			temp_la_list.append(train_la_dict[image_name][FLAGS.attribute_label_cnt:2 * FLAGS.attribute_label_cnt])
 		temp_la_np = np.array(temp_la_list)
 		# print('temp_la_np', temp_la_np, temp_la_np.shape)
 		gt_la_attr_train[i, :] = np.mean(temp_la_np, axis=0)
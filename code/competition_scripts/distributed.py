@@ -0,0 +1,294 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：data-parallel CPU training, one train_multi process per worker with its own input pipeline,
+#                gradients averaged every step with a shared-memory (one host) or socket (several hosts) all-reduce
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import time
+import random
+import socket
+import struct
+import argparse
+import multiprocessing
+import numpy as np
+
+from config import FLAGS
+
+
+def _flatten(arrays):
+    return np.concatenate([np.asarray(array, dtype=np.float32).ravel() for array in arrays])
+
+
+def _unflatten(flat, shapes):
+    arrays = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(flat[offset:offset + size].reshape(shape))
+        offset += size
+    return arrays
+
+
+class SharedMemoryAllReduce(object):
+    """
+    All-reduce of the local worker processes through a /dev/shm buffer of (world_size + 1) rows,
+    row r holds the gradients of rank r and the last row their mean. Every rank averages one column chunk,
+    so the reduction is spread over the workers. Create it before forking the workers, then call set_rank in each.
+    """
+    def __init__(self, world_size, shm_dir='/dev/shm'):
+        """Initializer
+            Args:
+            world_size	: Number of worker processes
+            shm_dir		: Directory of the shared buffer, a tmpfs
+        """
+        self.world_size = world_size
+        self.rank = 0
+        self.path = os.path.join(shm_dir, 'ldf_allreduce_%d' % os.getpid())
+        self.barrier = multiprocessing.Barrier(world_size)
+        self.buffer = None
+
+    def set_rank(self, rank):
+        self.rank = rank
+
+    def _open(self, num_elements):
+        """ Rank 0 creates the buffer at the first call, when the gradient size is known
+        """
+        if self.buffer is not None and self.buffer.shape[1] == num_elements:
+            return
+        # no rank still reads the previous buffer when rank 0 resizes it
+        self.barrier.wait()
+        if self.rank == 0:
+            self.buffer = np.memmap(self.path, dtype=np.float32, mode='w+', shape=(self.world_size + 1, num_elements))
+        self.barrier.wait()
+        if self.rank != 0:
+            self.buffer = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(self.world_size + 1, num_elements))
+
+    def allreduce(self, arrays):
+        """ Mean of arrays over the ranks
+        Args:
+            arrays	: list of numpy arrays, same shapes on every rank
+        Returns:
+            list of float32 arrays
+        """
+        flat = _flatten(arrays)
+        self._open(flat.size)
+        self.buffer[self.rank] = flat
+        self.barrier.wait()
+
+        # reduce-scatter: rank r averages chunk r into the last row
+        chunk = (flat.size + self.world_size - 1) // self.world_size
+        begin = min(self.rank * chunk, flat.size)
+        end = min(begin + chunk, flat.size)
+        if end > begin:
+            self.buffer[self.world_size, begin:end] = \
+                self.buffer[0:self.world_size, begin:end].sum(axis=0) / self.world_size
+        self.barrier.wait()
+
+        # every rank has read the mean before the next step writes it again, see the first barrier
+        return _unflatten(np.array(self.buffer[self.world_size]), [np.shape(array) for array in arrays])
+
+    def broadcast(self, arrays):
+        """ arrays of rank 0 on every rank
+        """
+        flat = _flatten(arrays)
+        self._open(flat.size)
+        self.barrier.wait()
+        if self.rank == 0:
+            self.buffer[self.world_size] = flat
+        self.barrier.wait()
+        result = np.array(self.buffer[self.world_size])
+        self.barrier.wait()
+        return _unflatten(result, [np.shape(array) for array in arrays])
+
+    def close(self):
+        self.barrier.wait()
+        self.buffer = None
+        if self.rank == 0 and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _send_array(conn, flat):
+    data = flat.tobytes()
+    conn.sendall(struct.pack('!Q', len(data)) + data)
+
+
+def _recv_exact(conn, size):
+    chunks = []
+    while size > 0:
+        chunk = conn.recv(min(size, 4 * 1024 * 1024))
+        if not chunk:
+            raise IOError('all-reduce peer closed the connection')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_array(conn):
+    size = struct.unpack('!Q', _recv_exact(conn, 8))[0]
+    return np.frombuffer(_recv_exact(conn, size), dtype=np.float32)
+
+
+class SocketAllReduce(object):
+    """
+    All-reduce over TCP through rank 0, for workers on several hosts.
+    Rank 0 receives the gradients of every rank, sums them in rank order and sends the mean back.
+    """
+    def __init__(self, rank, world_size, master=FLAGS.dp_master, timeout=300.0):
+        """Initializer
+            Args:
+            rank		: Global rank of this process
+            world_size	: Number of processes over all hosts
+            master		: 'host:port' rank 0 listens on
+            timeout		: Seconds to wait for the other ranks to connect
+        """
+        self.rank = rank
+        self.world_size = world_size
+        host, port = master.rsplit(':', 1)
+        port = int(port)
+
+        if rank == 0:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(('', port))
+            server.listen(world_size)
+            server.settimeout(timeout)
+            self.peers = {}
+            while len(self.peers) < world_size - 1:
+                conn, _ = server.accept()
+                conn.settimeout(None)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                peer_rank = struct.unpack('!I', _recv_exact(conn, 4))[0]
+                self.peers[peer_rank] = conn
+            server.close()
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    self.conn = socket.create_connection((host, port))
+                    break
+                except (IOError, OSError):
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(1.0)
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conn.sendall(struct.pack('!I', rank))
+
+    def allreduce(self, arrays):
+        """ Mean of arrays over the ranks, see SharedMemoryAllReduce.allreduce
+        """
+        flat = _flatten(arrays)
+        if self.rank == 0:
+            total = flat.copy()
+            for peer_rank in sorted(self.peers):
+                total += _recv_array(self.peers[peer_rank])
+            total /= self.world_size
+            for peer_rank in sorted(self.peers):
+                _send_array(self.peers[peer_rank], total)
+        else:
+            _send_array(self.conn, flat)
+            total = _recv_array(self.conn)
+        return _unflatten(total, [np.shape(array) for array in arrays])
+
+    def broadcast(self, arrays):
+        """ arrays of rank 0 on every rank
+        """
+        flat = _flatten(arrays)
+        if self.rank == 0:
+            for peer_rank in sorted(self.peers):
+                _send_array(self.peers[peer_rank], flat)
+        else:
+            flat = _recv_array(self.conn)
+        return _unflatten(flat, [np.shape(array) for array in arrays])
+
+    def close(self):
+        # the last all-reduce is a barrier, every rank has its result
+        self.allreduce([np.zeros(1, dtype=np.float32)])
+        if self.rank == 0:
+            for conn in self.peers.values():
+                conn.close()
+        else:
+            self.conn.close()
+
+
+def _worker(local_rank, node_rank, num_workers, num_nodes, backend, master, shared_allreduce):
+    rank = node_rank * num_workers + local_rank
+    world_size = num_workers * num_nodes
+    np.random.seed(FLAGS.dp_seed + rank)
+    random.seed(FLAGS.dp_seed + rank)
+
+    if backend == 'shm':
+        allreduce = shared_allreduce
+        allreduce.set_rank(rank)
+    else:
+        allreduce = SocketAllReduce(rank, world_size, master)
+
+    # tensorflow is imported after the fork, every worker owns its runtime and its share of the cores
+    from train_ldf import train_multi
+    intra_op_threads = max(1, multiprocessing.cpu_count() // num_workers)
+    try:
+        train_multi(rank=rank, world_size=world_size, allreduce=allreduce, intra_op_threads=intra_op_threads)
+    finally:
+        allreduce.close()
+
+
+def launch(num_workers=FLAGS.dp_num_workers, backend=FLAGS.dp_backend, num_nodes=FLAGS.dp_num_nodes, node_rank=0,
+           master=FLAGS.dp_master):
+    """ Start the workers of this host and wait for them
+    Args:
+        num_workers	: Worker processes on this host
+        backend		: 'shm' for one host, 'socket' for one or several hosts
+        num_nodes	: Number of hosts, each runs launch with its node_rank
+        node_rank	: Index of this host, the host of node_rank 0 runs rank 0 and must be reachable at master
+        master		: 'host:port' of the socket all-reduce
+    """
+    if backend == 'shm' and num_nodes > 1:
+        raise ValueError("The 'shm' all-reduce works on one host, use 'socket' for {} hosts".format(num_nodes))
+    world_size = num_workers * num_nodes
+    if FLAGS.batch_size % world_size != 0:
+        raise ValueError('batch_size {} is not a multiple of the {} workers'.format(FLAGS.batch_size, world_size))
+
+    shared_allreduce = SharedMemoryAllReduce(num_workers) if backend == 'shm' else None
+    print('DATA PARALLEL TRAINING', world_size, 'workers,', FLAGS.batch_size // world_size, 'images per worker, backend', backend)
+
+    processes = []
+    for local_rank in range(num_workers):
+        process = multiprocessing.Process(target=_worker, args=(local_rank, node_rank, num_workers, num_nodes, backend,
+                                                                master, shared_allreduce))
+        process.start()
+        processes.append(process)
+
+    failed = False
+    try:
+        while processes:
+            for process in list(processes):
+                process.join(timeout=1.0)
+                if process.exitcode is None:
+                    continue
+                processes.remove(process)
+                if process.exitcode != 0:
+                    failed = True
+            if failed:
+                break
+    finally:
+        # one failed worker blocks the others in the all-reduce
+        for process in processes:
+            process.terminate()
+            process.join()
+        if shared_allreduce is not None and os.path.exists(shared_allreduce.path):
+            os.remove(shared_allreduce.path)
+    if failed:
+        raise RuntimeError('A data-parallel worker failed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel training of train_multi')
+    parser.add_argument('--num_workers', type=int, default=FLAGS.dp_num_workers, help='worker processes on this host')
+    parser.add_argument('--backend', choices=['shm', 'socket'], default=FLAGS.dp_backend)
+    parser.add_argument('--num_nodes', type=int, default=FLAGS.dp_num_nodes)
+    parser.add_argument('--node_rank', type=int, default=0)
+    parser.add_argument('--master', default=FLAGS.dp_master, help='host:port of rank 0 for the socket backend')
+    args = parser.parse_args()
+
+    launch(args.num_workers, args.backend, args.num_nodes, args.node_rank, args.master)
@@ -0,0 +1,220 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：export the latest train_multi checkpoint as a frozen inference graph (conv1/conv2 batch norms
+#                folded into their convolutions, no dropout, no optimizer slots) with the class metadata,
+#                and import it in the inference stages
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib.slim.python.slim.nets import resnet_v2
+from tensorflow.tools.graph_transforms import TransformGraph
+slim = tf.contrib.slim
+
+from config import FLAGS, model_path_suffix
+from parse_raw_data import load_catalog
+
+
+INPUT_NAME = 'input_images'
+OUTPUT_NAME = 'latent_logits'
+
+_TRANSFORMS = ['strip_unused_nodes',
+               'remove_nodes(op=Identity, op=CheckNumerics)',
+               'fold_constants(ignore_errors=true)',
+               'fold_batch_norms',
+               'fold_old_batch_norms',
+               'sort_by_execution_order']
+
+
+def _head_prefix(head_on_cached_features):
+    if head_on_cached_features is None:
+        head_on_cached_features = FLAGS.train_head_on_cached_features
+    return 'head_' if head_on_cached_features else ''
+
+
+def default_checkpoint_dir(head_on_cached_features=None):
+    """ Model dir the inference stages read: the train_multi one, or the one of the head trained on cached
+    features by feature_cache.py, default with train_head_on_cached_features
+    """
+    return os.path.join('../../data/results_multi/model_weights',
+                        _head_prefix(head_on_cached_features) + model_path_suffix())
+
+
+def default_export_dir(head_on_cached_features=None):
+    return os.path.join(FLAGS.inference_graph_dir, _head_prefix(head_on_cached_features) + model_path_suffix())
+
+
+def _graph_path(export_dir):
+    return os.path.join(export_dir, 'inference_graph.pb')
+
+
+def _meta_path(export_dir):
+    return os.path.join(export_dir, 'inference_meta.json')
+
+
+def _build_inference_network(images):
+    """ resnet_v2_50 and the fully_connected head in inference mode, batch norms use their moving statistics
+    """
+    feature, _ = resnet_v2.resnet_v2_50(images, num_classes=None, reuse=False, is_training=False)
+    feature = tf.squeeze(feature, axis=[1, 2])
+    logits = slim.fully_connected(feature, num_outputs=2 * FLAGS.attribute_label_cnt, activation_fn=None)
+    return tf.identity(logits, name=OUTPUT_NAME)
+
+
+def export_inference_graph(checkpoint_dir=None, export_dir=None):
+    """ Freeze the model variables of the latest checkpoint of checkpoint_dir into a pruned inference graph
+    Args:
+        checkpoint_dir	: Model dir, default default_checkpoint_dir()
+        export_dir		: Output directory, default inference_graph_dir/<model suffix>
+    Store:
+        inference_graph.pb		: GraphDef from INPUT_NAME [batch, img_size, img_size, 3] to OUTPUT_NAME [batch, 60]
+        inference_meta.json		: checkpoint, tensor names, input spec and the class lists, written last
+    """
+    checkpoint_dir = checkpoint_dir or default_checkpoint_dir()
+    export_dir = export_dir or default_export_dir()
+    ckpt = tf.train.latest_checkpoint(checkpoint_dir)
+    if ckpt is None:
+        raise IOError('No checkpoint in {}'.format(checkpoint_dir))
+    start_time = time.time()
+
+    with tf.Graph().as_default() as graph:
+        images = tf.placeholder(dtype=tf.float32, shape=[None, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth],
+                                name=INPUT_NAME)
+        _build_inference_network(images)
+        # the model variables only, the optimizer slots of the checkpoint are not read
+        saver = tf.train.Saver(var_list=slim.get_model_variables())
+        with tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            saver.restore(sess, ckpt)
+            frozen = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [OUTPUT_NAME])
+    optimized = TransformGraph(frozen, [INPUT_NAME], [OUTPUT_NAME], _TRANSFORMS)
+
+    catalog = load_catalog()
+    os.system('mkdir -p {}'.format(export_dir))
+    if os.path.exists(_meta_path(export_dir)):
+        os.remove(_meta_path(export_dir))
+    with open(_graph_path(export_dir), 'wb') as f:
+        f.write(optimized.SerializeToString())
+    with open(_meta_path(export_dir), 'w') as f:
+        json.dump({'checkpoint': ckpt, 'input': INPUT_NAME + ':0', 'output': OUTPUT_NAME + ':0',
+                   'img_size': FLAGS.img_size, 'normalize': FLAGS.normalize,
+                   'attribute_label_cnt': FLAGS.attribute_label_cnt, 'class_list': list(catalog.class_list),
+                   'seen_class_index': [int(i) for i in catalog.seen_class_index],
+                   'unseen_class_index': [int(i) for i in catalog.unseen_class_index]}, f)
+    print('INFERENCE GRAPH of %s exported to %s in %.2f seconds: %d nodes frozen, %d after the transforms' %
+          (ckpt, export_dir, time.time() - start_time, len(frozen.node), len(optimized.node)))
+    return export_dir
+
+
+def ensure_inference_graph(checkpoint_dir=None, export_dir=None):
+    """ Export again when there is no artifact or when it was not exported from the latest checkpoint
+    Returns:
+        meta dict of the artifact
+    """
+    checkpoint_dir = checkpoint_dir or default_checkpoint_dir()
+    export_dir = export_dir or default_export_dir()
+    meta = None
+    if os.path.exists(_meta_path(export_dir)):
+        with open(_meta_path(export_dir), 'r') as f:
+            meta = json.load(f)
+    latest = tf.train.latest_checkpoint(checkpoint_dir)
+    if meta is None or (latest is not None and meta['checkpoint'] != latest):
+        export_inference_graph(checkpoint_dir, export_dir)
+        with open(_meta_path(export_dir), 'r') as f:
+            meta = json.load(f)
+    return meta
+
+
+def import_inference_graph(images=None, checkpoint_dir=None, export_dir=None):
+    """ Import the frozen graph into the default graph, exporting it first when needed
+    Args:
+        images	: [batch, img_size, img_size, 3] float32 tensor fed to the network, e.g. a placeholder_with_default
+                  over a tf.data batch, None to use the placeholder of the artifact
+    Returns:
+        images, latent logits tensor, meta dict
+    """
+    export_dir = export_dir or default_export_dir()
+    meta = ensure_inference_graph(checkpoint_dir, export_dir)
+    graph_def = tf.GraphDef()
+    with open(_graph_path(export_dir), 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    input_map = {meta['input']: images} if images is not None else None
+    logits, = tf.import_graph_def(graph_def, input_map=input_map, return_elements=[meta['output']], name='inference')
+    if images is None:
+        images = tf.get_default_graph().get_tensor_by_name('inference/' + meta['input'])
+    return images, logits, meta
+
+
+_first_prediction_reported = set()
+
+
+def report_first_prediction(stage, stage_start_time):
+    """ Print the time from the start of stage to its first prediction, once per stage
+    """
+    if stage not in _first_prediction_reported:
+        _first_prediction_reported.add(stage)
+        print('[%s][%s] first prediction %.2f seconds after the stage start' %
+              (time.strftime("%Y-%m-%d %H:%M:%S"), stage, time.time() - stage_start_time))
+
+
+def _checkpoint_startup(images_np, config):
+    """ First prediction of the inference stages before the frozen graph: training-mode switch and dropout in
+    the graph, global and local init, restore of every variable from the training checkpoint and the mean
+    of every trainable variable printed
+    """
+    with tf.Graph().as_default() as graph:
+        images = tf.placeholder(dtype=tf.float32, shape=[None, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth])
+        is_training = tf.placeholder(dtype=tf.bool)
+        feature, _ = resnet_v2.resnet_v2_50(images, num_classes=None, reuse=False, is_training=is_training)
+        feature = tf.squeeze(feature, axis=[1, 2])
+        feature = slim.dropout(feature, keep_prob=1)
+        logits = slim.fully_connected(feature, num_outputs=2 * FLAGS.attribute_label_cnt, activation_fn=None)
+        with tf.Session(graph=graph, config=config) as sess:
+            saver = tf.train.Saver()
+            sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+            checkpoint = tf.train.get_checkpoint_state(default_checkpoint_dir())
+            saver.restore(sess, checkpoint.model_checkpoint_path)
+            for variable in tf.trainable_variables():  # check weights
+                with tf.variable_scope('', reuse=True):
+                    var = tf.get_variable(variable.name.split(':0')[0])
+                    print(variable.name, np.mean(sess.run(var)))
+            return sess.run(logits, feed_dict={images: images_np, is_training: False})
+
+
+def benchmark_startup(batch_size=FLAGS.batch_size_test):
+    """ Time from an empty graph to the first prediction, the checkpoint path the inference stages used
+    before against the frozen artifact
+    """
+    images_np = np.random.uniform(size=(batch_size, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth)).astype(np.float32)
+    config = tf.ConfigProto(device_count={'GPU': 0})
+    ensure_inference_graph()
+
+    start_time = time.time()
+    checkpoint_logits = _checkpoint_startup(images_np, config)
+    checkpoint_time = time.time() - start_time
+
+    start_time = time.time()
+    with tf.Graph().as_default() as graph:
+        images, logits, _ = import_inference_graph()
+        with tf.Session(graph=graph, config=config) as sess:
+            frozen_logits = sess.run(logits, feed_dict={images: images_np})
+    frozen_time = time.time() - start_time
+
+    print('first prediction: %.2f seconds from the checkpoint, %.2f seconds from the frozen graph, max difference %.2e' %
+          (checkpoint_time, frozen_time, np.max(np.abs(checkpoint_logits - frozen_logits))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the latest train_multi checkpoint as a frozen inference graph')
+    parser.add_argument('--checkpoint_dir', default=None, help='default the train_multi model dir, or the head one with train_head_on_cached_features')
+    parser.add_argument('--export_dir', default=None, help='default inference_graph_dir/<model suffix>')
+    parser.add_argument('--benchmark', action='store_true', help='compare the startup with a checkpoint restore')
+    args = parser.parse_args()
+
+    export_inference_graph(args.checkpoint_dir, args.export_dir)
+    if args.benchmark:
+        benchmark_startup()
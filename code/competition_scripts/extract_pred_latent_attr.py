@@ -8,12 +8,34 @@ import tensorflow as tf
 import os
 import time
 import numpy as np
-from tensorflow.contrib.slim.python.slim.nets import resnet_v2
-slim = tf.contrib.slim
 
 from config import FLAGS
 from data_generator import *
 from parse_raw_data import *
+from input_pipeline import build_inference_dataset
+from export_inference_graph import import_inference_graph, report_first_prediction, default_checkpoint_dir
+
+
+def extract_with_dataset(sess, init_op, batch_names, final_logits, feed_dict, total, stage_start_time=None):
+	"""Run the model over a tf.data iterator until it is exhausted, return {image name: logits}"""
+	sess.run(init_op)
+	la_dict = {}
+	step = 0
+	while True:
+		batch_start_time = time.time()
+		try:
+			image_name, pred_logits = sess.run([batch_names, final_logits], feed_dict=feed_dict)
+		except tf.errors.OutOfRangeError:
+			break
+		if stage_start_time is not None:
+			report_first_prediction('extract_pred_latent_attr', stage_start_time)
+		pred_logits = np.array(pred_logits).reshape(len(image_name), -1)
+		for i in range(len(image_name)):
+			la_dict[image_name[i].decode('utf-8')] = pred_logits[i]
+		step = step + len(image_name)
+		print('[%s][testing %d][step %d / %d exec %.2f seconds]'
+		      % (time.strftime("%Y-%m-%d %H:%M:%S"), len(image_name), step, total, (time.time() - batch_start_time)))
+	return la_dict
 
 
 def extract_pred_latent_attr():
@@ -21,12 +43,14 @@ def extract_pred_latent_attr():
 		Step 1: Create dirs for saving models and logs
 	'''
 	print('Start extract predicted latent attr')
+	stage_start_time = time.time()
 	os.environ['CUDA_VISIBLE_DEVICES'] = FLAGS.gpu_id
 	model_path_suffix = os.path.join(
 		FLAGS.network_def + '_' + FLAGS.version + '_' + 'train_multi' + '_imagesize_' + str(
 			FLAGS.img_size) +
 		'_batchsize_' + str(FLAGS.batch_size) + '_experiment_' + FLAGS.experiment_id)
-	model_save_dir = os.path.join('../../data/results_multi/model_weights', model_path_suffix)
+	# train_multi dir, or the head trained on cached features with train_head_on_cached_features
+	model_save_dir = default_checkpoint_dir()
 
 	print('Extract pred attr of train set: ' + model_path_suffix + ' ...')
 	la_save_dir_train = os.path.join('../../data/results_extract_la' + '/train', model_path_suffix)
@@ -38,36 +62,35 @@ def extract_pred_latent_attr():
 	'''
 	Step 2: Create dataset and data generator
 	'''
-	test_set_train = []
-	with open(FLAGS.train_file, 'r') as f:
-		for line in f.readlines():
-			image_name = line.split('	')[0]
-			test_set_train.append(image_name)
+	catalog = load_catalog()
+	test_set_train = list(catalog.train_images)
 	print('READING LABELS OF TRAIN DATA')
 	print('Train total num:', len(test_set_train))
 	test_size_train = len(test_set_train)
 
-	test_set_test = parse_test_image_list(FLAGS.test_file)
+	test_set_test = catalog.test_images
 	print('Test total num:', len(test_set_test))
 	test_size_test = len(test_set_test)
 
 	'''
 	Step 3: Build network graph
 	'''
-	_, whole_attr_np, _ = parse_repre_label2one_hot_map(FLAGS.attrs_per_class_dir)
-	# print(whole_attr_np)
-
 	with tf.Graph().as_default() as g3:
-		image_placeholder = tf.placeholder(dtype=tf.float32, shape=[None, FLAGS.img_height, FLAGS.img_width,
-																	FLAGS.img_depth])  # [batch, 224, 224, 3]
-		is_training = tf.placeholder(dtype=tf.bool)
-
-		feature, endpoints = resnet_v2.resnet_v2_50(image_placeholder, num_classes=None, reuse=False,
-													is_training=is_training)
-		feature = tf.squeeze(feature, axis=[1, 2])
-		print('feature shape:', feature)
-		feature = slim.dropout(feature, keep_prob=1)
-		final_logits = slim.fully_connected(feature, num_outputs=2 * FLAGS.attribute_label_cnt, activation_fn=None)
+		if FLAGS.input_pipeline == 'tf_data':
+			# one iterator over both sets, the image placeholder defaults to its batches
+			train_dataset = build_inference_dataset(test_set_train, FLAGS.img_dir)
+			test_dataset = build_inference_dataset(test_set_test, FLAGS.test_img_dir)
+			iterator = tf.data.Iterator.from_structure(train_dataset.output_types, train_dataset.output_shapes)
+			train_init_op = iterator.make_initializer(train_dataset)
+			test_init_op = iterator.make_initializer(test_dataset)
+			batch_names, batch_images = iterator.get_next()
+			image_placeholder = tf.placeholder_with_default(batch_images, shape=[None, FLAGS.img_height, FLAGS.img_width,
+																				 FLAGS.img_depth])  # [batch, 224, 224, 3]
+		else:
+			image_placeholder = None
+
+		# frozen inference graph of the latest checkpoint, exported by export_inference_graph.py when missing
+		image_placeholder, final_logits, _ = import_inference_graph(image_placeholder, checkpoint_dir=model_save_dir)
 		print('logits shape', final_logits)
 
 	'''
@@ -77,57 +100,48 @@ def extract_pred_latent_attr():
 
 	device_count = {'GPU': 1} if FLAGS.use_gpu else {'GPU': 0}
 	with tf.Session(config=tf.ConfigProto(device_count=device_count, allow_soft_placement=True), graph=g3) as sess:
-		# Create model saver
-		saver = tf.train.Saver()
-
-		# Init all vars
-		init_op = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
-		sess.run(init_op)
-
-		if True:
-			# Restore pretrained weights
-			pretrained_model = model_save_dir
-			print('load checkpoint of ', pretrained_model)
-			checkpoint = tf.train.get_checkpoint_state(pretrained_model)
-			ckpt = checkpoint.model_checkpoint_path  # 获取最新保存的模型检查点文件
-			saver.restore(sess, ckpt)
-			for variable in tf.trainable_variables():  # check weights
-				with tf.variable_scope('', reuse=True):
-					var = tf.get_variable(variable.name.split(':0')[0])
-					print(variable.name, np.mean(sess.run(var)))
-
 		# Extract train la start
-		step = 0
-		train_la_dict = {}
-		while True:
-			if step < test_size_train:
-				image_name = test_set_train[step: step + FLAGS.batch_size_test]
-				print('IMAGE_NAME', image_name)
-				step = step + FLAGS.batch_size_test
-				image_num = len(image_name)
-				print('image num', image_num)
-
-				image_data = np.zeros((image_num, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth), dtype=np.float32)
-				for i in range(image_num):
-					img = open_img(is_train=True, name=image_name[i], size=FLAGS.img_size,
-								   color=FLAGS.img_type)
-
-					if FLAGS.normalize:
-						image_data[i, :, :, :] = img.astype(np.float32) / 255.0
+		if FLAGS.input_pipeline == 'tf_data':
+			train_la_dict = extract_with_dataset(sess, train_init_op, batch_names, final_logits, {}, test_size_train, stage_start_time)
+		else:
+			step = 0
+			train_la_dict = {}
+			while True:
+				if step < test_size_train:
+					image_name = test_set_train[step: step + FLAGS.batch_size_test]
+					print('IMAGE_NAME', image_name)
+					step = step + FLAGS.batch_size_test
+					image_num = len(image_name)
+					print('image num', image_num)
+
+					image_cache = get_image_cache('train')
+					if image_cache is not None and image_cache.has(image_name[0], FLAGS.img_size):
+						image_data = image_cache.get_batch(image_name, FLAGS.img_size).astype(np.float32)
+						if FLAGS.normalize:
+							image_data /= 255.0
 					else:
-						image_data[i, :, :, :] = img.astype(np.float32)
-
-				batch_start_time = time.time()
-
-				pred_logits = sess.run([final_logits], feed_dict={image_placeholder: image_data, is_training: False})
-				pred_logits = np.array(pred_logits).squeeze()
-
-				for i in range(image_num):
-					train_la_dict[image_name[i]] = pred_logits[i]
-				print('[%s][testing %d][step %d / %d exec %.2f seconds]'
-				      % (time.strftime("%Y-%m-%d %H:%M:%S"), image_num, step, test_size_train, (time.time() - batch_start_time)))
-			else:
-				break
+						image_data = np.zeros((image_num, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth), dtype=np.float32)
+						for i in range(image_num):
+							img = open_img(is_train=True, name=image_name[i], size=FLAGS.img_size,
+										   color=FLAGS.img_type)
+
+							if FLAGS.normalize:
+								image_data[i, :, :, :] = img.astype(np.float32) / 255.0
+							else:
+								image_data[i, :, :, :] = img.astype(np.float32)
+
+					batch_start_time = time.time()
+
+					pred_logits = sess.run([final_logits], feed_dict={image_placeholder: image_data})
+					report_first_prediction('extract_pred_latent_attr', stage_start_time)
+					pred_logits = np.array(pred_logits).squeeze()
+
+					for i in range(image_num):
+						train_la_dict[image_name[i]] = pred_logits[i]
+					print('[%s][testing %d][step %d / %d exec %.2f seconds]'
+					      % (time.strftime("%Y-%m-%d %H:%M:%S"), image_num, step, test_size_train, (time.time() - batch_start_time)))
+				else:
+					break
 		print('train_la_dict: ', len(train_la_dict))
 		np.savez(os.path.join(la_save_dir_train, 'train_la.npz'), dict=train_la_dict)
 		train_la_dict_2 = np.load(os.path.join(la_save_dir_train, 'train_la.npz'))['dict'][()]
@@ -136,39 +150,49 @@ def extract_pred_latent_attr():
 		print("[%s][total exec %s seconds" % (time.strftime("%Y-%m-%d %H:%M:%S"), (time.time() - total_start_time)))
 
 		# Extract test la start
-		step = 0
-		test_la_dict = {}
-		while True:
-			if step < test_size_test:
-				image_name = test_set_test[step: step + FLAGS.batch_size_test]
-				print('IMAGE_NAME', image_name)
-				step = step + FLAGS.batch_size_test
-				image_num = len(image_name)
-				print('image num', image_num)
-
-				image_data = np.zeros((image_num, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth), dtype=np.float32)
-				for i in range(image_num):
-					img = open_img(is_train=False, name=image_name[i], size=FLAGS.img_size,
-								   color=FLAGS.img_type)
-
-					if FLAGS.normalize:
-						image_data[i, :, :, :] = img.astype(np.float32) / 255.0
+		if FLAGS.input_pipeline == 'tf_data':
+			test_la_dict = extract_with_dataset(sess, test_init_op, batch_names, final_logits, {}, test_size_test, stage_start_time)
+		else:
+			step = 0
+			test_la_dict = {}
+			while True:
+				if step < test_size_test:
+					image_name = test_set_test[step: step + FLAGS.batch_size_test]
+					print('IMAGE_NAME', image_name)
+					step = step + FLAGS.batch_size_test
+					image_num = len(image_name)
+					print('image num', image_num)
+
+					image_cache = get_image_cache('test')
+					if image_cache is not None and image_cache.has(image_name[0], FLAGS.img_size):
+						image_data = image_cache.get_batch(image_name, FLAGS.img_size).astype(np.float32)
+						if FLAGS.normalize:
+							image_data /= 255.0
 					else:
-						image_data[i, :, :, :] = img.astype(np.float32)
-
-				batch_start_time = time.time()
-
-				pred_logits = sess.run([final_logits], feed_dict={image_placeholder: image_data, is_training: False})
-				pred_logits = np.array(pred_logits).squeeze()
-
-				for i in range(image_num):
-					test_la_dict[image_name[i]] = pred_logits[i]
-
-				print('[%s][testing %d][step %d / %d exec %.2f seconds]'
-				      % (time.strftime("%Y-%m-%d %H:%M:%S"), image_num, step, test_size_test,
-				         (time.time() - batch_start_time)))
-			else:
-				break
+						image_data = np.zeros((image_num, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth), dtype=np.float32)
+						for i in range(image_num):
+							img = open_img(is_train=False, name=image_name[i], size=FLAGS.img_size,
+										   color=FLAGS.img_type)
+
+							if FLAGS.normalize:
+								image_data[i, :, :, :] = img.astype(np.float32) / 255.0
+							else:
+								image_data[i, :, :, :] = img.astype(np.float32)
+
+					batch_start_time = time.time()
+
+					pred_logits = sess.run([final_logits], feed_dict={image_placeholder: image_data})
+					report_first_prediction('extract_pred_latent_attr', stage_start_time)
+					pred_logits = np.array(pred_logits).squeeze()
+
+					for i in range(image_num):
+						test_la_dict[image_name[i]] = pred_logits[i]
+
+					print('[%s][testing %d][step %d / %d exec %.2f seconds]'
+					      % (time.strftime("%Y-%m-%d %H:%M:%S"), image_num, step, test_size_test,
+					         (time.time() - batch_start_time)))
+				else:
+					break
 
 		print('test_la_dict: ', len(test_la_dict))
 		np.savez(os.path.join(la_save_dir_test, 'test_la.npz'), dict=test_la_dict)
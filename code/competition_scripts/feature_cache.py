@@ -0,0 +1,239 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：run the resnet backbone once over the training set for a fixed set of augmentation seeds,
+#                store the pooled features in a memory-mapped float16 store and train the 60-d head on them
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib.slim.python.slim.nets import resnet_v2
+slim = tf.contrib.slim
+
+import loss as model
+from config import FLAGS, model_path_suffix
+from data_generator import DataGenerator, PKSampler
+from augment_engine import AugmentEngine
+from parse_raw_data import load_catalog
+from export_inference_graph import default_checkpoint_dir
+from validator import valid_set_path
+from summary_writer import AsyncSummaryWriter, is_summary_step
+
+
+FEATURE_DIM = 2048
+
+
+def _features_path(cache_dir):
+    return os.path.join(cache_dir, 'features.npy')
+
+
+def _meta_path(cache_dir):
+    return os.path.join(cache_dir, 'meta.json')
+
+
+def _latest_checkpoint(checkpoint_dir):
+    checkpoint = tf.train.get_checkpoint_state(checkpoint_dir)
+    if checkpoint is None:
+        raise IOError('No checkpoint in {}'.format(checkpoint_dir))
+    return checkpoint.model_checkpoint_path
+
+
+def extract_backbone_features(checkpoint_dir=None, cache_dir=FLAGS.feature_cache_dir, num_views=FLAGS.feature_cache_views,
+                              batch_size=FLAGS.batch_size_test):
+    """ Write the pooled backbone features of every training image, one view per augmentation seed. The images
+    train_multi held out for validator.py (valid_set.txt of its model dir) are left out
+    Args:
+        checkpoint_dir	: Checkpoint of the backbone, default the train_multi model dir
+        cache_dir		: Output directory
+        num_views		: View 0 is the plain resized image, view v > 0 is augmented with seed v
+        batch_size		: Images per forward pass
+    Store:
+        features.npy	: (num_views, num_images, 2048) float16
+        num_labels.npy	: (num_images,) int32
+        index.txt		: image names, written with meta.json last
+    """
+    if checkpoint_dir is None:
+        checkpoint_dir = default_checkpoint_dir(head_on_cached_features=False)
+    ckpt = _latest_checkpoint(checkpoint_dir)
+
+    # the train split of the backbone run, without writing a split when it held nothing out
+    valid_set_file = valid_set_path(checkpoint_dir)
+    dataset = DataGenerator(FLAGS.attrs_per_class_dir, FLAGS.img_dir, FLAGS.train_file)
+    dataset.generate_set(rand=False, validationRate=0.0,
+                         valid_set_file=valid_set_file if os.path.exists(valid_set_file) else None)
+    image_names = dataset.train_set
+    num_images = len(image_names)
+
+    os.system('mkdir -p {}'.format(cache_dir))
+    if os.path.exists(_meta_path(cache_dir)):
+        os.remove(_meta_path(cache_dir))
+    features = np.lib.format.open_memmap(_features_path(cache_dir), mode='w+', dtype=np.float16,
+                                         shape=(num_views, num_images, FEATURE_DIM))
+    np.save(os.path.join(cache_dir, 'num_labels.npy'), dataset.num_labels[dataset.train_index])
+
+    with tf.Graph().as_default():
+        image_placeholder = tf.placeholder(dtype=tf.float32, shape=[None, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth])
+        feature, _ = resnet_v2.resnet_v2_50(image_placeholder, num_classes=None, reuse=False, is_training=False)
+        feature = tf.squeeze(feature, axis=[1, 2])
+        saver = tf.train.Saver(var_list=slim.get_model_variables())
+
+        device_count = {'GPU': 1} if FLAGS.use_gpu else {'GPU': 0}
+        with tf.Session(config=tf.ConfigProto(device_count=device_count, allow_soft_placement=True)) as sess:
+            saver.restore(sess, ckpt)
+            print('EXTRACT FEATURES OF', num_images, 'images,', num_views, 'views, backbone', ckpt)
+
+            start_time = time.time()
+            image_data = np.zeros((batch_size, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth), dtype=np.float32)
+            for view in range(num_views):
+                engine = AugmentEngine(rng=np.random.RandomState(view))
+                for start in range(0, num_images, batch_size):
+                    names = image_names[start:start + batch_size]
+                    batch = image_data[:len(names)]
+                    if view == 0:
+                        batch[:] = dataset.open_batch(names, FLAGS.img_size, FLAGS.img_type)
+                        if FLAGS.normalize:
+                            batch /= 255.0
+                    else:
+                        src_batch = dataset.open_batch(names, engine.source_size(), FLAGS.img_type)
+                        engine.augment_batch(src_batch, out=batch, normalize=FLAGS.normalize)
+                    features[view, start:start + len(names)] = sess.run(feature, feed_dict={image_placeholder: batch})
+                    print('[%s][extracting view %d / %d][%d / %d exec %.2f seconds]' %
+                          (time.strftime("%Y-%m-%d %H:%M:%S"), view + 1, num_views, start + len(names), num_images,
+                           time.time() - start_time))
+
+    features.flush()
+    del features
+    with open(os.path.join(cache_dir, 'index.txt'), 'w') as f:
+        for image_name in image_names:
+            f.write(image_name + '\n')
+    with open(_meta_path(cache_dir), 'w') as f:
+        json.dump({'checkpoint': ckpt, 'num_views': num_views, 'num_images': num_images, 'train_file': FLAGS.train_file}, f)
+    print('FEATURE CACHE WRITTEN', cache_dir)
+
+
+def is_cache_current(checkpoint_dir=None, cache_dir=FLAGS.feature_cache_dir, num_views=FLAGS.feature_cache_views):
+    """ True when cache_dir holds the features of the latest backbone checkpoint for the current views and train file
+    """
+    if not os.path.exists(_meta_path(cache_dir)):
+        return False
+    with open(_meta_path(cache_dir), 'r') as f:
+        meta = json.load(f)
+    if checkpoint_dir is None:
+        checkpoint_dir = default_checkpoint_dir(head_on_cached_features=False)
+    return (meta['checkpoint'] == _latest_checkpoint(checkpoint_dir) and meta['num_views'] == num_views
+            and meta['train_file'] == FLAGS.train_file)
+
+
+class FeatureCache(object):
+    """
+    Read-only view on the features written by extract_backbone_features
+    """
+    def __init__(self, cache_dir=FLAGS.feature_cache_dir):
+        """Initializer
+            Args:
+            cache_dir	: Directory written by extract_backbone_features
+        """
+        with open(_meta_path(cache_dir), 'r') as f:
+            self.meta = json.load(f)
+        self.features = np.load(_features_path(cache_dir), mmap_mode='r')
+        self.num_labels = np.load(os.path.join(cache_dir, 'num_labels.npy'))
+        self.num_views, self.num_images = self.features.shape[0:2]
+
+    def get_batch(self, index, views):
+        """ (len(index), 2048) float32 features of the images at index, each in its view
+        """
+        return self.features[views, index].astype(np.float32)
+
+
+def train_head_on_features(cache_dir=FLAGS.feature_cache_dir):
+    """ Train the 60-d fully_connected head with build_multi_loss_3 on cached features,
+    then save it with the backbone of the cache as one checkpoint that the other stages restore
+    """
+    cache = FeatureCache(cache_dir)
+    print('TRAIN HEAD ON', cache.num_images, 'images x', cache.num_views, 'views of', cache.meta['checkpoint'])
+
+    # read by the inference stages with train_head_on_cached_features
+    model_save_dir = default_checkpoint_dir(head_on_cached_features=True)
+    train_log_save_dir = os.path.join('../../data/results_multi/logs', 'head_' + model_path_suffix(), 'train')
+    os.system('mkdir -p {}'.format(model_save_dir))
+    os.system('mkdir -p {}'.format(train_log_save_dir))
+
+    whole_attr_np = load_catalog().class_attributes[:, 0:FLAGS.attribute_label_cnt]
+    sampler = PKSampler(np.arange(cache.num_images), cache.num_labels, FLAGS.pk_images_per_class) \
+        if FLAGS.batch_sampler == 'pk' else None
+    training_iters_per_epoch = int(cache.num_images / FLAGS.batch_size)
+
+    with tf.Graph().as_default():
+        feature_placeholder = tf.placeholder(dtype=tf.float32, shape=[None, FEATURE_DIM])
+        whole_attr = tf.constant(whole_attr_np, dtype=tf.float32)
+        num_label_placeholder = tf.placeholder(dtype=tf.int32, shape=[None])
+        gt_onehot_label_placeholder = tf.one_hot(num_label_placeholder, FLAGS.num_class)
+
+        # same layers and scopes as train_multi, so the head variables keep their names
+        feature = slim.dropout(feature_placeholder, keep_prob=0.5)
+        logits = slim.fully_connected(feature, num_outputs=2 * FLAGS.attribute_label_cnt, activation_fn=None)
+        head_variables = slim.get_model_variables()
+        loss, train = model.build_multi_loss_3(logits, gt_onehot_label_placeholder, whole_attr,
+                                               num_label_placeholder, FLAGS.margin, FLAGS.squared,
+                                               FLAGS.triplet_strategy, optimizer='Adam')
+
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            merged = tf.summary.merge_all()
+            train_writer = AsyncSummaryWriter(train_log_save_dir, sess.graph)
+            sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+
+            start_time = time.time()
+            global_step = 0
+            for epoch in range(FLAGS.feature_head_epochs):
+                for step in range(training_iters_per_epoch):
+                    if sampler is not None:
+                        index = sampler.sample(FLAGS.batch_size)
+                    else:
+                        index = np.random.randint(0, cache.num_images, FLAGS.batch_size)
+                    views = np.random.randint(0, cache.num_views, len(index))
+                    feed_dict = {feature_placeholder: cache.get_batch(index, views),
+                                 num_label_placeholder: cache.num_labels[index]}
+                    global_step = step + epoch * training_iters_per_epoch
+                    if is_summary_step(global_step):
+                        summary, loss_result, _ = sess.run([merged, loss, train], feed_dict=feed_dict)
+                        train_writer.add_summary(summary, global_step)
+                    else:
+                        loss_result, _ = sess.run([loss, train], feed_dict=feed_dict)
+
+                print('[%s][training head][epoch %d / %d exec %.2f seconds]  loss : %3.10f, %s' %
+                      (time.strftime("%Y-%m-%d %H:%M:%S"), epoch + 1, FLAGS.feature_head_epochs,
+                       time.time() - start_time, loss_result, train_writer.timing()))
+            head_values = dict((var.op.name, value) for var, value in zip(head_variables, sess.run(head_variables)))
+            train_writer.close()
+
+    # backbone of the cache + trained head, restorable by extract_pred_latent_attr and test_one_with_aug
+    with tf.Graph().as_default():
+        image_placeholder = tf.placeholder(dtype=tf.float32, shape=[None, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth])
+        feature, _ = resnet_v2.resnet_v2_50(image_placeholder, num_classes=None, reuse=False, is_training=False)
+        feature = tf.squeeze(feature, axis=[1, 2])
+        backbone_variables = slim.get_model_variables()
+        slim.fully_connected(feature, num_outputs=2 * FLAGS.attribute_label_cnt, activation_fn=None)
+        head_assign = [tf.assign(var, head_values[var.op.name]) for var in slim.get_model_variables()
+                       if var.op.name in head_values]
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            tf.train.Saver(var_list=backbone_variables).restore(sess, cache.meta['checkpoint'])
+            sess.run(head_assign)
+            tf.train.Saver(var_list=slim.get_model_variables()).save(
+                sess=sess, save_path=model_save_dir + '/' + FLAGS.network_def.split('.py')[0], global_step=global_step + 1)
+    print('\nHead checkpoint saved in', model_save_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backbone feature cache and head training on it')
+    parser.add_argument('stage', nargs='?', choices=['extract', 'train', 'all'], default='all')
+    parser.add_argument('--checkpoint_dir', default=None, help='backbone checkpoint, default the train_multi model dir')
+    args = parser.parse_args()
+
+    if args.stage in ('extract', 'all'):
+        extract_backbone_features(args.checkpoint_dir)
+    if args.stage in ('train', 'all'):
+        train_head_on_features()
@@ -0,0 +1,187 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：in-graph augmentation and normalization, the TF version of augment_engine.py
+#                for feeding raw uint8 images at size_before_crop
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import tensorflow as tf
+
+from config import FLAGS
+
+
+def _matrices(a, b, c, d, e, f):
+    """ Batch of 3x3 affine matrices [[a, b, c], [d, e, f], [0, 0, 1]], every argument has shape [batch]
+    """
+    zeros = tf.zeros_like(a)
+    ones = tf.ones_like(a)
+    return tf.reshape(tf.stack([a, b, c, d, e, f, zeros, zeros, ones], axis=1), [-1, 3, 3])
+
+
+def _translate(tx, ty):
+    ones = tf.ones_like(tx)
+    zeros = tf.zeros_like(tx)
+    return _matrices(ones, zeros, tx, zeros, ones, ty)
+
+
+def _resize(src_size, dst_size):
+    """ Pixel-center aligned resize from src_size to dst_size, sizes have shape [batch]
+    """
+    ratio = dst_size / src_size
+    zeros = tf.zeros_like(ratio)
+    return _matrices(ratio, zeros, 0.5 * ratio - 0.5, zeros, ratio, 0.5 * ratio - 0.5)
+
+
+def _flip(coin, size, horizontal):
+    """ Flip where coin is True, identity elsewhere
+    """
+    sign = tf.where(coin, -tf.ones_like(size), tf.ones_like(size))
+    shift = tf.where(coin, size - 1.0, tf.zeros_like(size))
+    zeros = tf.zeros_like(size)
+    ones = tf.ones_like(size)
+    if horizontal:
+        return _matrices(sign, zeros, shift, zeros, ones, zeros)
+    return _matrices(ones, zeros, zeros, zeros, sign, shift)
+
+
+def _rotate(angle, size):
+    """ Counter-clockwise rotation around the image center, angle in degrees
+    """
+    theta = angle * 3.141592653589793 / 180.0
+    center = (size - 1.0) / 2.0
+    cos = tf.cos(theta)
+    sin = tf.sin(theta)
+    rotation = _matrices(cos, sin, tf.zeros_like(cos), -sin, cos, tf.zeros_like(cos))
+    return tf.matmul(_translate(center, center), tf.matmul(rotation, _translate(-center, -center)))
+
+
+def _sample_transforms(batch_size, src_size, out_size):
+    """ Draw the FLAGS-driven augmentation of every image, same distribution as AugmentEngine.sample_transform
+    Returns:
+        matrix	: [batch, 3, 3] maps source pixels to output pixels
+        box		: [batch, 3] crop box (x, y, size) in source pixels
+        clip	: [batch, 3, 3] rotation after a zoom in, the pre-rotation canvas is clipped to out_size
+    """
+    def coin():
+        return tf.random_uniform([batch_size]) < 0.5
+
+    ones = tf.ones([batch_size])
+    src = float(src_size) * ones
+    out = float(out_size) * ones
+    identity = _translate(0.0 * ones, 0.0 * ones)
+
+    # crop aug
+    crop_size = src
+    loc_x = 0.0 * ones
+    loc_y = 0.0 * ones
+    if FLAGS.if_crop_augment:
+        crop = coin()
+        size = float(int(src_size * FLAGS.crop_scale))
+        crop_size = tf.where(crop, size * ones, src)
+        loc_x = tf.where(crop, tf.floor(tf.random_uniform([batch_size], 0.0, src_size - size)), loc_x)
+        loc_y = tf.where(crop, tf.floor(tf.random_uniform([batch_size], 0.0, src_size - size)), loc_y)
+    matrix = tf.matmul(_resize(crop_size, out), _translate(-loc_x, -loc_y))
+
+    # flip aug
+    if FLAGS.if_flip_augment:
+        matrix = tf.matmul(_flip(coin(), out, horizontal=False), matrix)
+        matrix = tf.matmul(_flip(coin(), out, horizontal=True), matrix)
+
+    # augment size
+    zoom_in = tf.zeros([batch_size], dtype=tf.bool)
+    if FLAGS.if_size_augment:
+        resize = coin()
+        compress_ratio = tf.random_uniform([batch_size], FLAGS.min_compress_ratio, FLAGS.max_compress_ratio)
+        size = tf.round(compress_ratio * out_size)
+        offset = tf.where(compress_ratio <= 1.0, tf.floor((out - size) / 2.0), -tf.floor((size - out) / 2.0))
+        size_matrix = tf.matmul(_translate(offset, offset), _resize(out, size))
+        matrix = tf.matmul(tf.where(resize, size_matrix, identity), matrix)
+        zoom_in = tf.logical_and(resize, compress_ratio > 1.0)
+
+    # rotate augmentation
+    clip = identity
+    if FLAGS.if_rotate_augment:
+        rotate = coin()
+        angle = tf.floor(tf.random_uniform([batch_size], -FLAGS.max_rotation, FLAGS.max_rotation))
+        rotation = tf.where(rotate, _rotate(angle, out), identity)
+        matrix = tf.matmul(rotation, matrix)
+        clip = tf.where(tf.logical_and(rotate, zoom_in), rotation, identity)
+
+    return matrix, tf.stack([loc_x, loc_y, crop_size], axis=1), clip
+
+
+def _inside(points, low, high):
+    """ [batch, 3, n] homogeneous points -> [batch, n] True where low <= x, y <= high, bounds have shape [batch, 1]
+    """
+    x = points[:, 0, :]
+    y = points[:, 1, :]
+    return tf.logical_and(tf.logical_and(x >= low[0], x <= high[0]), tf.logical_and(y >= low[1], y <= high[1]))
+
+
+def _warp(images, matrix, box, clip, out_size):
+    """ Warp float images with one bilinear resample, output pixel p is read at source pixel matrix^-1 p
+    Args:
+        images		: [batch, size, size, 3] float32 tensor, size is static
+        matrix, box, clip	: See _sample_transforms
+        out_size	: Size of the warped images
+    Returns:
+        [batch, out_size, out_size, 3] float32 tensor
+    """
+    src_size = images.get_shape()[1].value
+    batch_size = tf.shape(images)[0]
+
+    # the projective transform keeps the size of its input, the output pixels are its top-left out_size window,
+    # padding at the bottom and right keeps the source pixel coordinates
+    if out_size > src_size:
+        images = tf.pad(images, [[0, 0], [0, out_size - src_size], [0, out_size - src_size], [0, 0]])
+    transforms = tf.reshape(tf.matrix_inverse(matrix), [-1, 9])[:, :8]
+    augmented = tf.contrib.image.transform(images, transforms, interpolation='BILINEAR')
+    augmented = augmented[:, :out_size, :out_size, :]
+
+    # black out pixels mapped from outside the crop box, and the corners a zoomed canvas drops before the rotation
+    ys, xs = tf.meshgrid(tf.range(out_size, dtype=tf.float32), tf.range(out_size, dtype=tf.float32), indexing='ij')
+    grid = tf.stack([tf.reshape(xs, [-1]), tf.reshape(ys, [-1]), tf.ones([out_size * out_size])], axis=0)
+    grid = tf.tile(tf.expand_dims(grid, 0), [batch_size, 1, 1])
+    loc = box[:, 0:2]
+    size = box[:, 2:3]
+    in_box = _inside(tf.matmul(tf.matrix_inverse(matrix), grid),
+                     [loc[:, 0:1] - 0.5, loc[:, 1:2] - 0.5], [loc[:, 0:1] + size - 0.5, loc[:, 1:2] + size - 0.5])
+    edge = [tf.fill([batch_size, 1], -0.5), tf.fill([batch_size, 1], out_size - 0.5)]
+    in_canvas = _inside(tf.matmul(tf.matrix_inverse(clip), grid), [edge[0], edge[0]], [edge[1], edge[1]])
+    mask = tf.to_float(tf.logical_and(in_box, in_canvas))
+    mask = tf.reshape(mask, [-1, out_size, out_size, 1])
+
+    return augmented * mask
+
+
+def augment_images(images, out_size=FLAGS.img_size):
+    """ Random crop, flip, size and rotate aug of a batch as one projective transform per image, resampled
+    once from the source like the fused CPU warp
+    Args:
+        images		: [batch, size, size, 3] tensor, size is static
+        out_size	: Size of the augmented images
+    Returns:
+        [batch, out_size, out_size, 3] float32 tensor, not normalized
+    """
+    src_size = images.get_shape()[1].value
+    matrix, box, clip = _sample_transforms(tf.shape(images)[0], src_size, out_size)
+    return _warp(tf.to_float(images), matrix, box, clip, out_size)
+
+
+def preprocess_images(images, is_training, out_size=FLAGS.img_size):
+    """ Augmentation in training, plain resize otherwise, then the /255.0 normalization
+    Args:
+        images		: [batch, size, size, 3] uint8 tensor at size_before_crop
+        is_training	: bool tensor
+        out_size	: Size of the network input
+    Returns:
+        [batch, out_size, out_size, 3] float32 tensor
+    """
+    with tf.name_scope('graph_augment'):
+        processed = tf.cond(is_training,
+                            lambda: augment_images(images, out_size),
+                            lambda: tf.image.resize_images(tf.to_float(images), [out_size, out_size]))
+        processed.set_shape([None, out_size, out_size, 3])
+        if FLAGS.normalize:
+            processed = processed / 255.0
+    return processed
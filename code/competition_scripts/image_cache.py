@@ -0,0 +1,248 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：persistent cache of decoded images, stored as packed memory-mapped uint8 arrays
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import json
+import time
+import multiprocessing
+import numpy as np
+import cv2
+
+from config import FLAGS
+
+
+# split name -> (image list file, image dir), the list file holds the image name in the first column
+CACHE_SPLITS = {'train': (FLAGS.train_file, FLAGS.img_dir),
+                'test': (FLAGS.test_file, FLAGS.test_img_dir)}
+
+
+def _read_image_names(list_file):
+    image_names = []
+    with open(list_file, 'r') as f:
+        for line in f.readlines():
+            image_name = line.split('	')[0].replace('\n', '')
+            if image_name:
+                image_names.append(image_name)
+    return image_names
+
+
+def _array_path(cache_dir, split, size):
+    return os.path.join(cache_dir, '{}_{}.npy'.format(split, size))
+
+
+def _index_path(cache_dir, split):
+    return os.path.join(cache_dir, '{}_index.txt'.format(split))
+
+
+def _meta_path(cache_dir, split):
+    return os.path.join(cache_dir, '{}_meta.json'.format(split))
+
+
+def _sources_path(cache_dir, split):
+    return os.path.join(cache_dir, '{}_sources.npy'.format(split))
+
+
+def _source_stats(img_dir, image_names):
+    """ (len(image_names), 2) float64 mtime and size of every image file, -1 for missing files
+    """
+    stats = np.full((len(image_names), 2), -1.0)
+    for i, image_name in enumerate(image_names):
+        try:
+            stat = os.stat(os.path.join(img_dir, image_name))
+        except OSError:
+            continue
+        stats[i] = (stat.st_mtime, stat.st_size)
+    return stats
+
+
+def decode_image(path, sizes):
+    """ Decode an image once and resize it to every size, same pixels as open_img in data_generator
+    Args:
+        path	: Image file
+        sizes	: List of square output sizes
+    Returns:
+        list of (size, size, 3) uint8 RGB arrays
+    """
+    img = cv2.imread(path)
+    if img is None:
+        raise IOError('Can not decode image: {}'.format(path))
+
+    resized = []
+    for size in sizes:
+        img_resized = cv2.resize(img, (size, size))
+        resized.append(cv2.cvtColor(img_resized, cv2.COLOR_BGR2RGB))
+    return resized
+
+
+def _build_worker(args):
+    cache_dir, split, img_dir, sizes, start, image_names = args
+    arrays = [np.load(_array_path(cache_dir, split, size), mmap_mode='r+') for size in sizes]
+    for i, image_name in enumerate(image_names):
+        for array, img in zip(arrays, decode_image(os.path.join(img_dir, image_name), sizes)):
+            array[start + i] = img
+    for array in arrays:
+        array.flush()
+    return len(image_names)
+
+
+def build_image_cache(split, cache_dir=FLAGS.image_cache_dir, sizes=None, num_workers=None, chunk=256):
+    """ Decode every image of a split once into packed uint8 arrays
+    Args:
+        split		: 'train'/'test', see CACHE_SPLITS
+        cache_dir	: Output directory
+        sizes		: Square sizes to store, default FLAGS.size_before_crop and FLAGS.img_size
+        num_workers	: Decoding processes, default the number of cpus
+        chunk		: Images per decoding task
+    """
+    list_file, img_dir = CACHE_SPLITS[split]
+    if sizes is None:
+        sizes = sorted(set([FLAGS.size_before_crop, FLAGS.img_size]))
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    os.system('mkdir -p {}'.format(cache_dir))
+
+    image_names = _read_image_names(list_file)
+    print('BUILD IMAGE CACHE', split, len(image_names), 'images, sizes', sizes)
+
+    # the index is written last, a cache without index is treated as missing
+    if os.path.exists(_index_path(cache_dir, split)):
+        os.remove(_index_path(cache_dir, split))
+    # stats taken before decoding, a file changed during the build is decoded again when the cache is opened
+    stats = _source_stats(img_dir, image_names)
+
+    for size in sizes:
+        array = np.lib.format.open_memmap(_array_path(cache_dir, split, size), mode='w+', dtype=np.uint8,
+                                          shape=(len(image_names), size, size, 3))
+        del array
+
+    start_time = time.time()
+    tasks = [(cache_dir, split, img_dir, sizes, start, image_names[start: start + chunk])
+             for start in range(0, len(image_names), chunk)]
+    done = 0
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for num in pool.imap_unordered(_build_worker, tasks):
+            done += num
+            print('[%s][caching %s][%d / %d exec %.2f seconds]' %
+                  (time.strftime("%Y-%m-%d %H:%M:%S"), split, done, len(image_names), time.time() - start_time))
+    finally:
+        pool.close()
+        pool.join()
+
+    np.save(_sources_path(cache_dir, split), stats)
+    with open(_meta_path(cache_dir, split), 'w') as f:
+        json.dump({'list_file': list_file, 'img_dir': img_dir, 'sizes': sizes, 'num': len(image_names)}, f)
+    with open(_index_path(cache_dir, split), 'w') as f:
+        for image_name in image_names:
+            f.write(image_name + '\n')
+    print('IMAGE CACHE BUILT', cache_dir)
+
+
+class ImageCache(object):
+    """
+    Read-only view on a built cache, images are slices of memory-mapped arrays
+    """
+    def __init__(self, cache_dir, split):
+        """Initializer
+            Args:
+            cache_dir	: Directory written by build_image_cache
+            split		: 'train'/'test'
+        """
+        with open(_meta_path(cache_dir, split), 'r') as f:
+            self.meta = json.load(f)
+        self.sizes = self.meta['sizes']
+
+        self.image2offset = {}
+        with open(_index_path(cache_dir, split), 'r') as f:
+            for offset, line in enumerate(f.readlines()):
+                self.image2offset[line.replace('\n', '')] = offset
+
+        self.arrays = {}
+        for size in self.sizes:
+            self.arrays[size] = np.load(_array_path(cache_dir, split, size), mmap_mode='r')
+
+    def __contains__(self, name):
+        return name in self.image2offset
+
+    def has(self, name, size):
+        return size in self.arrays and name in self.image2offset
+
+    def get(self, name, size):
+        """ (size, size, 3) uint8 RGB image, a read-only view into the cache
+        """
+        return self.arrays[size][self.image2offset[name]]
+
+    def get_batch(self, names, size, out=None):
+        """ (len(names), size, size, 3) uint8 RGB images gathered in one call
+        """
+        offsets = np.array([self.image2offset[name] for name in names], dtype=np.int64)
+        return np.take(self.arrays[size], offsets, axis=0, out=out)
+
+
+_opened_caches = {}
+
+
+def refresh_image_cache(split, cache_dir=FLAGS.image_cache_dir):
+    """ Decode again, in place, the cached images whose file changed (mtime or size) since they were cached
+    Args:
+        split		: 'train'/'test', see CACHE_SPLITS
+        cache_dir	: Directory written by build_image_cache
+    Returns:
+        Names of the cached images whose file is missing, None when the cache has no source stats
+    """
+    if not os.path.exists(_sources_path(cache_dir, split)):
+        return None
+    _, img_dir = CACHE_SPLITS[split]
+    with open(_meta_path(cache_dir, split), 'r') as f:
+        sizes = json.load(f)['sizes']
+    with open(_index_path(cache_dir, split), 'r') as f:
+        image_names = [line.replace('\n', '') for line in f.readlines()]
+
+    cached_stats = np.load(_sources_path(cache_dir, split))
+    stats = _source_stats(img_dir, image_names)
+    missing = stats[:, 0] < 0
+    stale = np.nonzero(np.any(stats != cached_stats, axis=1) & ~missing)[0]
+    if len(stale) > 0:
+        print('IMAGE CACHE', split, len(stale), 'changed images, decode them again')
+        arrays = [np.load(_array_path(cache_dir, split, size), mmap_mode='r+') for size in sizes]
+        for offset in stale:
+            for array, img in zip(arrays, decode_image(os.path.join(img_dir, image_names[offset]), sizes)):
+                array[offset] = img
+        for array in arrays:
+            array.flush()
+        cached_stats[stale] = stats[stale]
+        np.save(_sources_path(cache_dir, split), cached_stats)
+    return [image_names[offset] for offset in np.nonzero(missing)[0]]
+
+
+def get_image_cache(split):
+    """ The cache of a split, or None when caching is disabled or the cache is not built. The images whose file
+    changed since they were cached are decoded again, those whose file is missing are left out
+    """
+    if not FLAGS.use_image_cache:
+        return None
+    if split not in _opened_caches:
+        missing = None
+        if os.path.exists(_index_path(FLAGS.image_cache_dir, split)):
+            missing = refresh_image_cache(split, FLAGS.image_cache_dir)
+            if missing is None:
+                print('Image cache', split, 'in', FLAGS.image_cache_dir, 'has no source stats, rebuild it with '
+                      '`python image_cache.py`, decode from jpeg')
+        else:
+            print('No image cache for', split, 'in', FLAGS.image_cache_dir, ', decode from jpeg')
+        if missing is not None:
+            _opened_caches[split] = ImageCache(FLAGS.image_cache_dir, split)
+            for image_name in missing:
+                del _opened_caches[split].image2offset[image_name]
+            print('USE IMAGE CACHE', split, FLAGS.image_cache_dir)
+        else:
+            _opened_caches[split] = None
+    return _opened_caches[split]
+
+
+if __name__ == '__main__':
+    build_image_cache('train')
+    build_image_cache('test')
@@ -0,0 +1,158 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：tf.data input pipelines for training, latent attr extraction and testing with augmentation
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+from config import FLAGS
+from graph_augment import augment_images
+
+
+def decode_image(path, size):
+    """ Read and decode one image file, resized to (size, size, 3) uint8 RGB
+    """
+    img = tf.image.decode_jpeg(tf.read_file(path), channels=3)
+    img = tf.image.resize_images(img, [size, size])
+    return tf.cast(tf.round(img), tf.uint8)
+
+
+def normalize_images(images):
+    """ float32 images, divided by 255 with FLAGS.normalize
+    """
+    images = tf.to_float(images)
+    if FLAGS.normalize:
+        images = images / 255.0
+    return images
+
+
+def source_image_size():
+    """ Size the training images are decoded at, before the random crop
+    """
+    return FLAGS.size_before_crop if FLAGS.if_crop_augment else FLAGS.img_size
+
+
+def check_train_flags(pipeline='tf_data'):
+    """ Raise ValueError for the FLAGS the tf.data pipelines do not implement, instead of ignoring them
+    Args:
+        pipeline	: Name of the input pipeline in the message
+    """
+    if FLAGS.if_color_augment:
+        raise ValueError('if_color_augment is not implemented by the %s input pipeline, use the generator' % pipeline)
+    if FLAGS.batch_sampler != 'random':
+        raise ValueError('batch_sampler %s is not implemented by the %s input pipeline, use the generator'
+                         % (FLAGS.batch_sampler, pipeline))
+
+
+def build_train_dataset(image_names, num_labels, whole_attr_np, img_dir=FLAGS.img_dir, batch_size=FLAGS.batch_size,
+                        shuffle_buffer=FLAGS.shuffle_buffer):
+    """ Endless dataset of augmented training batches
+    Args:
+        image_names		: Names of the training images
+        num_labels		: Class index of every image
+        whole_attr_np	: (num_class, attribute_label_cnt) class attribute matrix
+        img_dir			: Directory containing the images
+        batch_size		: Number of images per batch
+        shuffle_buffer	: Size of the shuffle buffer, 0 to read in order
+    Returns:
+        tf.data.Dataset of (images, attribute_labels, num_labels)
+    """
+    check_train_flags('tf_data')
+    paths = [os.path.join(img_dir, name) for name in image_names]
+    dataset = tf.data.Dataset.from_tensor_slices((tf.constant(paths), tf.constant(np.asarray(num_labels, dtype=np.int32))))
+    if shuffle_buffer > 0:
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.repeat()
+
+    source_size = source_image_size()
+    dataset = dataset.map(lambda path, num_label: (decode_image(path, source_size), num_label),
+                          num_parallel_calls=FLAGS.data_parallel_calls)
+    dataset = dataset.batch(batch_size)
+
+    # augment whole batches, one transform op per batch
+    whole_attr = tf.constant(whole_attr_np[:, 0:FLAGS.attribute_label_cnt], dtype=tf.float32)
+
+    def augment_batch(images, batch_num_labels):
+        images = normalize_images(augment_images(images))
+        images.set_shape([None, FLAGS.img_size, FLAGS.img_size, FLAGS.img_depth])
+        attribute_labels = tf.gather(whole_attr, batch_num_labels)
+        return images, attribute_labels, batch_num_labels
+
+    dataset = dataset.map(augment_batch, num_parallel_calls=2)
+    return dataset.prefetch(FLAGS.prefetch_batches)
+
+
+def build_inference_dataset(image_names, img_dir, batch_size=FLAGS.batch_size_test):
+    """ Dataset of the images in order, resized to img_size without augmentation
+    Returns:
+        tf.data.Dataset of (names, images)
+    """
+    paths = [os.path.join(img_dir, name) for name in image_names]
+    dataset = tf.data.Dataset.from_tensor_slices((tf.constant(list(image_names)), tf.constant(paths)))
+    dataset = dataset.map(lambda name, path: (name, normalize_images(decode_image(path, FLAGS.img_size))),
+                          num_parallel_calls=FLAGS.data_parallel_calls)
+    dataset = dataset.batch(batch_size)
+    return dataset.prefetch(FLAGS.prefetch_batches)
+
+
+def build_test_aug_dataset(image_names, img_dir, aug_num=FLAGS.aug_num):
+    """ Dataset of aug_num augmented views per image, for testing with augmentation
+    Returns:
+        tf.data.Dataset of (name, images) with images of shape (aug_num, img_size, img_size, 3)
+    """
+    if FLAGS.if_color_augment:
+        raise ValueError('if_color_augment is not implemented by the tf_data input pipeline, use the generator')
+    paths = [os.path.join(img_dir, name) for name in image_names]
+    source_size = source_image_size()
+
+    def augment_views(name, path):
+        img = decode_image(path, source_size)
+        views = normalize_images(augment_images(tf.tile(tf.expand_dims(img, 0), [aug_num, 1, 1, 1])))
+        views.set_shape([aug_num, FLAGS.img_size, FLAGS.img_size, FLAGS.img_depth])
+        return name, views
+
+    dataset = tf.data.Dataset.from_tensor_slices((tf.constant(list(image_names)), tf.constant(paths)))
+    dataset = dataset.map(augment_views, num_parallel_calls=FLAGS.data_parallel_calls)
+    return dataset.prefetch(FLAGS.prefetch_batches)
+
+
+def benchmark_input_pipelines(num_batches=50):
+    """ Print the throughput of the python generator and of the tf.data pipeline on the same training data
+    """
+    from data_generator import DataGenerator
+    from parse_raw_data import load_catalog
+
+    dataset = DataGenerator(FLAGS.attrs_per_class_dir, FLAGS.img_dir, FLAGS.train_file)
+    dataset.generate_set(rand=True, validationRate=0.0)
+    whole_attr_np = load_catalog().class_attributes
+
+    generator = dataset.generator(batchSize=FLAGS.batch_size, norm=FLAGS.normalize, sample='train',
+                                  num_workers=FLAGS.num_data_workers, num_slots=FLAGS.data_ring_slots)
+    next(generator)
+    start_time = time.time()
+    for _ in range(num_batches):
+        next(generator)
+    generator_speed = num_batches * FLAGS.batch_size / (time.time() - start_time)
+    generator.close()
+
+    num_labels = dataset.num_labels[dataset.train_index]
+    with tf.Graph().as_default():
+        next_batch = build_train_dataset(dataset.train_set, num_labels, whole_attr_np).make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            sess.run(next_batch)
+            start_time = time.time()
+            for _ in range(num_batches):
+                sess.run(next_batch)
+            tf_data_speed = num_batches * FLAGS.batch_size / (time.time() - start_time)
+
+    print('generator (%d workers, %s backend): %.1f images/sec' %
+          (FLAGS.num_data_workers, FLAGS.augment_backend, generator_speed))
+    print('tf.data (%d parallel calls): %.1f images/sec' % (FLAGS.data_parallel_calls, tf_data_speed))
+
+
+if __name__ == '__main__':
+    benchmark_input_pipelines()
@@ -8,6 +8,7 @@ import tensorflow as tf
 
 from config import FLAGS
 from triplet_loss import *
+from resnet_recompute import recompute_optimizer
 
 
 def build_loss_softmax_with_score(logits, gt_onehot_labels, whole_attr_labels, variable_to_train=None, freeze=False, optimizer='Adam'):
@@ -222,8 +223,46 @@ def build_multi_loss_2(logits, gt_onehot_labels, whole_attr_labels, num_labels,
         return multi_loss, train_op
 
 
-def build_multi_loss_3(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared=False,
-                       triplet_strategy='batch_hard', optimizer='Adam', freeze=False, variable_to_train=None):
+def _sampled_softmax_loss_with_score(y_conv_softmax, num_labels, whole_attr_labels, num_sampled,
+                                     in_batch_negatives=False):
+    """ Compatibility softmax over the true class and a sample of negative classes instead of every class,
+    the cost per step does not depend on the number of classes
+    Args:
+        y_conv_softmax		: [batch, attribute_label_cnt] softmax half of the logits
+        num_labels			: [batch] class indexes
+        whole_attr_labels	: [num_class, attribute_label_cnt] class attributes, a graph constant or variable
+        num_sampled			: Negative classes drawn uniformly without replacement per step, shared by the batch
+        in_batch_negatives	: Also use the classes of the other images of the batch as negatives
+    Returns:
+        mean softmax cross entropy of the true class against the negatives
+    """
+    num_labels = tf.to_int32(num_labels)
+    num_class = whole_attr_labels.get_shape()[0].value or FLAGS.num_class
+
+    # uniform sampling: every class has the same expected count, so no log-probability correction is needed
+    sampled, _, _ = tf.nn.uniform_candidate_sampler(true_classes=tf.expand_dims(tf.to_int64(num_labels), 1),
+                                                    num_true=1, num_sampled=min(num_sampled, num_class), unique=True,
+                                                    range_max=num_class)
+    negative_classes = tf.to_int32(sampled)
+    if in_batch_negatives:
+        negative_classes, _ = tf.unique(tf.concat([negative_classes, num_labels], axis=0))
+
+    # (16,30) . (16,30) and (16,30) x (k,30).T, compatibility scores with the gathered class attributes only
+    true_score = tf.reduce_sum(y_conv_softmax * tf.gather(whole_attr_labels, num_labels), axis=1, keep_dims=True)
+    negative_scores = tf.matmul(y_conv_softmax, tf.gather(whole_attr_labels, negative_classes), transpose_b=True)
+
+    # a negative equal to the true class of the image is removed from its softmax
+    accidental_hits = tf.equal(tf.expand_dims(num_labels, 1), tf.expand_dims(negative_classes, 0))
+    negative_scores = tf.where(accidental_hits, tf.fill(tf.shape(negative_scores), -1e9), negative_scores)
+
+    scores = tf.concat([true_score, negative_scores], axis=1)
+    return tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=tf.zeros_like(num_labels), logits=scores))
+
+
+def _build_multi_loss_terms(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared=False,
+                            triplet_strategy='batch_hard', triplet_memory_size=0,
+                            softmax_strategy='full'):
     y_conv = tf.reshape(logits, [-1, 2 * FLAGS.attribute_label_cnt])
 
     y_conv_softmax = y_conv[:, 0:FLAGS.attribute_label_cnt]
@@ -232,15 +271,23 @@ def build_multi_loss_3(logits, gt_onehot_labels, whole_attr_labels, num_labels,
     print(y_conv, y_conv_softmax, y_conv_triplet)
 
     # build softmax loss
-    # (16,30) x (230,30).T output (16, 230), compatibility score
-    whole_inner_product = tf.matmul(y_conv_softmax, tf.transpose(whole_attr_labels))
-
     with tf.name_scope('softmax_loss_with_score'):
-        softmax_loss_with_score = tf.reduce_mean(
-            tf.nn.softmax_cross_entropy_with_logits(logits=whole_inner_product, labels=gt_onehot_labels))
+        if softmax_strategy == "full":
+            # (16,30) x (230,30).T output (16, 230), compatibility score
+            whole_inner_product = tf.matmul(y_conv_softmax, tf.transpose(whole_attr_labels))
+            softmax_loss_with_score = tf.reduce_mean(
+                tf.nn.softmax_cross_entropy_with_logits(logits=whole_inner_product, labels=gt_onehot_labels))
+        elif softmax_strategy == "sampled":
+            softmax_loss_with_score = _sampled_softmax_loss_with_score(y_conv_softmax, num_labels, whole_attr_labels,
+                                                                       FLAGS.softmax_num_sampled,
+                                                                       FLAGS.softmax_in_batch_negatives)
+        else:
+            raise ValueError("Softmax strategy not recognized: {}".format(softmax_strategy))
         tf.summary.scalar('softmax_loss_with_score', softmax_loss_with_score)
 
     # Define triplet loss
+    if triplet_memory_size > 0 and triplet_strategy != "batch_hard":
+        raise ValueError("triplet_memory_size is only used by batch_hard, not {}".format(triplet_strategy))
     with tf.name_scope('triplet_loss'):
         if triplet_strategy == "batch_all":
             triplet_loss, fraction = batch_all_triplet_loss(labels=num_labels,
@@ -248,6 +295,22 @@ def build_multi_loss_3(logits, gt_onehot_labels, whole_attr_labels, num_labels,
                                                             margin=margin,
                                                             squared=squared)
             tf.summary.scalar('triplet_loss', triplet_loss)
+        elif triplet_strategy == "batch_all_chunked":
+            # batch_all with O(batch_size^2) memory, see batch_all_triplet_loss_chunked
+            triplet_loss, fraction = batch_all_triplet_loss_chunked(labels=num_labels,
+                                                                    embeddings=y_conv_triplet,
+                                                                    margin=margin,
+                                                                    squared=squared,
+                                                                    chunk_size=FLAGS.triplet_chunk_size)
+            tf.summary.scalar('triplet_loss', triplet_loss)
+        elif triplet_strategy == "batch_hard" and triplet_memory_size > 0:
+            # hardest positive and negative mined in the batch and the embeddings of the last batches
+            triplet_loss = batch_hard_triplet_loss_with_memory(labels=num_labels,
+                                                               embeddings=y_conv_triplet,
+                                                               margin=margin,
+                                                               squared=squared,
+                                                               memory_size=triplet_memory_size)
+            tf.summary.scalar('triplet_loss', triplet_loss)
         elif triplet_strategy == "batch_hard":
             triplet_loss = batch_hard_triplet_loss(labels=num_labels,
                                                    embeddings=y_conv_triplet,
@@ -260,23 +323,195 @@ def build_multi_loss_3(logits, gt_onehot_labels, whole_attr_labels, num_labels,
     with tf.name_scope('multi_loss'):
         multi_loss = softmax_loss_with_score + triplet_loss
         tf.summary.scalar('multi_loss', multi_loss)
+    return multi_loss, softmax_loss_with_score, triplet_loss
 
-    with tf.variable_scope('train_multi_loss'):
-        global_step = tf.train.get_or_create_global_step()
 
-        lr = tf.train.exponential_decay(FLAGS.learning_rate,
-                                        global_step=global_step,
-                                        decay_rate=FLAGS.lr_decay_rate,
-                                        decay_steps=FLAGS.lr_decay_step)
-        tf.summary.scalar('learning_rate_multi', lr)
+def _multi_loss_learning_rate():
+    global_step = tf.train.get_or_create_global_step()
+
+    lr = tf.train.exponential_decay(FLAGS.learning_rate,
+                                    global_step=global_step,
+                                    decay_rate=FLAGS.lr_decay_rate,
+                                    decay_steps=FLAGS.lr_decay_step)
+    tf.summary.scalar('learning_rate_multi', lr)
+    return global_step, lr
 
+
+def build_multi_loss_3(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared=False,
+                       triplet_strategy='batch_hard', optimizer='Adam', freeze=False, variable_to_train=None):
+    multi_loss, _, _ = _build_multi_loss_terms(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared,
+                                               triplet_strategy, FLAGS.triplet_memory_size, FLAGS.softmax_strategy)
+
+    with tf.variable_scope('train_multi_loss'):
+        global_step, lr = _multi_loss_learning_rate()
+
+        # with resnet_v2_50_recompute the backbone activations are recomputed in the backward pass
         if freeze:
-            optimizer_2 = tf.train.AdamOptimizer(lr)
+            optimizer_2 = recompute_optimizer(tf.train.AdamOptimizer(lr))
             train_op = tf.contrib.slim.learning.create_train_op(multi_loss, optimizer_2,
                                                                 variables_to_train=variable_to_train)
         else:
             train_op = tf.contrib.layers.optimize_loss(loss=multi_loss,
                                                        global_step=global_step,
                                                        learning_rate=lr,
-                                                       optimizer=optimizer)
-        return multi_loss, train_op
\ No newline at end of file
+                                                       optimizer=recompute_optimizer(optimizer))
+        return multi_loss, train_op
+
+
+def build_multi_loss_3_data_parallel(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared=False,
+                                     triplet_strategy='batch_hard', variable_to_train=None):
+    """ build_multi_loss_3 with the gradient computation and the update split in two,
+    so that the gradients can be averaged across workers between them (see distributed.py)
+    Returns:
+        multi_loss		: Loss of the local batch
+        gradients		: Gradient tensors of the local batch, running them also runs the batch norm
+        				  and triplet memory updates
+        grad_placeholders	: Placeholders to feed the averaged gradients into, same order as gradients
+        apply_op		: Adam update from the fed gradients, increments the global step
+    """
+    multi_loss, _, _ = _build_multi_loss_terms(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared,
+                                               triplet_strategy, FLAGS.triplet_memory_size, FLAGS.softmax_strategy)
+
+    with tf.variable_scope('train_multi_loss'):
+        global_step, lr = _multi_loss_learning_rate()
+        optimizer = recompute_optimizer(tf.train.AdamOptimizer(lr))
+
+        # same as optimize_loss, the batch norm moving averages are updated with the loss
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        with tf.control_dependencies(update_ops):
+            loss_with_updates = tf.identity(multi_loss)
+
+        if variable_to_train is None:
+            variable_to_train = tf.trainable_variables()
+        grads_and_vars = [(grad, var) for grad, var in optimizer.compute_gradients(loss_with_updates, variable_to_train)
+                          if grad is not None]
+        gradients = [tf.convert_to_tensor(grad) for grad, _ in grads_and_vars]
+        grad_placeholders = [tf.placeholder(dtype=tf.float32, shape=var.get_shape()) for _, var in grads_and_vars]
+        apply_op = optimizer.apply_gradients([(placeholder, var) for placeholder, (_, var)
+                                              in zip(grad_placeholders, grads_and_vars)], global_step=global_step)
+        return multi_loss, gradients, grad_placeholders, apply_op
+
+
+def build_multi_loss_3_accumulate(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared=False,
+                                  triplet_strategy='batch_hard', accumulate_steps=FLAGS.accumulate_steps,
+                                  variable_to_train=None):
+    """ build_multi_loss_3 with the gradients of accumulate_steps micro-batches summed in accumulator variables
+    before one Adam update, the global step and so the learning rate schedule count the updates.
+    The triplets are mined in each micro-batch, and in the earlier micro-batches of the step too with
+    triplet_memory_size >= (accumulate_steps - 1) * micro-batch size, their embeddings are computed with
+    the same weights
+    Returns:
+        multi_loss		: Loss of the micro-batch
+        accumulate_op	: Adds the gradients of the micro-batch to the accumulators, runs the batch norm
+        				  and triplet memory updates
+        apply_op		: Adam update with the mean of the accumulated gradients, increments the global step
+        				  and resets the accumulators
+    """
+    multi_loss, _, _ = _build_multi_loss_terms(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared,
+                                               triplet_strategy, FLAGS.triplet_memory_size, FLAGS.softmax_strategy)
+
+    with tf.variable_scope('train_multi_loss'):
+        global_step, lr = _multi_loss_learning_rate()
+        optimizer = recompute_optimizer(tf.train.AdamOptimizer(lr))
+
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        with tf.control_dependencies(update_ops):
+            loss_with_updates = tf.identity(multi_loss)
+
+        if variable_to_train is None:
+            variable_to_train = tf.trainable_variables()
+        grads_and_vars = [(grad, var) for grad, var in optimizer.compute_gradients(loss_with_updates, variable_to_train)
+                          if grad is not None]
+
+        # local variables: not checkpointed, a resumed run starts a new accumulation
+        with tf.variable_scope('accumulators'):
+            accumulators = [tf.get_variable(var.op.name, var.get_shape(), var.dtype.base_dtype,
+                                            initializer=tf.zeros_initializer(), trainable=False,
+                                            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                            for _, var in grads_and_vars]
+        accumulate_op = tf.group(*[tf.assign_add(accumulator, grad)
+                                   for accumulator, (grad, _) in zip(accumulators, grads_and_vars)])
+
+        apply = optimizer.apply_gradients([(accumulator / accumulate_steps, var) for accumulator, (_, var)
+                                           in zip(accumulators, grads_and_vars)], global_step=global_step)
+        with tf.control_dependencies([apply]):
+            apply_op = tf.group(*[tf.assign(accumulator, tf.zeros_like(accumulator)) for accumulator in accumulators])
+        return multi_loss, accumulate_op, apply_op
+
+
+def unfreeze_stages(unfreeze_schedule, backbone_scope='resnet_v2_50'):
+    """ Variables to train of every stage of a progressive unfreezing schedule
+    Args:
+        unfreeze_schedule	: [(first global step, [scopes unfrozen at that step])], see FLAGS.unfreeze_schedule
+        backbone_scope		: Variables outside it (the fully_connected head) are trained at every stage
+    Returns:
+        [(first global step, variables to train)], sorted by step, the scopes of the earlier stages stay unfrozen
+    """
+    stages = []
+    scopes = []
+    for first_step, stage_scopes in sorted(unfreeze_schedule, key=lambda stage: stage[0]):
+        scopes = scopes + [scope.rstrip('/') + '/' for scope in stage_scopes]
+        variables = [var for var in tf.trainable_variables()
+                     if not var.op.name.startswith(backbone_scope + '/')
+                     or any(var.op.name.startswith(scope) for scope in scopes)]
+        stages.append((first_step, variables))
+    return stages
+
+
+def unfreeze_stage_index(stages, global_step):
+    """ Index of the stage of unfreeze_stages trained at global_step
+    """
+    index = 0
+    for i, (first_step, _) in enumerate(stages):
+        if global_step >= first_step:
+            index = i
+    return index
+
+
+def build_multi_loss_3_unfreeze(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared=False,
+                                triplet_strategy='batch_hard', stages=None):
+    """ build_multi_loss_3 with one train op per unfreezing stage, each computing the gradients of its variables
+    to train only, so no gradient is computed below the lowest unfrozen block.
+    The variables unfrozen at each stage get their own Adam optimizer: its moments and its beta1/beta2 powers
+    start at the first step of the stage, so the bias correction of a newly unfrozen block starts from its own
+    step 1 instead of the global step. The stages share the global step and the learning rate schedule
+    Args:
+        stages	: unfreeze_stages(FLAGS.unfreeze_schedule)
+    Returns:
+        multi_loss	: Loss of the batch
+        train_ops	: Train op of every stage, same order as stages, returning the loss like create_train_op
+    """
+    multi_loss, _, _ = _build_multi_loss_terms(logits, gt_onehot_labels, whole_attr_labels, num_labels, margin, squared,
+                                               triplet_strategy, FLAGS.triplet_memory_size, FLAGS.softmax_strategy)
+
+    with tf.variable_scope('train_multi_loss'):
+        global_step, lr = _multi_loss_learning_rate()
+        # variables first trained at every stage, each group with its own Adam, stage 0 keeps the usual slot names
+        groups = []
+        trained = set()
+        for _, variables in stages:
+            groups.append([var for var in variables if var not in trained])
+            trained.update(variables)
+        optimizers = [tf.train.AdamOptimizer(lr, name='Adam' if i == 0 else 'Adam_stage_%d' % i)
+                      for i in range(len(stages))]
+        gradient_optimizer = recompute_optimizer(optimizers[0])
+
+        # batch norm statistics are updated with every step, as in create_train_op
+        with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+            loss_with_updates = tf.identity(multi_loss)
+
+        train_ops = []
+        for stage, (_, variables) in enumerate(stages):
+            grads_and_vars = gradient_optimizer.compute_gradients(loss_with_updates, variables)
+            grads_and_vars = [(grad, var) for grad, var in grads_and_vars if grad is not None]
+            apply_ops = []
+            for group, optimizer in zip(groups[:stage + 1], optimizers):
+                group = set(group)
+                group_grads_and_vars = [(grad, var) for grad, var in grads_and_vars if var in group]
+                if group_grads_and_vars:
+                    apply_ops.append(optimizer.apply_gradients(group_grads_and_vars))
+            with tf.control_dependencies(apply_ops):
+                increment = tf.assign_add(global_step, 1)
+            with tf.control_dependencies([increment]):
+                train_ops.append(tf.identity(loss_with_updates, name='train_op_stage_%d' % stage))
+        return multi_loss, train_ops
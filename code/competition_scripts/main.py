@@ -4,19 +4,29 @@
 # Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
 
 
-from train_ldf import train_multi
-from extract_pred_latent_attr import extract_pred_latent_attr
-from train_seen_to_unseen_attr_regression import train_seen_to_useen_attr_regression
-from determine_gt_attr_with_latent import determine_gt_attr_with_latent
-from test_one_with_aug import test_one_with_aug_multi
 from config import FLAGS
 
 
+# the stages are imported when they run, so each run only loads the modules it needs
 if __name__ == '__main__':
-    if FLAGS.is_train:
+    if FLAGS.is_train and FLAGS.train_head_on_cached_features:
+        from feature_cache import extract_backbone_features, train_head_on_features, is_cache_current
+        # extracted again once train_multi saved a newer backbone checkpoint
+        if not is_cache_current():
+            extract_backbone_features()
+        train_head_on_features()
+    elif FLAGS.is_train and FLAGS.dp_num_workers * FLAGS.dp_num_nodes > 1:
+        from distributed import launch
+        launch()
+    elif FLAGS.is_train:
+        from train_ldf import train_multi
         train_multi()
     else:
+        from extract_pred_latent_attr import extract_pred_latent_attr
         extract_pred_latent_attr()
+        from train_seen_to_unseen_attr_regression import train_seen_to_useen_attr_regression
         train_seen_to_useen_attr_regression()
+        from determine_gt_attr_with_latent import determine_gt_attr_with_latent
         determine_gt_attr_with_latent()
+        from test_one_with_aug import test_one_with_aug_multi
         test_one_with_aug_multi()
\ No newline at end of file
@@ -4,10 +4,10 @@
 # Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
 
 
+import os
+import pickle
+import hashlib
 import numpy as np
-from sklearn import preprocessing
-import tensorflow as tf
-import cv2
 
 from config import FLAGS
 
@@ -122,6 +122,7 @@ def parse_repre_label2one_hot_map(filepath):
     whole_attr_np = np.array(whole_attr_list)
     print('whole attr np:', whole_attr_np)
 
+    from sklearn import preprocessing
     onehot_encoder = preprocessing.OneHotEncoder(sparse=False)
     integer_encodes = integer_encodes.reshape(len(integer_encodes), 1)
     onehot_encodes = onehot_encoder.fit_transform(integer_encodes)
@@ -136,7 +137,131 @@ def parse_repre_label2one_hot_map(filepath):
     return class_represent_list, whole_attr_np, repre_label2one_hot_map
 
 
+class Catalog(object):
+    """
+    Every text file of the dataset parsed once, classes are ordered as in attributes_per_class.txt (num_label)
+    """
+    def __init__(self, attrs_per_class_dir=FLAGS.attrs_per_class_dir, train_file=FLAGS.train_file,
+                 test_file=FLAGS.test_file, label_list=FLAGS.label_list, class_wordembeddings=FLAGS.class_wordembeddings):
+        """Initializer
+            Args:
+            attrs_per_class_dir		: Attributes per class
+            train_file				: Text file with image name and class label per line
+            test_file				: Text file with a test image name per line, skipped when missing
+            label_list				: Class label to true label, skipped when missing
+            class_wordembeddings	: Word embedding per true label, skipped when missing
+        """
+        # classes
+        self.class_list = []
+        class_attributes = []
+        with open(attrs_per_class_dir, 'r') as f:
+            for line in f.readlines():
+                items = line.replace('\n', '').split('	')
+                self.class_list.append(items[0])
+                class_attributes.append([float(item) for item in items[1:]])
+        self.class2num_label = dict((class_label, i) for i, class_label in enumerate(self.class_list))
+        self.class_attributes = np.array(class_attributes, dtype=np.float32)  # (num_class, attribute cnt)
+
+        # train images and their class index
+        train_images = []
+        train_num_labels = []
+        with open(train_file, 'r') as f:
+            for line in f.readlines():
+                items = line.replace('\n', '').split('	')
+                train_images.append(items[0])
+                train_num_labels.append(self.class2num_label[items[1]])
+        self.train_images = np.array(train_images)
+        self.train_num_labels = np.array(train_num_labels, dtype=np.int32)
+
+        # seen classes have train images, both index arrays are in num_label order
+        seen = np.zeros(len(self.class_list), dtype=np.bool_)
+        seen[self.train_num_labels] = True
+        self.seen_class_index = np.nonzero(seen)[0].astype(np.int32)
+        self.unseen_class_index = np.nonzero(~seen)[0].astype(np.int32)
+
+        self.test_images = parse_test_image_list(test_file) if os.path.exists(test_file) else []
+
+        # true labels and word embeddings, aligned with class_list
+        self.true_labels = None
+        self.word_embeddings = None
+        if os.path.exists(label_list):
+            represent_label2true_label = parse_represent_label2true_label_map(label_list)
+            self.true_labels = [represent_label2true_label[class_label] for class_label in self.class_list]
+            if os.path.exists(class_wordembeddings):
+                word_embedding_per_class = parse_word_embedding_per_class(class_wordembeddings)
+                self.word_embeddings = np.array([word_embedding_per_class[true_label] for true_label in self.true_labels],
+                                                dtype=np.float32)
+
+    def seen_classes(self):
+        return [self.class_list[i] for i in self.seen_class_index]
+
+    def unseen_classes(self):
+        return [self.class_list[i] for i in self.unseen_class_index]
+
+    def train_image2represent_label(self):
+        return dict(zip(self.train_images, [self.class_list[i] for i in self.train_num_labels]))
+
+    def images_of_class(self, num_label):
+        return self.train_images[self.train_num_labels == num_label]
+
+
+_CATALOG_CACHE_VERSION = 1
+_loaded_catalogs = {}
+
+
+def _source_signature(paths):
+    """ (path, mtime, size) of every source file, None for missing files
+    """
+    signature = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append((os.path.abspath(path), stat.st_mtime, stat.st_size))
+        else:
+            signature.append((os.path.abspath(path), None, None))
+    return signature
+
+
+def load_catalog(attrs_per_class_dir=FLAGS.attrs_per_class_dir, train_file=FLAGS.train_file, test_file=FLAGS.test_file,
+                 label_list=FLAGS.label_list, class_wordembeddings=FLAGS.class_wordembeddings,
+                 cache_dir=FLAGS.catalog_cache_dir):
+    """ The Catalog of these files, from the binary cache while none of them changed
+    Args:
+        See Args section in Catalog
+        cache_dir	: Directory of the pickled catalogs, None to always parse
+    """
+    paths = [attrs_per_class_dir, train_file, test_file, label_list, class_wordembeddings]
+    signature = [_CATALOG_CACHE_VERSION] + _source_signature(paths)
+    key = hashlib.md5(repr([os.path.abspath(path) for path in paths]).encode('utf-8')).hexdigest()
+    if key in _loaded_catalogs and _loaded_catalogs[key][0] == signature:
+        return _loaded_catalogs[key][1]
+
+    cache_path = os.path.join(cache_dir, 'catalog_{}.pkl'.format(key)) if cache_dir else None
+    catalog = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_signature, cached_catalog = pickle.load(f)
+            if cached_signature == signature:
+                catalog = cached_catalog
+        except Exception as e:
+            print('Can not read catalog cache', cache_path, e)
+
+    if catalog is None:
+        catalog = Catalog(*paths)
+        if cache_path:
+            os.system('mkdir -p {}'.format(cache_dir))
+            with open(cache_path + '.tmp', 'wb') as f:
+                pickle.dump((signature, catalog), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(cache_path + '.tmp', cache_path)
+            print('CATALOG CACHE WRITTEN', cache_path)
+
+    _loaded_catalogs[key] = (signature, catalog)
+    return catalog
+
+
 def read_single_sample(tfrecord_file):
+    import tensorflow as tf
     queue = tf.train.string_input_producer([tfrecord_file], shuffle=True, num_epochs=FLAGS.training_epoch)
     reader = tf.TFRecordReader()
     _, serialized_example = reader.read(queue)
@@ -152,6 +277,8 @@ def read_single_sample(tfrecord_file):
 
 
 def tmp_test():
+    import tensorflow as tf
+    import cv2
     '''
     train_image2represent_label_map_filepath = '../../data/DatasetA_train_20180813/train.txt'
     train_image2represent_label_map = parse_train_image2represent_label_map(train_image2represent_label_map_filepath)
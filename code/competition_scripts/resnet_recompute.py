@@ -0,0 +1,297 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：resnet_v2_50 with activation recomputation, only the outputs of the root block and of every
+#                bottleneck unit are kept for the backward pass, the activations inside them are recomputed
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import sys
+import json
+import time
+import weakref
+import resource
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib.slim.python.slim.nets import resnet_v2
+from tensorflow.contrib.slim.python.slim.nets import resnet_utils
+slim = tf.contrib.slim
+
+from config import FLAGS
+
+
+# segments of the recompute networks of each graph, read by RecomputeOptimizer
+_graph_segments = weakref.WeakKeyDictionary()
+
+
+class _Segment(object):
+    """
+    Part of the network between two kept activations, with what is needed to build it again
+    """
+    def __init__(self, scope, build_fn, inputs, outputs, variables):
+        self.scope = scope
+        self.build_fn = build_fn
+        self.inputs = inputs
+        self.outputs = outputs
+        self.variables = variables
+
+    def rebuild(self, inputs):
+        """ Same ops on inputs with the same variables, the batch norm updates are not added again
+        """
+        update_ops = tf.get_collection_ref(tf.GraphKeys.UPDATE_OPS)
+        kept_update_ops = list(update_ops)
+        with tf.variable_scope(self.scope, reuse=True):
+            outputs = self.build_fn(inputs)
+        update_ops[:] = kept_update_ops
+        return outputs
+
+
+def _build_segment(segments, scope, build_fn, inputs):
+    """ build_fn(inputs) in variable scope scope (a name or a VariableScope), kept as a segment
+    """
+    variables_before = set(tf.trainable_variables())
+    with tf.variable_scope(scope) as segment_scope:
+        outputs = build_fn(inputs)
+    variables = [var for var in tf.trainable_variables() if var not in variables_before]
+    segments.append(_Segment(segment_scope, build_fn, inputs, outputs, variables))
+    return outputs
+
+
+def graph_segments(graph=None):
+    """ Segments of the recompute networks built in graph, input side first
+    """
+    return _graph_segments.get(graph or tf.get_default_graph(), [])
+
+
+def resnet_v2_50_recompute(inputs, is_training=True, reuse=None, scope='resnet_v2_50'):
+    """ resnet_v2.resnet_v2_50 with num_classes=None and the same variable names, so the checkpoints are shared,
+    built one bottleneck unit at a time and registered for RecomputeOptimizer
+    Args:
+        inputs		: [batch, height, width, 3] images
+        is_training	: Python bool or bool tensor of the batch norms
+    Returns:
+        net			: [batch, 1, 1, 2048] pooled feature
+        end_points	: Kept activations by scope name
+    """
+    blocks = [resnet_v2.resnet_v2_block('block1', base_depth=64, num_units=3, stride=2),
+              resnet_v2.resnet_v2_block('block2', base_depth=128, num_units=4, stride=2),
+              resnet_v2.resnet_v2_block('block3', base_depth=256, num_units=6, stride=2),
+              resnet_v2.resnet_v2_block('block4', base_depth=512, num_units=3, stride=1)]
+    segments = []
+    end_points = {}
+
+    def root_block(net):
+        with slim.arg_scope([slim.batch_norm], is_training=is_training):
+            with slim.arg_scope([slim.conv2d], activation_fn=None, normalizer_fn=None):
+                net = resnet_utils.conv2d_same(net, 64, 7, stride=2, scope='conv1')
+            return slim.max_pool2d(net, [3, 3], stride=2, scope='pool1')
+
+    def bottleneck_unit(block, unit):
+        def build(net):
+            with slim.arg_scope([slim.batch_norm], is_training=is_training):
+                return block.unit_fn(net, rate=1, **unit)
+        return build
+
+    # same scopes as resnet_v2.resnet_v2 and resnet_utils.stack_blocks_dense
+    with tf.variable_scope(scope, 'resnet_v2', [inputs], reuse=reuse) as sc:
+        net = _build_segment(segments, sc, root_block, inputs)
+        end_points[sc.name + '/pool1'] = net
+        for block in blocks:
+            with tf.variable_scope(block.scope, 'block', [net]):
+                for i, unit in enumerate(block.args):
+                    net = _build_segment(segments, 'unit_%d' % (i + 1), bottleneck_unit(block, unit), net)
+                    end_points[segments[-1].scope.name] = net
+        # postnorm and the pooling are short, they are kept with the head
+        with slim.arg_scope([slim.batch_norm], is_training=is_training):
+            net = slim.batch_norm(net, activation_fn=tf.nn.relu, scope='postnorm')
+        net = tf.reduce_mean(net, [1, 2], name='pool5', keep_dims=True)
+        end_points[sc.name + '/global_pool'] = net
+
+    # one recompute network per graph, the last one built is the one trained
+    _graph_segments[tf.get_default_graph()] = segments
+    return net, end_points
+
+
+class RecomputeOptimizer(tf.train.Optimizer):
+    """
+    Optimizer whose gradients go through the recompute segments one at a time, from the last one: the segment
+    is built again from its kept input once the gradient of its output is known, differentiated, and its
+    activations are freed before the previous segment is built. The update is the one of the wrapped optimizer.
+    """
+    def __init__(self, optimizer, segments=None, name='Recompute'):
+        """Initializer
+            Args:
+            optimizer	: tf.train.Optimizer applying the gradients
+            segments	: Segments of resnet_v2_50_recompute, default those of the default graph
+        """
+        super(RecomputeOptimizer, self).__init__(use_locking=False, name=name)
+        self.optimizer = optimizer
+        self.segments = segments if segments is not None else graph_segments()
+
+    def compute_gradients(self, loss, var_list=None, gate_gradients=tf.train.Optimizer.GATE_OP,
+                          aggregation_method=None, colocate_gradients_with_ops=False, grad_loss=None):
+        if var_list is None:
+            var_list = tf.trainable_variables()
+        var_list = list(var_list)
+        gradient_of = {}
+
+        # the segments below the lowest one with a trained variable are neither recomputed nor differentiated
+        var_set = set(var_list)
+        trained = [i for i, segment in enumerate(self.segments) if any(var in var_set for var in segment.variables)]
+        lowest = trained[0] if trained else len(self.segments)
+        segments = self.segments[lowest:]
+
+        # the head (and every variable outside the segments) is differentiated as usual, down to the last kept output
+        segment_variables = set(var for segment in self.segments for var in segment.variables)
+        head_variables = [var for var in var_list if var not in segment_variables]
+        outputs = [segments[-1].outputs] if segments else []
+        gradients = tf.gradients(loss, outputs + head_variables, grad_ys=grad_loss,
+                                 aggregation_method=aggregation_method,
+                                 colocate_gradients_with_ops=colocate_gradients_with_ops)
+        output_gradient = gradients[0] if segments else None
+        gradient_of.update(zip(head_variables, gradients[len(outputs):]))
+        dependencies = [output_gradient]
+
+        for segment in reversed(segments):
+            if output_gradient is None:
+                break
+            # the recomputation starts once every gradient of the segment above exists: its weight gradients
+            # are off the critical path, without them the scheduler keeps several recomputed segments alive
+            with tf.control_dependencies(dependencies):
+                inputs = tf.identity(tf.stop_gradient(segment.inputs))
+            outputs = segment.rebuild(inputs)
+            variables = [var for var in segment.variables if var in var_set]
+            # the input of the lowest segment, the images or a frozen activation, is not differentiated
+            first = segment is segments[0]
+            gradients = tf.gradients(outputs, ([] if first else [inputs]) + variables, grad_ys=output_gradient,
+                                     aggregation_method=aggregation_method,
+                                     colocate_gradients_with_ops=colocate_gradients_with_ops)
+            output_gradient = None if first else gradients[0]
+            gradient_of.update(zip(variables, gradients[0 if first else 1:]))
+            dependencies = [gradient for gradient in gradients if gradient is not None]
+
+        return [(gradient_of.get(var), var) for var in var_list]
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        return self.optimizer.apply_gradients(grads_and_vars, global_step=global_step, name=name)
+
+    def get_slot(self, var, name):
+        return self.optimizer.get_slot(var, name)
+
+    def get_slot_names(self):
+        return self.optimizer.get_slot_names()
+
+
+def recompute_optimizer(optimizer):
+    """ optimizer unchanged when no recompute network is built in the default graph, otherwise it wrapped
+    in a RecomputeOptimizer
+    Args:
+        optimizer	: tf.train.Optimizer, or name / function of the learning rate as taken by optimize_loss
+    """
+    if not graph_segments():
+        return optimizer
+    if isinstance(optimizer, tf.train.Optimizer):
+        return RecomputeOptimizer(optimizer)
+    if isinstance(optimizer, str):
+        optimizer = tf.contrib.layers.OPTIMIZER_CLS_NAMES[optimizer]
+    return lambda lr: RecomputeOptimizer(optimizer(lr))
+
+
+STRATEGIES = ['stored', 'recompute']
+
+
+def run_one(strategy, batch_size, repeats=5):
+    """ Training step of resnet_v2_50 and the LDF head, printed as json with the mean step time and the peak rss
+    """
+    import loss as model
+
+    rng = np.random.RandomState(0)
+    images_np = rng.uniform(size=(batch_size, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth)).astype(np.float32)
+    labels_np = rng.randint(0, max(2, batch_size // 4), batch_size).astype(np.int32)
+    whole_attr_np = rng.normal(size=(FLAGS.num_class, FLAGS.attribute_label_cnt)).astype(np.float32)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tf.Graph().as_default():
+        images = tf.constant(images_np)
+        labels = tf.constant(labels_np)
+        if strategy == 'recompute':
+            feature, _ = resnet_v2_50_recompute(images, is_training=True)
+        else:
+            feature, _ = resnet_v2.resnet_v2_50(images, num_classes=None, is_training=True)
+        logits = slim.fully_connected(tf.squeeze(feature, axis=[1, 2]), num_outputs=2 * FLAGS.attribute_label_cnt,
+                                      activation_fn=None)
+        loss, train = model.build_multi_loss_3(logits, tf.one_hot(labels, FLAGS.num_class), tf.constant(whole_attr_np),
+                                               labels, FLAGS.margin, FLAGS.squared, FLAGS.triplet_strategy)
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+            sess.run(train)
+            start_time = time.time()
+            for _ in range(repeats):
+                sess.run(train)
+            step_time = (time.time() - start_time) / repeats
+    # ru_maxrss is in kilobytes on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'time': step_time, 'peak_mb': rss / 1024.0, 'graph_mb': (rss - rss_before) / 1024.0}))
+
+
+def check_gradients(batch_size=4):
+    """ Largest difference between the gradients of RecomputeOptimizer and tf.gradients, in one graph
+    """
+    import loss as model
+
+    rng = np.random.RandomState(0)
+    with tf.Graph().as_default():
+        images = tf.constant(rng.uniform(size=(batch_size, FLAGS.img_height, FLAGS.img_width,
+                                               FLAGS.img_depth)).astype(np.float32))
+        labels = tf.constant(np.arange(batch_size, dtype=np.int32) // 2)
+        feature, _ = resnet_v2_50_recompute(images, is_training=True)
+        logits = slim.fully_connected(tf.squeeze(feature, axis=[1, 2]), num_outputs=2 * FLAGS.attribute_label_cnt,
+                                      activation_fn=None)
+        whole_attr = tf.constant(rng.normal(size=(FLAGS.num_class, FLAGS.attribute_label_cnt)).astype(np.float32))
+        loss, _, _ = model._build_multi_loss_terms(logits, tf.one_hot(labels, FLAGS.num_class), whole_attr, labels,
+                                                   FLAGS.margin, FLAGS.squared, FLAGS.triplet_strategy)
+        variables = tf.trainable_variables()
+        stored = tf.gradients(loss, variables)
+        recomputed = [grad for grad, _ in RecomputeOptimizer(tf.train.AdamOptimizer()).compute_gradients(loss, variables)]
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+            stored_np, recomputed_np = sess.run([stored, recomputed])
+    return max(float(np.max(np.abs(a - b))) for a, b in zip(stored_np, recomputed_np))
+
+
+def compare(batch_sizes=(64, 128, 256), repeats=5):
+    """ Run both strategies at every batch size, each in its own process, and print the comparison table
+    """
+    print('max gradient difference, recompute against stored activations: %.2e' % check_gradients())
+    print('%-10s %6s %12s %12s %14s' % ('strategy', 'batch', 'step s', 'peak MB', 'extra peak MB'))
+    for batch_size in batch_sizes:
+        for strategy in STRATEGIES:
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', strategy,
+                                        '--batch_size', str(batch_size), '--repeats', str(repeats)],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            stdout, _ = process.communicate()
+            lines = [line for line in stdout.splitlines() if line.startswith('{')]
+            if process.returncode != 0 or not lines:
+                print('%-10s %6d %12s' % (strategy, batch_size, 'failed (out of memory?)'))
+                continue
+            result = json.loads(lines[-1])
+            print('%-10s %6d %12.2f %12.1f %14.1f' % (strategy, batch_size, result['time'], result['peak_mb'],
+                                                      result['graph_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='resnet_v2_50 training step with stored against recomputed activations')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--run', choices=STRATEGIES, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--batch_size', type=int, default=64, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # run the imported module: loss.py reads the recompute segments of resnet_recompute, not of this __main__ copy
+    import resnet_recompute
+    if args.run is not None:
+        resnet_recompute.run_one(args.run, args.batch_size, args.repeats)
+    else:
+        resnet_recompute.compare(args.batch_sizes, args.repeats)
@@ -0,0 +1,92 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：progressive-resolution training, the train images grow from a small size to img_size at set epochs,
+#                with the epoch times of every resolution and the time saved against the full resolution
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import time
+import collections
+import numpy as np
+
+from config import FLAGS
+
+
+class ResolutionSchedule(object):
+    """
+    Train image size (and size before crop) of every epoch, set on the data generator, and the wall-clock
+    time of the epochs of each size. FLAGS keep the configured resolution for every other reader
+    """
+    def __init__(self, stages=None):
+        """Initializer
+            Args:
+            stages	: [(first epoch, img_size, size_before_crop)], default FLAGS.resolution_schedule,
+            		  empty to train at img_size from the first epoch
+        """
+        stages = FLAGS.resolution_schedule if stages is None else stages
+        # the configured resolution, the last stage of every schedule
+        self.full_resolution = (FLAGS.img_size, FLAGS.size_before_crop)
+        self.stages = sorted(tuple(stage) for stage in stages) if stages else [(0, FLAGS.img_size, FLAGS.size_before_crop)]
+        if self.stages[0][0] != 0:
+            self.stages.insert(0, (0,) + self.full_resolution)
+        self.epoch_seconds = collections.OrderedDict()
+        self._epoch_start_time = None
+
+    def resolution(self, epoch):
+        """ (img_size, size_before_crop) of epoch, 0-based
+        """
+        resolution = self.stages[0][1:]
+        for first_epoch, img_size, size_before_crop in self.stages:
+            if epoch >= first_epoch:
+                resolution = (img_size, size_before_crop)
+        return resolution
+
+    def is_progressive(self):
+        return any(stage[1:] != self.full_resolution for stage in self.stages)
+
+    def max_img_size(self):
+        return max(stage[1] for stage in self.stages)
+
+    def apply(self, resolution, dataset):
+        """ Set resolution on the dataset in the parent process, the pool workers pick it up with their next batch
+        Args:
+            dataset	: DataGenerator building the training batches
+        """
+        dataset.set_resolution(resolution)
+
+    def start_epoch(self):
+        self._epoch_start_time = time.time()
+
+    def end_epoch(self, epoch):
+        """ Time of epoch, kept with the epochs of the same size, and the report line
+        """
+        resolution = self.resolution(epoch)
+        self.epoch_seconds.setdefault(resolution, []).append(time.time() - self._epoch_start_time)
+        return self.report(resolution)
+
+    def report(self, resolution):
+        """ Mean epoch time at resolution and the time saved per epoch against the full resolution,
+        measured once a full resolution epoch ran, estimated from the number of pixels before
+        """
+        seconds = np.mean(self.epoch_seconds[resolution])
+        line = 'resolution %d: %.1f seconds per epoch' % (resolution[0], seconds)
+        if resolution == self.full_resolution:
+            return line
+        if self.full_resolution in self.epoch_seconds:
+            full_seconds = np.mean(self.epoch_seconds[self.full_resolution])
+            estimated = ''
+        else:
+            full_seconds = seconds * (float(self.full_resolution[0]) / resolution[0]) ** 2
+            estimated = ' (estimated from the pixel count)'
+        return line + ', %.1f seconds saved per epoch against resolution %d%s' % (full_seconds - seconds,
+                                                                                 self.full_resolution[0], estimated)
+
+    def finish(self):
+        """ The total time saved
+        """
+        if self.full_resolution not in self.epoch_seconds or not self.is_progressive():
+            return ''
+        full_seconds = np.mean(self.epoch_seconds[self.full_resolution])
+        saved = sum(full_seconds * len(times) - np.sum(times) for resolution, times in self.epoch_seconds.items()
+                    if resolution != self.full_resolution)
+        return 'progressive resolution saved %.1f seconds of training' % saved
@@ -0,0 +1,105 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：per-step phase timing of the training loop with rolling percentiles,
+#                and chrome traces of full-trace session runs (open them in chrome://tracing)
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import time
+import collections
+import contextlib
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from config import FLAGS
+
+
+class StepProfiler(object):
+    """
+    Time of every phase of the training steps (data wait, feed, session run, summary write, checkpoint)
+    over the last window steps, and a RunMetadata full trace every trace_every_steps
+    """
+    def __init__(self, trace_dir, window=FLAGS.profile_window, trace_every_steps=FLAGS.trace_every_steps):
+        """Initializer
+            Args:
+            trace_dir			: Directory of the chrome trace files
+            window				: Number of steps the percentiles are computed on
+            trace_every_steps	: Steps between two full traces, 0 for none
+        """
+        self.trace_dir = trace_dir
+        self.window = window
+        self.trace_every_steps = trace_every_steps
+        # phase names in the order they first ran, and (step time, phase times) of the last window steps
+        self.names = []
+        self.current = collections.defaultdict(float)
+        self.step_start_time = None
+        self.steps = collections.deque(maxlen=window)
+        if trace_every_steps > 0:
+            os.system('mkdir -p {}'.format(trace_dir))
+
+    def start_step(self):
+        self.current = collections.defaultdict(float)
+        self.step_start_time = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the block as part of phase name of the current step
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.current[name] += time.time() - start_time
+
+    def end_step(self):
+        for name in self.current:
+            if name not in self.names:
+                self.names.append(name)
+        self.steps.append((time.time() - self.step_start_time, dict(self.current)))
+
+    def _times(self, name):
+        """ Times of phase name in the steps of the window it ran in, 'step' for the whole steps
+        """
+        if name == 'step':
+            return [step_time for step_time, _ in self.steps]
+        return [phases[name] for _, phases in self.steps if name in phases]
+
+    def percentiles(self, q=(50, 90, 99)):
+        """ dict of phase name to its percentiles in seconds over the steps it ran in, 'step' is the whole step
+        """
+        result = collections.OrderedDict()
+        for name in self.names + ['step']:
+            times = self._times(name)
+            if times:
+                result[name] = np.percentile(np.asarray(times), q)
+        return result
+
+    def report(self):
+        """ One line per phase: p50 / p90 / p99 in milliseconds and share of the total step time
+        """
+        percentiles = self.percentiles()
+        total = np.sum(self._times('step'))
+        lines = ['phase timing over the last %d steps (p50 / p90 / p99 ms, share of the step)' % len(self.steps)]
+        for name, values in percentiles.items():
+            share = np.sum(self._times(name)) / total if total > 0 else 0.0
+            lines.append('    %-12s %8.1f %8.1f %8.1f  %5.1f%%' % (name, values[0] * 1e3, values[1] * 1e3, values[2] * 1e3,
+                                                                    100.0 * share))
+        return '\n'.join(lines)
+
+    def run_options(self, step):
+        """ (RunOptions, RunMetadata) of a full trace on the trace steps, (None, None) otherwise
+        """
+        if self.trace_every_steps > 0 and step > 0 and step % self.trace_every_steps == 0:
+            return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+        return None, None
+
+    def write_trace(self, run_metadata, step):
+        """ Chrome trace of the session run of step, with the memory allocations
+        """
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True)
+        path = os.path.join(self.trace_dir, 'timeline_step_%d.json' % step)
+        with open(path, 'w') as f:
+            f.write(trace)
+        return path
@@ -0,0 +1,65 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：tensorboard writer whose event files are written by a background thread,
+#                the training thread only queues the serialized summaries
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import time
+import threading
+import queue
+import tensorflow as tf
+
+from config import FLAGS
+
+
+def is_summary_step(step, every=None):
+    """ True on the steps that evaluate the summaries, one step in summary_every_steps, never with 0
+    """
+    every = FLAGS.summary_every_steps if every is None else every
+    return every > 0 and step % every == 0
+
+
+class AsyncSummaryWriter(object):
+    """
+    tf.summary.FileWriter behind a queue, add_summary returns at once and the summaries are parsed
+    and written by a background thread. The time spent on each side is kept for the logs.
+    """
+    def __init__(self, logdir, graph=None, max_queue=100):
+        """Initializer
+            Args:
+            logdir		: Event file directory
+            graph		: Graph written with the events
+            max_queue	: Pending summaries, add_summary blocks when the writer falls that far behind
+        """
+        self.writer = tf.summary.FileWriter(logdir, graph)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.caller_time = 0.0
+        self.write_time = 0.0
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            start_time = time.time()
+            self.writer.add_summary(*item)
+            self.write_time += time.time() - start_time
+
+    def add_summary(self, summary, global_step=None):
+        start_time = time.time()
+        self.queue.put((summary, global_step))
+        self.caller_time += time.time() - start_time
+
+    def timing(self):
+        """ Seconds spent in add_summary on the training thread and in writing on the background thread
+        """
+        return 'summaries queued in %.2f seconds, written in %.2f seconds in background' % (self.caller_time, self.write_time)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
@@ -0,0 +1,205 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：convert train.txt and its images to compressed TFRecord shards, and read them back
+#                with parallel interleaved reads, `python tfrecord_dataset.py --help` for the converter
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import json
+import time
+import random
+import argparse
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+
+from config import FLAGS
+from parse_raw_data import load_catalog
+from image_cache import decode_image
+from input_pipeline import normalize_images, source_image_size, check_train_flags
+from graph_augment import augment_images
+
+
+_COMPRESSION = {'GZIP': tf.python_io.TFRecordCompressionType.GZIP,
+                'ZLIB': tf.python_io.TFRecordCompressionType.ZLIB,
+                '': tf.python_io.TFRecordCompressionType.NONE}
+
+
+def _shard_path(out_dir, prefix, shard, num_shards):
+    return os.path.join(out_dir, '%s-%05d-of-%05d.tfrecord' % (prefix, shard, num_shards))
+
+
+def _meta_path(out_dir, prefix):
+    return os.path.join(out_dir, '{}_meta.json'.format(prefix))
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def _float_feature(values):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+
+def _encode_example(img_dir, image_name, num_label, attribute_label, image_format, size):
+    """ One tf.train.Example holding the image, its num_label and its attribute vector
+    Args:
+        image_format	: 'jpeg' stores the file bytes as they are, 'raw' stores (size, size, 3) uint8 RGB pixels
+    """
+    path = os.path.join(img_dir, image_name)
+    if image_format == 'jpeg':
+        with open(path, 'rb') as f:
+            image = f.read()
+    else:
+        image = decode_image(path, [size])[0].tobytes()
+    feature = {'name': _bytes_feature(image_name.encode('utf-8')),
+               'image': _bytes_feature(image),
+               'num_label': _int64_feature(num_label),
+               'attribute_label': _float_feature(attribute_label)}
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def _write_shard(args):
+    path, compression, img_dir, samples, image_format, size = args
+    options = tf.python_io.TFRecordOptions(_COMPRESSION[compression])
+    with tf.python_io.TFRecordWriter(path + '.tmp', options=options) as writer:
+        for image_name, num_label, attribute_label in samples:
+            example = _encode_example(img_dir, image_name, num_label, attribute_label, image_format, size)
+            writer.write(example.SerializeToString())
+    os.rename(path + '.tmp', path)
+    return len(samples)
+
+
+def write_tfrecord_shards(train_file=FLAGS.train_file, img_dir=FLAGS.img_dir, attrs_per_class_dir=FLAGS.attrs_per_class_dir,
+                          out_dir=FLAGS.tfrecord_dir, prefix='train', num_shards=FLAGS.tfrecord_shards,
+                          image_format=FLAGS.tfrecord_image_format, compression=FLAGS.tfrecord_compression,
+                          num_workers=None, seed=0):
+    """ Write every image of train_file with its labels to num_shards compressed TFRecord files
+    Args:
+        train_file			: Text file with image name and class label per line
+        img_dir				: Directory containing the images
+        attrs_per_class_dir	: Attributes per class
+        out_dir				: Output directory
+        prefix				: Shard file name prefix
+        num_shards			: Number of shards, images are shuffled once so every shard mixes all classes
+        image_format		: 'jpeg'/'raw', see _encode_example, raw images are stored at size_before_crop
+        compression			: 'GZIP'/'ZLIB'/''
+        num_workers			: Writing processes, default the number of cpus
+        seed				: Seed of the shuffle before sharding
+    """
+    catalog = load_catalog(attrs_per_class_dir=attrs_per_class_dir, train_file=train_file)
+    samples = []
+    for image_name, num_label in sorted(zip(catalog.train_images, catalog.train_num_labels)):
+        samples.append((str(image_name), int(num_label), [float(attr) for attr in catalog.class_attributes[num_label]]))
+    random.Random(seed).shuffle(samples)
+
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    os.system('mkdir -p {}'.format(out_dir))
+    print('WRITE TFRECORD SHARDS', len(samples), 'images to', num_shards, 'shards in', out_dir)
+
+    # the meta file is written last, shards without meta are treated as missing
+    if os.path.exists(_meta_path(out_dir, prefix)):
+        os.remove(_meta_path(out_dir, prefix))
+
+    size = source_image_size()
+    tasks = [(_shard_path(out_dir, prefix, shard, num_shards), compression, img_dir, samples[shard::num_shards],
+              image_format, size) for shard in range(num_shards)]
+    start_time = time.time()
+    done = 0
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for num in pool.imap_unordered(_write_shard, tasks):
+            done += num
+            print('[%s][writing %s][%d / %d exec %.2f seconds]' %
+                  (time.strftime("%Y-%m-%d %H:%M:%S"), prefix, done, len(samples), time.time() - start_time))
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(_meta_path(out_dir, prefix), 'w') as f:
+        json.dump({'train_file': train_file, 'img_dir': img_dir, 'num': len(samples), 'num_shards': num_shards,
+                   'image_format': image_format, 'size': size, 'compression': compression,
+                   'attribute_cnt': len(samples[0][2])}, f)
+    print('TFRECORD SHARDS WRITTEN', out_dir)
+
+
+def read_tfrecord_meta(tfrecord_dir=FLAGS.tfrecord_dir, prefix='train'):
+    with open(_meta_path(tfrecord_dir, prefix), 'r') as f:
+        return json.load(f)
+
+
+def build_tfrecord_dataset(tfrecord_dir=FLAGS.tfrecord_dir, prefix='train', batch_size=FLAGS.batch_size,
+                           shuffle_buffer=FLAGS.shuffle_buffer, parallel_reads=FLAGS.tfrecord_parallel_reads,
+                           num_workers=1, worker_index=0):
+    """ Endless dataset of augmented training batches read from the shards
+    Args:
+        tfrecord_dir	: Directory written by write_tfrecord_shards
+        prefix			: Shard file name prefix
+        batch_size		: Number of images per batch
+        shuffle_buffer	: Size of the shuffle buffer of the interleaved records, 0 to keep the read order
+        parallel_reads	: Shards read at the same time
+        num_workers		: Data-parallel workers, each reads the shards worker_index::num_workers
+        worker_index	: Rank of this worker
+    Returns:
+        tf.data.Dataset of (images, attribute_labels, num_labels), same as input_pipeline.build_train_dataset
+    """
+    check_train_flags('tfrecord')
+    meta = read_tfrecord_meta(tfrecord_dir, prefix)
+    shards = [_shard_path(tfrecord_dir, prefix, shard, meta['num_shards'])
+              for shard in range(worker_index, meta['num_shards'], num_workers)]
+    source_size = source_image_size()
+
+    def read_shard(path):
+        return tf.data.TFRecordDataset(path, compression_type=meta['compression'], buffer_size=8 * 1024 * 1024)
+
+    def parse(serialized):
+        features = tf.parse_single_example(serialized, features={
+            'image': tf.FixedLenFeature(shape=[], dtype=tf.string),
+            'num_label': tf.FixedLenFeature(shape=[], dtype=tf.int64),
+            'attribute_label': tf.FixedLenFeature(shape=[meta['attribute_cnt']], dtype=tf.float32)})
+        if meta['image_format'] == 'jpeg':
+            image = tf.image.decode_jpeg(features['image'], channels=3)
+        else:
+            image = tf.reshape(tf.decode_raw(features['image'], out_type=tf.uint8), [meta['size'], meta['size'], 3])
+        if meta['image_format'] == 'jpeg' or meta['size'] != source_size:
+            image = tf.cast(tf.round(tf.image.resize_images(image, [source_size, source_size])), tf.uint8)
+        attribute_label = features['attribute_label'][0:FLAGS.attribute_label_cnt]
+        return image, attribute_label, tf.cast(features['num_label'], tf.int32)
+
+    dataset = tf.data.Dataset.from_tensor_slices(tf.constant(shards)).shuffle(len(shards)).repeat()
+    dataset = dataset.apply(tf.contrib.data.parallel_interleave(read_shard, cycle_length=parallel_reads, sloppy=True))
+    if shuffle_buffer > 0:
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.map(parse, num_parallel_calls=FLAGS.data_parallel_calls)
+    dataset = dataset.batch(batch_size)
+
+    def augment_batch(images, attribute_labels, num_labels):
+        images = normalize_images(augment_images(images))
+        images.set_shape([None, FLAGS.img_size, FLAGS.img_size, FLAGS.img_depth])
+        return images, attribute_labels, num_labels
+
+    dataset = dataset.map(augment_batch, num_parallel_calls=2)
+    return dataset.prefetch(FLAGS.prefetch_batches)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a train.txt and its images to TFRecord shards')
+    parser.add_argument('--train_file', default=FLAGS.train_file)
+    parser.add_argument('--img_dir', default=FLAGS.img_dir)
+    parser.add_argument('--attrs_per_class_dir', default=FLAGS.attrs_per_class_dir)
+    parser.add_argument('--out_dir', default=FLAGS.tfrecord_dir)
+    parser.add_argument('--prefix', default='train')
+    parser.add_argument('--num_shards', type=int, default=FLAGS.tfrecord_shards)
+    parser.add_argument('--image_format', choices=['jpeg', 'raw'], default=FLAGS.tfrecord_image_format)
+    parser.add_argument('--compression', choices=sorted(_COMPRESSION.keys()), default=FLAGS.tfrecord_compression)
+    parser.add_argument('--num_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    write_tfrecord_shards(args.train_file, args.img_dir, args.attrs_per_class_dir, args.out_dir, args.prefix,
+                          args.num_shards, args.image_format, args.compression, args.num_workers)
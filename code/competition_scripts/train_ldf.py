@@ -6,7 +6,9 @@
 
 import tensorflow as tf
 import os
+import sys
 import time
+import subprocess
 import numpy as np
 from tensorflow.contrib.slim.python.slim.nets import resnet_v2
 slim = tf.contrib.slim
@@ -16,9 +18,25 @@ from config import FLAGS
 from data_generator import DataGenerator
 from data_generator import *
 from parse_raw_data import *
+from graph_augment import preprocess_images
+from input_pipeline import build_train_dataset, check_train_flags
+from tfrecord_dataset import build_tfrecord_dataset
+from checkpointer import AsyncCheckpointer
+from summary_writer import AsyncSummaryWriter, is_summary_step
+from step_profiler import StepProfiler
+from resnet_recompute import resnet_v2_50_recompute
+from resolution_schedule import ResolutionSchedule
 
 
-def train_multi():
+def train_multi(rank=0, world_size=1, allreduce=None, intra_op_threads=0):
+	'''
+	Args:
+		rank				: Rank of this worker in data-parallel training, only rank 0 writes logs and checkpoints
+		world_size			: Number of workers, each trains on batch_size / world_size images per step
+		allreduce			: SharedMemoryAllReduce / SocketAllReduce averaging the gradients, None to train alone
+		intra_op_threads	: Threads of the session, 0 for all the cores
+	'''
+
 	'''
 	Step 1: Create dirs for saving models and logs
 	'''
@@ -46,30 +64,96 @@ def train_multi():
 	Step 2: Create dataset and data generator
 	'''
 	print('CREATE DIFFERENT DATASETS')
+	if FLAGS.input_pipeline != 'generator':
+		# the tf.data and TFRecord pipelines implement neither the color augmentation nor the P x K sampler
+		check_train_flags(FLAGS.input_pipeline)
 	dataset = DataGenerator(FLAGS.attrs_per_class_dir, FLAGS.img_dir, FLAGS.train_file)
-	dataset.generate_set(rand=True, validationRate=0.0)
+	# images are held out only for validator.py, the TFRecord shards hold every training image so the
+	# validator would score images the model trains on
+	validate = FLAGS.run_validator and FLAGS.validation_rate > 0
+	if validate and FLAGS.input_pipeline == 'tfrecord':
+		print('WARNING: validator.py is not started with the tfrecord input pipeline, its shards include the held-out images')
+		validate = False
+	# the held-out split is kept in the model dir for resumed runs and for validator.py
+	dataset.generate_set(rand=True, validationRate=FLAGS.validation_rate if validate else 0.0,
+	                     valid_set_file=os.path.join(model_save_dir, 'valid_set.txt') if validate else None)
 
 	# train setp configuration
 	train_size = dataset.count_train()
 	training_iters_per_epoch = int(train_size / FLAGS.batch_size)
 	print("train size: %d, training_iters_per_epoch: %d" % (train_size, training_iters_per_epoch))
 
-	generator = dataset.generator(batchSize=FLAGS.batch_size, norm=FLAGS.normalize, sample='train')
-	generator_eval = dataset.generator(batchSize=FLAGS.batch_size, norm=FLAGS.normalize, sample='valid')
-
-	_, whole_attr_np, _ = parse_repre_label2one_hot_map(FLAGS.attrs_per_class_dir)
+	# data-parallel workers share the batch and each one runs its share as accumulate_steps micro-batches,
+	# an epoch stays train_size / batch_size optimizer steps
+	data_parallel = allreduce is not None
+	accumulate_steps = FLAGS.accumulate_steps
+	worker_batch_size = FLAGS.batch_size // (world_size * accumulate_steps)
+	if data_parallel:
+		tf.set_random_seed(FLAGS.dp_seed + rank)
+		print("worker %d / %d, %d images per micro-batch" % (rank, world_size, worker_batch_size))
+	if accumulate_steps > 1:
+		print("%d micro-batches of %d images per optimizer step" % (accumulate_steps, worker_batch_size))
+	if FLAGS.input_pipeline == 'generator' and FLAGS.batch_sampler == 'pk' and worker_batch_size % FLAGS.pk_images_per_class != 0:
+		raise ValueError('batch_sampler pk: the micro-batch of %d images (batch_size %d / %d workers / %d accumulate_steps) '
+		                 'is not a multiple of pk_images_per_class %d'
+		                 % (worker_batch_size, FLAGS.batch_size, world_size, accumulate_steps, FLAGS.pk_images_per_class))
+
+	# image size of every epoch, set on the generator by the schedule, FLAGS keep the configured size
+	schedule = ResolutionSchedule()
+	progressive = schedule.is_progressive()
+	if progressive and (FLAGS.input_pipeline != 'generator' or FLAGS.augment_backend != 'fused'):
+		raise ValueError('resolution_schedule needs the generator input pipeline and the fused augment backend')
+	generator_resolution = schedule.full_resolution
+
+	# the data workers are forked here once, before the graph and the session start their threads
+	generator = None
+	if FLAGS.input_pipeline == 'generator':
+		generator = dataset.generator(batchSize=worker_batch_size, norm=FLAGS.normalize, sample='train',
+		                              num_workers=FLAGS.num_data_workers, num_slots=FLAGS.data_ring_slots,
+		                              sampler=FLAGS.batch_sampler, max_img_size=schedule.max_img_size())
+
+	whole_attr_np = load_catalog().class_attributes[:, 0:FLAGS.attribute_label_cnt]
 	# print(whole_attr_np)
 
-	image_placeholder = tf.placeholder(dtype=tf.float32, shape=[None, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth])  # [batch, 224, 224, 3]
-	whole_label_placeholder = tf.placeholder(dtype=tf.float32, shape=[FLAGS.num_class, FLAGS.attribute_label_cnt])  # [230, 30]
-	gt_onehot_label_placeholder = tf.placeholder(dtype=tf.float32, shape=[None, FLAGS.num_class])  # [batch, 230]
-	num_label_placeholder = tf.placeholder(dtype=tf.int32, shape=[None])  # [batch]
 	is_training = tf.placeholder(dtype=tf.bool)
+	if FLAGS.input_pipeline in ('tf_data', 'tfrecord'):
+		# batches come from the tf.data pipeline, the placeholders default to them and are not fed
+		if FLAGS.input_pipeline == 'tfrecord':
+			train_dataset = build_tfrecord_dataset(batch_size=worker_batch_size, num_workers=world_size, worker_index=rank)
+		else:
+			train_dataset = build_train_dataset(dataset.train_set[rank::world_size],
+			                                    dataset.num_labels[dataset.train_index][rank::world_size], whole_attr_np,
+			                                    batch_size=worker_batch_size)
+		train_images, _, train_num_labels = train_dataset.make_one_shot_iterator().get_next()
+		image_placeholder = tf.placeholder_with_default(train_images, shape=[None, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth])
+		network_input = image_placeholder
+	elif FLAGS.augment_backend == 'graph':
+		# raw uint8 images at size_before_crop, augmented and normalized in the graph
+		raw_size = FLAGS.size_before_crop if FLAGS.if_crop_augment else FLAGS.img_size
+		image_placeholder = tf.placeholder(dtype=tf.uint8, shape=[None, raw_size, raw_size, FLAGS.img_depth])  # [batch, 256, 256, 3]
+		network_input = preprocess_images(image_placeholder, is_training)
+	else:
+		# any size with a resolution schedule, resnet_v2_50 is fully convolutional up to the global pooling
+		image_shape = [None, None, None, FLAGS.img_depth] if progressive else [None, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth]
+		image_placeholder = tf.placeholder(dtype=tf.float32, shape=image_shape)  # [batch, 224, 224, 3]
+		network_input = image_placeholder
+	# the class attributes are a graph constant, never fed, the sampled softmax only gathers the rows it needs
+	whole_attr = tf.constant(whole_attr_np, dtype=tf.float32)  # [230, 30]
+	if FLAGS.input_pipeline in ('tf_data', 'tfrecord'):
+		num_label_placeholder = tf.placeholder_with_default(train_num_labels, shape=[None])
+	else:
+		num_label_placeholder = tf.placeholder(dtype=tf.int32, shape=[None])  # [batch]
+	# the onehot labels are built in the graph, only the class indexes are fed
+	gt_onehot_label_placeholder = tf.one_hot(num_label_placeholder, FLAGS.num_class)  # [batch, 230]
 
 	'''
 	Step 3: Build network graph
 	'''
-	feature, endpoints = resnet_v2.resnet_v2_50(image_placeholder, num_classes=None, reuse=False, is_training=is_training)
+	if FLAGS.recompute_activations:
+		# same variables, only the unit outputs are kept for the backward pass, see resnet_recompute.py
+		feature, endpoints = resnet_v2_50_recompute(network_input, is_training=is_training, reuse=False)
+	else:
+		feature, endpoints = resnet_v2.resnet_v2_50(network_input, num_classes=None, reuse=False, is_training=is_training)
 
 	'''
 	Step 4: Define variables to restore if have trained convnet parameters
@@ -105,13 +189,35 @@ def train_multi():
 	Step 5: Define multi loss according to LDF
 	'''
 	freeze = False
-	if freeze:
-		loss, train = model.build_multi_loss_3(logits, gt_onehot_label_placeholder, whole_label_placeholder,
+	unfreeze = len(FLAGS.unfreeze_schedule) > 0
+	if unfreeze and (data_parallel or accumulate_steps > 1 or freeze):
+		raise ValueError('unfreeze_schedule trains alone, without data parallelism, accumulation nor freeze')
+	if unfreeze:
+		# one train op per stage, the one of the current global step is run
+		unfreeze_schedule = model.unfreeze_stages(FLAGS.unfreeze_schedule)
+		loss, unfreeze_trains = model.build_multi_loss_3_unfreeze(
+			logits, gt_onehot_label_placeholder, whole_attr, num_label_placeholder, FLAGS.margin,
+			FLAGS.squared, FLAGS.triplet_strategy, stages=unfreeze_schedule)
+		unfreeze_stage = None
+	elif data_parallel:
+		# the gradients are fetched, summed over the micro-batches and averaged over the workers,
+		# then fed to apply_gradients
+		loss, gradients, grad_placeholders, train = model.build_multi_loss_3_data_parallel(
+			logits, gt_onehot_label_placeholder, whole_attr, num_label_placeholder, FLAGS.margin,
+			FLAGS.squared, FLAGS.triplet_strategy, variable_to_train=variable_to_train_if_freeze if freeze else None)
+	elif accumulate_steps > 1:
+		# accumulate runs on every micro-batch, train once per optimizer step
+		loss, accumulate, train = model.build_multi_loss_3_accumulate(
+			logits, gt_onehot_label_placeholder, whole_attr, num_label_placeholder, FLAGS.margin,
+			FLAGS.squared, FLAGS.triplet_strategy, accumulate_steps,
+			variable_to_train=variable_to_train_if_freeze if freeze else None)
+	elif freeze:
+		loss, train = model.build_multi_loss_3(logits, gt_onehot_label_placeholder, whole_attr,
 		                                       num_label_placeholder, FLAGS.margin, FLAGS.squared,
 		                                       FLAGS.triplet_strategy, optimizer='Adam', freeze=freeze,
 		                                       variable_to_train=variable_to_train_if_freeze)
 	else:
-		loss, train = model.build_multi_loss_3(logits, gt_onehot_label_placeholder, whole_label_placeholder,
+		loss, train = model.build_multi_loss_3(logits, gt_onehot_label_placeholder, whole_attr,
 		                                       num_label_placeholder, FLAGS.margin, FLAGS.squared,
 		                                       FLAGS.triplet_strategy, optimizer='Adam')
 
@@ -120,25 +226,30 @@ def train_multi():
 	'''
 	total_start_time = time.time()
 	device_count = {'GPU': 1} if FLAGS.use_gpu else {'GPU': 0}
-	with tf.Session(config=tf.ConfigProto(device_count=device_count, allow_soft_placement=True)) as sess:
+	session_config = tf.ConfigProto(device_count=device_count, allow_soft_placement=True,
+	                                intra_op_parallelism_threads=intra_op_threads)
+	with tf.Session(config=session_config) as sess:
 		# Create tensorboard
 		merged = tf.summary.merge_all()
-		train_writer = tf.summary.FileWriter(train_log_save_dir, sess.graph)
-		validation_writer = tf.summary.FileWriter(test_log_save_dir, sess.graph)
+		if rank == 0:
+			train_writer = AsyncSummaryWriter(train_log_save_dir, sess.graph)
 
-		# Create model saver
+		# Create model saver, checkpoints are written in the background by rank 0
 		saver_restore = tf.train.Saver(var_list=variable_to_restore)
 		saver = tf.train.Saver()
+		if rank == 0:
+			checkpointer = AsyncCheckpointer(model_save_dir + '/' + FLAGS.network_def.split('.py')[0])
 
 		# Init all vars
 		init_op = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
 		sess.run(init_op)
 
-		# Restore pretrained weights
-		if FLAGS.pretrained_model:
-			pretrained_model = model_save_dir
-			print('load checkpoint of:', pretrained_model)
-			checkpoint = tf.train.get_checkpoint_state(pretrained_model)
+		# Restore the latest checkpoint of the model dir, training resumes at its global step
+		checkpoint = tf.train.get_checkpoint_state(model_save_dir)
+		if FLAGS.pretrained_model and checkpoint is None:
+			raise IOError('No checkpoint in {}'.format(model_save_dir))
+		if (FLAGS.pretrained_model or FLAGS.auto_resume) and checkpoint is not None:
+			print('load checkpoint of:', model_save_dir)
 			# 获取最新保存的模型检查点文件
 			ckpt = checkpoint.model_checkpoint_path
 			saver.restore(sess, ckpt)
@@ -148,39 +259,147 @@ def train_multi():
 					var = tf.get_variable(variable.name.split(':0')[0])
 					print(variable.name, np.mean(sess.run(var)))
 
+		global_step_tensor = tf.train.get_global_step()
+		start_step = sess.run(global_step_tensor)
+
+		# every worker starts from the weights, optimizer slots and step of rank 0
+		if data_parallel:
+			float_variables = [var for var in tf.global_variables() if var.dtype.base_dtype == tf.float32]
+			for var, value in zip(float_variables, allreduce.broadcast(sess.run(float_variables))):
+				var.load(value, sess)
+			start_step = int(allreduce.broadcast([np.float32(start_step)])[0])
+			global_step_tensor.load(start_step, sess)
+
+		# Validation runs in its own process on every new checkpoint and writes the 'val' logs,
+		# it exits after the last checkpoint once this process is gone
+		if rank == 0 and validate and len(dataset.valid_set) > 0:
+			subprocess.Popen([sys.executable, 'validator.py', '--model_dir', model_save_dir, '--log_dir', test_log_save_dir,
+			                  '--parent_pid', str(os.getpid())], cwd=os.path.dirname(os.path.abspath(__file__)))
+
 		# Start training
-		global_step = 0
-		for epoch in range(152, FLAGS.training_epoch):
-			for step in range(training_iters_per_epoch):
+		start_epoch = start_step // training_iters_per_epoch
+		print('start training at epoch %d, global step %d' % (start_epoch + 1, start_step))
+		global_step = start_step - 1
+		# data wait, feed, session run, summary write and checkpoint of every step, and full traces of the graph
+		profiler = StepProfiler(os.path.join(train_log_save_dir, '..', 'trace'))
+		for epoch in range(start_epoch, FLAGS.training_epoch):
+			first_step = start_step % training_iters_per_epoch if epoch == start_epoch else 0
+			if schedule.resolution(epoch) != generator_resolution:
+				generator_resolution = schedule.resolution(epoch)
+				schedule.apply(generator_resolution, dataset)
+				print('[%s][resolution][epoch %d] images of %d x %d, %d before crop' %
+				      (time.strftime("%Y-%m-%d %H:%M:%S"), epoch + 1, generator_resolution[0], generator_resolution[0],
+				       generator_resolution[1]))
+			schedule.start_epoch()
+			for step in range(first_step, training_iters_per_epoch):
 				# Train start
-				image_data, attr_labels, num_labels, onehot_labels = next(generator)
+				profiler.start_step()
 				batch_start_time = time.time()
 				global_step = step + epoch * (training_iters_per_epoch)
-
-				summary, loss_result, _ = \
-					sess.run([merged, loss, train], feed_dict={image_placeholder: image_data,
-					                                           whole_label_placeholder: whole_attr_np,
-					                                           num_label_placeholder: num_labels,
-					                                           gt_onehot_label_placeholder: onehot_labels,
-					                                           is_training:True})
-
-				train_writer.add_summary(summary, global_step)
-
-				if step % 10 == 0:
-					print('[%s][training][epoch %d, step %d / %d exec %.2f seconds]  loss : %3.10f' %
-					      (time.strftime("%Y-%m-%d %H:%M:%S"), epoch + 1, step, training_iters_per_epoch, (time.time() - batch_start_time), loss_result))
-
-			# Save models for one epoch
-			saver.save(sess=sess, save_path=model_save_dir + '/' + FLAGS.network_def.split('.py')[0], global_step=(global_step + 1))
-			print('\nModel checkpoint saved for one epoch...\n')
+				anchor_fraction = ''
+				if unfreeze and model.unfreeze_stage_index(unfreeze_schedule, global_step) != unfreeze_stage:
+					unfreeze_stage = model.unfreeze_stage_index(unfreeze_schedule, global_step)
+					train = unfreeze_trains[unfreeze_stage]
+					print('[%s][unfreeze][step %d] stage %d, %d variables trained' %
+					      (time.strftime("%Y-%m-%d %H:%M:%S"), global_step, unfreeze_stage,
+					       len(unfreeze_schedule[unfreeze_stage][1])))
+
+				# summaries every summary_every_steps, the loss only in between
+				write_summary = rank == 0 and is_summary_step(global_step)
+				run_phase = 'run_summary' if write_summary else 'run'
+				options, run_metadata = profiler.run_options(global_step) if rank == 0 else (None, None)
+				loss_sum = 0.0
+				for micro_step in range(accumulate_steps):
+					if FLAGS.input_pipeline in ('tf_data', 'tfrecord'):
+						# the wait for the tf.data batch is inside the session run, see IteratorGetNext in the traces
+						feed_dict = {is_training: True}
+					else:
+						with profiler.phase('data'):
+							image_data, attr_labels, num_labels = next(generator)
+						with profiler.phase('feed'):
+							anchor_fraction = '  valid anchors : %.2f' % valid_anchor_fraction(num_labels)
+							feed_dict = {image_placeholder: image_data,
+							             num_label_placeholder: num_labels,
+							             is_training: True}
+
+					# the summaries and the trace are those of the last micro-batch
+					last_micro_step = micro_step == accumulate_steps - 1
+					fetch_summary = write_summary and last_micro_step
+					run_options = dict(options=options, run_metadata=run_metadata) if last_micro_step else {}
+					if data_parallel:
+						fetches = [loss, gradients] + ([merged] if fetch_summary else [])
+						with profiler.phase(run_phase):
+							results = sess.run(fetches, feed_dict=feed_dict, **run_options)
+						gradient_sums = results[1] if micro_step == 0 else [a + b for a, b in zip(gradient_sums, results[1])]
+						loss_sum += results[0]
+						summary = results[2] if fetch_summary else None
+					else:
+						step_op = accumulate if accumulate_steps > 1 else train
+						with profiler.phase(run_phase):
+							if fetch_summary:
+								summary, loss_result, _ = sess.run([merged, loss, step_op], feed_dict=feed_dict,
+								                                   **run_options)
+							else:
+								loss_result, _ = sess.run([loss, step_op], feed_dict=feed_dict, **run_options)
+						loss_sum += loss_result
+				loss_result = loss_sum / accumulate_steps
+
+				if data_parallel:
+					# the loss is averaged with the gradients, for the log of rank 0
+					with profiler.phase('allreduce'):
+						averaged = allreduce.allreduce([gradient / accumulate_steps for gradient in gradient_sums] +
+						                               [np.float32(loss_result)])
+					loss_result = averaged[-1]
+					with profiler.phase('apply'):
+						sess.run(train, feed_dict=dict(zip(grad_placeholders, averaged[:-1])))
+				elif accumulate_steps > 1:
+					with profiler.phase('apply'):
+						sess.run(train)
+
+				if write_summary:
+					with profiler.phase('summary'):
+						train_writer.add_summary(summary, global_step)
+				if run_metadata is not None:
+					with profiler.phase('trace'):
+						print('chrome trace written in', profiler.write_trace(run_metadata, global_step))
+
+				if step % 10 == 0 and rank == 0:
+					print('[%s][training][epoch %d, step %d / %d exec %.2f seconds]  loss : %3.10f%s' %
+					      (time.strftime("%Y-%m-%d %H:%M:%S"), epoch + 1, step, training_iters_per_epoch, (time.time() - batch_start_time), loss_result,
+					       anchor_fraction))
+
+				# Save models every checkpoint_every_steps, suffixed with the number of steps done
+				if rank == 0 and (global_step + 1) % FLAGS.checkpoint_every_steps == 0:
+					with profiler.phase('checkpoint'):
+						checkpointer.save(sess, global_step + 1)
+				profiler.end_step()
+
+				if rank == 0 and FLAGS.profile_report_every_steps > 0 and (global_step + 1) % FLAGS.profile_report_every_steps == 0:
+					print(profiler.report())
+
+			if rank == 0:
+				print('[%s][logging][epoch %d] %s' % (time.strftime("%Y-%m-%d %H:%M:%S"), epoch + 1, train_writer.timing()))
+				if progressive:
+					print('[%s][resolution][epoch %d] %s' % (time.strftime("%Y-%m-%d %H:%M:%S"), epoch + 1, schedule.end_epoch(epoch)))
+
+		# the test stages run at the configured img_size
+		if generator is not None:
+			generator.close()
+		schedule_report = schedule.finish()
+		if rank == 0 and schedule_report:
+			print(schedule_report)
 
 		# Save models for total training process
-		saver.save(sess=sess, save_path=model_save_dir + '/' + FLAGS.network_def.split('.py')[0], global_step=(global_step + 1))
-		print('\nModel checkpoint saved for total train...\n')
+		if rank == 0:
+			if (global_step + 1) % FLAGS.checkpoint_every_steps != 0:
+				checkpointer.save(sess, global_step + 1)
+			checkpointer.close()
+			print('\nModel checkpoint saved for total train...\n')
 
 	print('Training done.')
 	print("[%s][total exec %s seconds" % (time.strftime("%Y-%m-%d %H:%M:%S"), (time.time() - total_start_time)))
-	train_writer.close()
+	if rank == 0:
+		train_writer.close()
 	sess.close()
 
 
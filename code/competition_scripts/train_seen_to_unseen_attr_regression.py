@@ -11,9 +11,9 @@ import numpy as np
 
 from config import FLAGS
 
-from data_generator import *
-from data_generator import *
+from parse_raw_data import *
 from seen2unseen_attr_regression_model import *
+from summary_writer import AsyncSummaryWriter, is_summary_step
 
 
 def train_seen_to_useen_attr_regression():
@@ -34,45 +34,22 @@ def train_seen_to_useen_attr_regression():
 		Step 2: Create dataset
 	'''
 
-	total_class_set_list, _, _ = parse_repre_label2one_hot_map(
-		FLAGS.attrs_per_class_dir)
+	catalog = load_catalog()
+	total_class_set_list = catalog.class_list
 	print('Total class set', total_class_set_list, len(total_class_set_list))
-
-	train_table = []
-	train_class_table = []
-	with open(FLAGS.train_file, 'r') as f:
-		for line in f.readlines():
-			image_name = line.split('	')[0]
-			class_repre = line.split('	')[1].replace('\n', '')
-			train_table.append(image_name)
-			if class_repre not in train_class_table:
-				train_class_table.append(class_repre)
-	# label_file = pd.read_csv(self.train_file)
 	print('READING LABELS OF TRAIN DATA')
-	print('Total num:', len(train_table))
+	print('Total num:', len(catalog.train_images))
 
-	train_class_set_list = [item for item in total_class_set_list if item in train_class_table]
+	train_class_set_list = catalog.seen_classes()
 	print('Train class set', train_class_set_list, len(train_class_set_list))
 
-	# obtain image name and class label in train.txt
-	train_image2represent_label_map = \
-		parse_train_image2represent_label_map(FLAGS.train_file)
-
-	# obtain class label and attribute label in attrs_per_class.txt
-	represent_label2attribute_vec_map = \
-		parse_attribute_per_class(FLAGS.attrs_per_class_dir)
-
-	input_data = np.zeros((len(train_class_set_list), FLAGS.attribute_label_cnt), dtype=np.float32)
-	for i in range(len(train_class_set_list)):
-		input_data[i, :] = np.array(represent_label2attribute_vec_map[train_class_set_list[i]])[0:FLAGS.attribute_label_cnt]
+	input_data = catalog.class_attributes[catalog.seen_class_index, 0:FLAGS.attribute_label_cnt]
 	print('input_data:', input_data[-1])
 
-	useen_class_set_list = [item for item in total_class_set_list if item not in train_class_table]
+	useen_class_set_list = catalog.unseen_classes()
 	print('useen_class_set_list', useen_class_set_list, len(useen_class_set_list))
 
-	output_data = np.zeros([len(useen_class_set_list), FLAGS.attribute_label_cnt], dtype=np.float32)
-	for i in range(len(useen_class_set_list)):
-		output_data[i, :] = np.array(represent_label2attribute_vec_map[useen_class_set_list[i]])[0:FLAGS.attribute_label_cnt]
+	output_data = catalog.class_attributes[catalog.unseen_class_index, 0:FLAGS.attribute_label_cnt]
 	print('ouput_data:', output_data[-1])
 
 	'''
@@ -93,7 +70,7 @@ def train_seen_to_useen_attr_regression():
 	with tf.Session(config=tf.ConfigProto(device_count=device_count, allow_soft_placement=True), graph=g1) as sess:
 		# Create tensorboard
 		merged = tf.summary.merge_all()
-		train_writer = tf.summary.FileWriter(train_log_save_dir, sess.graph)
+		train_writer = AsyncSummaryWriter(train_log_save_dir, sess.graph)
 
 		# Create model saver
 		saver = tf.train.Saver()
@@ -108,8 +85,13 @@ def train_seen_to_useen_attr_regression():
 			for step in range(len(useen_class_set_list)):
 				batch_start_time = time.time()
 				global_step = step + epoch * len(useen_class_set_list)
+				feed_dict = {input_placeholder:input_data, output_placeholder:output_data}
+				# the steps are tiny, summaries and logs only every summary_every_steps
+				if not is_summary_step(global_step):
+					sess.run(train_l2_loss_with_regularizer_op, feed_dict=feed_dict)
+					continue
 				summary, result_l2_loss_with_regularizer, _ = sess.run([merged, l2_loss_with_regularizer, train_l2_loss_with_regularizer_op],
-				 feed_dict={input_placeholder:input_data, output_placeholder:output_data})
+				 feed_dict=feed_dict)
 				train_writer.add_summary(summary, global_step)
 
 				print('[%s][training][epoch %d / %d, step %d / %d, exec %.2f seconds]  loss : %3.10f' %
@@ -120,7 +102,7 @@ def train_seen_to_useen_attr_regression():
 		           global_step=(global_step + 1))
 		print('\nModel checkpoint saved for total train...\n')
 
-	print('Training useen to useen regression done.')
+	print('Training useen to useen regression done,', train_writer.timing())
 	print("[%s][total exec %s seconds" % (time.strftime("%Y-%m-%d %H:%M:%S"), (time.time() - total_start_time)))
 	train_writer.close()
 	sess.close()
@@ -200,6 +200,9 @@ def batch_hard_triplet_loss(labels, embeddings, margin, squared=False):
     mask_anchor_positive = _get_anchor_positive_triplet_mask(labels)
     mask_anchor_positive = tf.to_float(mask_anchor_positive)
 
+    # Anchors without a positive in the batch only push negatives away
+    tf.summary.scalar("valid_anchor_fraction", tf.reduce_mean(tf.reduce_max(mask_anchor_positive, axis=1)))
+
     # We put to 0 any element where (a, p) is not valid (valid if a != p and label(a) == label(p))
     anchor_positive_dist = tf.multiply(mask_anchor_positive, pairwise_dist)
 
@@ -227,3 +230,173 @@ def batch_hard_triplet_loss(labels, embeddings, margin, squared=False):
     triplet_loss = tf.reduce_mean(triplet_loss)
 
     return triplet_loss
+
+
+def batch_all_triplet_loss_chunked(labels, embeddings, margin, squared=False, chunk_size=16):
+    """Build the batch_all triplet loss over chunks of anchors, with O(chunk_size * batch_size^2) memory.
+
+    Same value and gradient as batch_all_triplet_loss. The (batch_size, batch_size, batch_size) loss and mask
+    tensors are never built: a while_loop runs over chunk_size anchors at a time, sums the loss of the positive
+    triplets and counts, for every pair (a, j), the active triplets where j is the positive and where j is
+    the negative. The loop runs without gradient, the gradient reaches the embeddings through the pairwise
+    distances, d loss / d dist[a, j] = (#active (a, j, n) - #active (a, p, j)) / num_positive_triplets.
+
+    Args:
+        labels: labels of the batch, of size (batch_size,)
+        embeddings: tensor of shape (batch_size, embed_dim)
+        margin: margin for triplet loss
+        squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
+                 If false, output is the pairwise euclidean distance matrix.
+        chunk_size: number of anchors per iteration
+
+    Returns:
+        triplet_loss: scalar tensor containing the triplet loss
+        fraction_positive_triplets: fraction of the valid triplets with a positive loss
+    """
+    # Get the pairwise distance matrix, shape (batch_size, batch_size)
+    pairwise_dist = _pairwise_distances(embeddings, squared=squared)
+    dist = tf.stop_gradient(pairwise_dist)
+
+    batch_size = tf.shape(labels)[0]
+    num_chunks = (batch_size + chunk_size - 1) // chunk_size
+
+    # A triplet (a, p, n) is valid iff a != p, labels[a] == labels[p] and labels[a] != labels[n],
+    # p != n and a != n follow from the labels
+    mask_anchor_positive = _get_anchor_positive_triplet_mask(labels)
+    mask_anchor_negative = _get_anchor_negative_triplet_mask(labels)
+    num_valid_triplets = tf.reduce_sum(tf.to_float(tf.reduce_sum(tf.to_int32(mask_anchor_positive), axis=1)) *
+                                       tf.to_float(tf.reduce_sum(tf.to_int32(mask_anchor_negative), axis=1)))
+
+    def body(chunk, loss_sum, num_positive, grad_counts):
+        begin = chunk * chunk_size
+        end = tf.minimum(begin + chunk_size, batch_size)
+        chunk_dist = dist[begin:end]
+        # shape (chunk, batch_size, batch_size), triplet_loss[a, p, n] of the anchors of the chunk
+        triplet_loss = tf.expand_dims(chunk_dist, 2) - tf.expand_dims(chunk_dist, 1) + margin
+        valid = tf.logical_and(tf.expand_dims(mask_anchor_positive[begin:end], 2),
+                               tf.expand_dims(mask_anchor_negative[begin:end], 1))
+
+        # active triplets pass a gradient through tf.maximum(triplet_loss, 0.0), positive ones are counted
+        active = tf.to_float(tf.logical_and(valid, tf.greater_equal(triplet_loss, 0.0)))
+        positive = tf.to_float(tf.logical_and(valid, tf.greater(triplet_loss, 1e-16)))
+        loss_sum += tf.reduce_sum(active * triplet_loss)
+        num_positive += tf.reduce_sum(positive)
+
+        # shape (chunk, batch_size): times j is the positive of an active triplet minus times it is the negative
+        grad_counts = grad_counts.write(chunk, tf.reduce_sum(active, axis=2) - tf.reduce_sum(active, axis=1))
+        return chunk + 1, loss_sum, num_positive, grad_counts
+
+    _, loss_sum, num_positive_triplets, grad_counts = tf.while_loop(
+        lambda chunk, *_: chunk < num_chunks, body,
+        [tf.constant(0), tf.constant(0.0), tf.constant(0.0),
+         tf.TensorArray(dtype=tf.float32, size=num_chunks, infer_shape=False)],
+        back_prop=False)
+
+    fraction_positive_triplets = num_positive_triplets / (num_valid_triplets + 1e-16)
+
+    # Get final mean triplet loss over the positive valid triplets, its gradient flows through pairwise_dist
+    triplet_loss = loss_sum / (num_positive_triplets + 1e-16)
+    grad_dist = grad_counts.concat() / (num_positive_triplets + 1e-16)
+    surrogate = tf.reduce_sum(grad_dist * pairwise_dist)
+    triplet_loss = triplet_loss + surrogate - tf.stop_gradient(surrogate)
+
+    return triplet_loss, fraction_positive_triplets
+
+
+def _cross_distances(anchors, candidates, squared=False):
+    """Compute the 2D matrix of distances between the anchors and the candidates.
+
+    Args:
+        anchors: tensor of shape (batch_size, embed_dim)
+        candidates: tensor of shape (num_candidates, embed_dim)
+        squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
+                 If false, output is the pairwise euclidean distance matrix.
+
+    Returns:
+        distances: tensor of shape (batch_size, num_candidates)
+    """
+    # ||a - c||^2 = ||a||^2  - 2 <a, c> + ||c||^2
+    dot_product = tf.matmul(anchors, tf.transpose(candidates))
+    distances = (tf.expand_dims(tf.reduce_sum(tf.square(anchors), axis=1), 1) - 2.0 * dot_product +
+                 tf.expand_dims(tf.reduce_sum(tf.square(candidates), axis=1), 0))
+    distances = tf.maximum(distances, 0.0)
+
+    if not squared:
+        # same epsilon as _pairwise_distances for the gradient of sqrt at 0.0
+        mask = tf.to_float(tf.equal(distances, 0.0))
+        distances = tf.sqrt(distances + mask * 1e-16) * (1.0 - mask)
+
+    return distances
+
+
+def batch_hard_triplet_loss_with_memory(labels, embeddings, margin, squared=False, memory_size=1024):
+    """Build the batch_hard triplet loss, mining the hardest positive and negative of each anchor
+    in the batch and in a FIFO memory of the embeddings of the last memory_size images.
+
+    The memory lives in LOCAL_VARIABLES (not checkpointed, not shared between data parallel workers) and is
+    refilled after the loss is computed by an op added to UPDATE_OPS, so it runs with the train op like the
+    batch norm updates. Memory embeddings are constants for the gradient, only the batch ones are trained.
+
+    Args:
+        labels: labels of the batch, of size (batch_size,)
+        embeddings: tensor of shape (batch_size, embed_dim)
+        margin: margin for triplet loss
+        squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
+                 If false, output is the pairwise euclidean distance matrix.
+        memory_size: number of past embeddings kept
+
+    Returns:
+        triplet_loss: scalar tensor containing the triplet loss
+    """
+    labels = tf.to_int32(labels)
+    embed_dim = embeddings.get_shape().as_list()[1]
+    with tf.variable_scope('triplet_memory'):
+        memory_embeddings = tf.get_variable('embeddings', [memory_size, embed_dim], tf.float32,
+                                            initializer=tf.zeros_initializer(), trainable=False,
+                                            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        # label -1 marks the slots not filled yet
+        memory_labels = tf.get_variable('labels', [memory_size], tf.int32, initializer=tf.constant_initializer(-1),
+                                        trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        memory_position = tf.get_variable('position', [], tf.int32, initializer=tf.zeros_initializer(),
+                                          trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+    batch_size = tf.shape(labels)[0]
+    candidates = tf.concat([embeddings, tf.stop_gradient(memory_embeddings.read_value())], axis=0)
+    candidate_labels = tf.concat([labels, memory_labels.read_value()], axis=0)
+    filled = tf.concat([tf.ones([batch_size], tf.bool), tf.greater_equal(candidate_labels[batch_size:], 0)], axis=0)
+    tf.summary.scalar("memory_fill_fraction", tf.reduce_mean(tf.to_float(filled[batch_size:])))
+
+    # shape (batch_size, batch_size + memory_size)
+    dist = _cross_distances(embeddings, candidates, squared=squared)
+
+    # a candidate is a positive iff it is not the anchor itself and has the same label,
+    # a negative iff it has another label, empty memory slots are neither
+    labels_equal = tf.equal(tf.expand_dims(labels, 1), tf.expand_dims(candidate_labels, 0))
+    indices_not_equal = tf.logical_not(tf.cast(tf.eye(batch_size, batch_size + memory_size), tf.bool))
+    mask_anchor_positive = tf.to_float(tf.logical_and(labels_equal, indices_not_equal))
+    mask_anchor_negative = tf.to_float(tf.logical_and(tf.logical_not(labels_equal), tf.expand_dims(filled, 0)))
+
+    tf.summary.scalar("valid_anchor_fraction", tf.reduce_mean(tf.reduce_max(mask_anchor_positive, axis=1)))
+
+    # shape (batch_size, 1)
+    hardest_positive_dist = tf.reduce_max(mask_anchor_positive * dist, axis=1, keep_dims=True)
+    tf.summary.scalar("hardest_positive_dist", tf.reduce_mean(hardest_positive_dist))
+
+    max_anchor_negative_dist = tf.reduce_max(dist, axis=1, keep_dims=True)
+    hardest_negative_dist = tf.reduce_min(dist + max_anchor_negative_dist * (1.0 - mask_anchor_negative), axis=1,
+                                          keep_dims=True)
+    tf.summary.scalar("hardest_negative_dist", tf.reduce_mean(hardest_negative_dist))
+
+    triplet_loss = tf.reduce_mean(tf.maximum(hardest_positive_dist - hardest_negative_dist + margin, 0.0))
+
+    # enqueue the batch once the loss has read the memory, the newest memory_size images when the batch is larger
+    with tf.control_dependencies([triplet_loss]):
+        num_new = tf.minimum(batch_size, memory_size)
+        indices = tf.mod(memory_position + tf.range(num_new), memory_size)
+        update_memory = tf.group(
+            tf.scatter_update(memory_embeddings, indices, tf.stop_gradient(embeddings[batch_size - num_new:])),
+            tf.scatter_update(memory_labels, indices, labels[batch_size - num_new:]),
+            tf.assign(memory_position, tf.mod(memory_position + num_new, memory_size)))
+    tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, update_memory)
+
+    return triplet_loss
@@ -0,0 +1,162 @@
+# ZhijiangLab Cup competition：zero-shot learning competition
+# Team: ZJUAI
+# Code function：validation in its own process, every new checkpoint of train_multi is evaluated on the held-out
+#                split (attribute compatibility accuracy and the LDF losses) and written to the 'val' tensorboard dir
+# Reference paper: 《Discriminative Learning of Latent Features for Zero-Shot Recognition》
+
+
+import os
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib.slim.python.slim.nets import resnet_v2
+slim = tf.contrib.slim
+
+import loss as model
+from config import FLAGS, model_path_suffix
+from parse_raw_data import load_catalog
+from input_pipeline import decode_image, normalize_images
+
+
+def valid_set_path(model_dir):
+    return os.path.join(model_dir, 'valid_set.txt')
+
+
+def _checkpoint_step(ckpt):
+    return int(ckpt.rsplit('-', 1)[-1])
+
+
+class Validator(object):
+    """
+    Evaluation graph of the held-out images, restored from each checkpoint in turn
+    """
+    def __init__(self, model_dir, log_dir, num_threads=FLAGS.validator_threads, batch_size=FLAGS.batch_size_test):
+        """Initializer
+            Args:
+            model_dir	: Checkpoint directory of train_multi, holding valid_set.txt
+            log_dir		: 'val' tensorboard dir
+            num_threads	: Threads of the validation session
+            batch_size	: Images per forward pass
+        """
+        catalog = load_catalog()
+        label_of_image = dict(zip(catalog.train_images, catalog.train_num_labels))
+        with open(valid_set_path(model_dir), 'r') as f:
+            self.image_names = [line.strip() for line in f if line.strip()]
+        num_labels = np.array([label_of_image[name] for name in self.image_names], dtype=np.int32)
+        whole_attr_np = catalog.class_attributes[:, 0:FLAGS.attribute_label_cnt]
+        self.model_dir = model_dir
+        print('VALIDATOR:', len(self.image_names), 'held-out images of', model_dir)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            paths = [os.path.join(FLAGS.img_dir, name) for name in self.image_names]
+            dataset = tf.data.Dataset.from_tensor_slices((tf.constant(paths), tf.constant(num_labels)))
+            dataset = dataset.map(lambda path, num_label: (normalize_images(decode_image(path, FLAGS.img_size)), num_label),
+                                  num_parallel_calls=num_threads)
+            self.iterator = dataset.batch(batch_size).prefetch(1).make_initializable_iterator()
+            images, batch_num_labels = self.iterator.get_next()
+            images.set_shape([None, FLAGS.img_height, FLAGS.img_width, FLAGS.img_depth])
+
+            feature, _ = resnet_v2.resnet_v2_50(images, num_classes=None, reuse=False, is_training=False)
+            feature = tf.squeeze(feature, axis=[1, 2])
+            logits = slim.fully_connected(feature, num_outputs=2 * FLAGS.attribute_label_cnt, activation_fn=None)
+            whole_attr = tf.constant(whole_attr_np, dtype=tf.float32)
+
+            # same losses as in training, without dropout
+            _, self.softmax_loss, self.triplet_loss = model._build_multi_loss_terms(
+                logits, tf.one_hot(batch_num_labels, FLAGS.num_class), whole_attr, batch_num_labels, FLAGS.margin,
+                FLAGS.squared, FLAGS.triplet_strategy)
+
+            # compatibility score with every class attribute vector, argmax over all classes and over the seen ones
+            scores = tf.matmul(logits[:, 0:FLAGS.attribute_label_cnt], tf.transpose(whole_attr))
+            seen = np.zeros(FLAGS.num_class, dtype=bool)
+            seen[catalog.seen_class_index] = True
+            seen_scores = tf.where(tf.tile(tf.expand_dims(tf.constant(seen), 0), [tf.shape(scores)[0], 1]),
+                                   scores, tf.fill(tf.shape(scores), -np.inf))
+            self.correct_all = tf.reduce_sum(tf.to_int32(tf.equal(tf.to_int32(tf.argmax(scores, 1)), batch_num_labels)))
+            self.correct_seen = tf.reduce_sum(tf.to_int32(tf.equal(tf.to_int32(tf.argmax(seen_scores, 1)), batch_num_labels)))
+            self.batch_count = tf.shape(batch_num_labels)[0]
+
+            self.saver = tf.train.Saver(var_list=slim.get_model_variables())
+
+        config = tf.ConfigProto(device_count={'GPU': 0}, intra_op_parallelism_threads=num_threads,
+                                inter_op_parallelism_threads=1)
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.writer = tf.summary.FileWriter(log_dir)
+
+    def evaluate(self, ckpt):
+        """ Metrics of the held-out images with the weights of ckpt, written at the step of ckpt
+        """
+        start_time = time.time()
+        self.saver.restore(self.sess, ckpt)
+        self.sess.run(self.iterator.initializer)
+        totals = np.zeros(5)
+        while True:
+            try:
+                count, correct_all, correct_seen, softmax_loss, triplet_loss = self.sess.run(
+                    [self.batch_count, self.correct_all, self.correct_seen, self.softmax_loss, self.triplet_loss])
+            except tf.errors.OutOfRangeError:
+                break
+            # losses are batch means, weighted by the batch size
+            totals += [count, correct_all, correct_seen, softmax_loss * count, triplet_loss * count]
+        num = max(totals[0], 1)
+        metrics = [('accuracy_all_classes', totals[1] / num), ('accuracy_seen_classes', totals[2] / num),
+                   ('softmax_loss_with_score', totals[3] / num), ('triplet_loss', totals[4] / num),
+                   ('multi_loss', (totals[3] + totals[4]) / num)]
+
+        step = _checkpoint_step(ckpt)
+        self.writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='validation/' + tag, simple_value=value)
+                                                  for tag, value in metrics]), step)
+        self.writer.flush()
+        print('[%s][validation][step %d exec %.2f seconds]  %s' %
+              (time.strftime("%Y-%m-%d %H:%M:%S"), step, time.time() - start_time,
+               ', '.join('%s : %.4f' % (tag, value) for tag, value in metrics)))
+        return dict(metrics)
+
+    def close(self):
+        self.writer.close()
+        self.sess.close()
+
+
+def watch_checkpoints(model_dir, log_dir, parent_pid=None, poll_seconds=FLAGS.validation_interval):
+    """ Evaluate every new latest checkpoint of model_dir until the training process exits
+    Args:
+        parent_pid		: Pid of the training process, None to watch forever
+        poll_seconds	: Seconds between two looks at the model dir
+    """
+    os.nice(10)
+    while not os.path.exists(valid_set_path(model_dir)):
+        if parent_pid is not None and os.getppid() != parent_pid:
+            return
+        time.sleep(poll_seconds)
+    validator = Validator(model_dir, log_dir)
+    last_ckpt = None
+    try:
+        while True:
+            # the training process is gone once we are reparented, its last checkpoint is still evaluated
+            training_done = parent_pid is not None and os.getppid() != parent_pid
+            ckpt = tf.train.latest_checkpoint(model_dir)
+            if ckpt is not None and ckpt != last_ckpt:
+                try:
+                    validator.evaluate(ckpt)
+                except tf.errors.NotFoundError:
+                    # deleted by the retention of the checkpointer before it was read
+                    print('checkpoint', ckpt, 'removed before validation')
+                last_ckpt = ckpt
+                continue
+            if training_done:
+                break
+            time.sleep(poll_seconds)
+    finally:
+        validator.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate every new checkpoint of train_multi on the held-out split')
+    parser.add_argument('--model_dir', default=os.path.join('../../data/results_multi/model_weights', model_path_suffix()))
+    parser.add_argument('--log_dir', default=os.path.join('../../data/results_multi/logs', model_path_suffix(), 'val'))
+    parser.add_argument('--parent_pid', type=int, default=None, help='exit once this process is gone')
+    args = parser.parse_args()
+
+    watch_checkpoints(args.model_dir, args.log_dir, args.parent_pid)